@@ -0,0 +1,32 @@
+"""add_message_tokens
+
+Revision ID: 3f9c2d7e8b41
+Revises: a84cc4279d00
+Create Date: 2026-10-17 10:12:40.512337
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9c2d7e8b41"
+down_revision: str | Sequence[str] | None = "a84cc4279d00"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Add messages.tokens (estimated token count of content)."""
+    op.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+
+    # Backfill with the same estimate as services.tokens.count_tokens
+    op.execute("UPDATE messages SET tokens = (octet_length(content) + 3) / 4")
+
+    op.execute("ALTER TABLE messages ALTER COLUMN tokens SET NOT NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Drop messages.tokens."""
+    op.execute("ALTER TABLE messages DROP COLUMN IF EXISTS tokens")
@@ -0,0 +1,37 @@
+"""add_conversations
+
+Revision ID: 5c8e2f1a9b47
+Revises: 7b1e4a9c2d53
+Create Date: 2026-10-17 16:20:43.517209
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5c8e2f1a9b47"
+down_revision: str | Sequence[str] | None = "7b1e4a9c2d53"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Create conversations (system prompt reference per dialogue)."""
+    # Текст промпта берется из реестра roles.prompts, в БД хранится только имя и версия
+    op.execute("""
+        CREATE TABLE conversations (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            chat_id INTEGER NOT NULL REFERENCES chats(id),
+            prompt_name VARCHAR(50) NOT NULL,
+            prompt_version INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema: Drop conversations."""
+    op.execute("DROP TABLE IF EXISTS conversations")
@@ -0,0 +1,40 @@
+"""add_llm_usage
+
+Revision ID: 7b1e4a9c2d53
+Revises: 3f9c2d7e8b41
+Create Date: 2026-10-17 14:05:11.208734
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7b1e4a9c2d53"
+down_revision: str | Sequence[str] | None = "3f9c2d7e8b41"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Create llm_usage (timing and token usage of assistant messages)."""
+    op.execute("""
+        CREATE TABLE llm_usage (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+            model VARCHAR(255) NOT NULL,
+            endpoint VARCHAR(500) NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+
+    # Daily aggregation for /api/v1/stats/llm
+    op.execute("CREATE INDEX idx_llm_usage_created_at ON llm_usage(created_at)")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Drop llm_usage."""
+    op.execute("DROP TABLE IF EXISTS llm_usage")
@@ -0,0 +1,67 @@
+"""add_live_row_indexes
+
+Revision ID: 9d3b6f2e1c85
+Revises: 5c8e2f1a9b47
+Create Date: 2026-10-17 18:42:09.331270
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9d3b6f2e1c85"
+down_revision: str | Sequence[str] | None = "5c8e2f1a9b47"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Partial indexes on live rows (deleted_at IS NULL), built CONCURRENTLY."""
+    # CREATE INDEX CONCURRENTLY не выполняется внутри транзакции и не блокирует запись.
+    # IF NOT EXISTS: повторный запуск после прерванной сборки (невалидный индекс нужно
+    # удалить вручную: DROP INDEX CONCURRENTLY ...)
+    with op.get_context().autocommit_block():
+        # Контекст диалога: load_conversation, get_messages, усечение в append_messages.
+        # Порядок совпадает с ORDER BY created_at DESC, id DESC - без сортировки
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_context
+            ON messages(user_id, chat_id, created_at DESC, id DESC)
+            WHERE deleted_at IS NULL
+        """)
+
+        # Статистика дашборда: COUNT(*), AVG(length) и активность по дням за период.
+        # length в INCLUDE - запросы выполняются index-only scan без чтения таблицы
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_created_at
+            ON messages(created_at) INCLUDE (length)
+            WHERE deleted_at IS NULL
+        """)
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at
+            ON users(created_at)
+            WHERE deleted_at IS NULL
+        """)
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chats_created_at
+            ON chats(created_at)
+            WHERE deleted_at IS NULL
+        """)
+
+        # Все запросы по диалогу читают только живые строки - старый индекс с
+        # удаленными сообщениями заменен idx_messages_context
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_messages_user_chat")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Restore idx_messages_user_chat and drop partial indexes."""
+    with op.get_context().autocommit_block():
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_user_chat
+            ON messages(user_id, chat_id, deleted_at, created_at)
+        """)
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_chats_created_at")
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_users_created_at")
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_messages_created_at")
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_messages_context")
@@ -0,0 +1,101 @@
+"""add_conversation_epoch
+
+Revision ID: a6d2c8e4f1b9
+Revises: e8f1a3b5c7d9
+Create Date: 2026-10-17 23:41:12.527804
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a6d2c8e4f1b9"
+down_revision: str | Sequence[str] | None = "e8f1a3b5c7d9"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Add per-conversation epoch; clearing a dialogue bumps it."""
+    # Очистка диалога - одна запись в conversations (epoch + 1) вместо UPDATE
+    # всех его сообщений. Сообщения прошлых эпох не читаются и удаляются
+    # фоновой очисткой (services/purge.py) после cleared_at + период ожидания.
+    # Колонки с константным DEFAULT добавляются без перезаписи таблиц
+    op.execute("ALTER TABLE messages ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0")
+    op.execute("""
+        ALTER TABLE conversations
+            ALTER COLUMN prompt_name DROP NOT NULL,
+            ALTER COLUMN prompt_version DROP NOT NULL,
+            ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN cleared_at TIMESTAMP
+    """)
+
+    # Контекст диалога читается только в текущей эпохе: epoch входит в индекс,
+    # иначе сразу после очистки чтение просматривало бы всю старую историю.
+    # Как и для idx_messages_deleted: индекс на родителе (ONLY), на каждой
+    # партиции - CONCURRENTLY, затем присоединение к родителю
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_context_epoch
+        ON ONLY messages(user_id, chat_id, epoch, created_at DESC, id DESC)
+        WHERE deleted_at IS NULL
+    """)
+    partitions = op.get_bind().execute(
+        sa.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname"
+        )
+    )
+    names = [row[0] for row in partitions]
+
+    with op.get_context().autocommit_block():
+        for name in names:
+            op.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}_context_epoch_idx
+                ON {name}(user_id, chat_id, epoch, created_at DESC, id DESC)
+                WHERE deleted_at IS NULL
+            """)
+            op.execute(
+                f"ALTER INDEX idx_messages_context_epoch ATTACH PARTITION {name}_context_epoch_idx"
+            )
+        # Очищенные диалоги, ожидающие удаления старых эпох
+        op.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_conversations_cleared_at
+            ON conversations(cleared_at)
+            WHERE cleared_at IS NOT NULL
+        """)
+
+    op.execute("DROP INDEX IF EXISTS idx_messages_context")
+    op.execute("ALTER INDEX idx_messages_context_epoch RENAME TO idx_messages_context")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Soft delete messages of past epochs and drop epochs."""
+    # Без эпох сообщения очищенных диалогов снова стали бы видны
+    op.execute("""
+        UPDATE messages m
+        SET deleted_at = COALESCE(cv.cleared_at, NOW())
+        FROM conversations cv
+        WHERE m.user_id = cv.user_id AND m.chat_id = cv.chat_id
+          AND m.epoch < cv.epoch AND m.deleted_at IS NULL
+    """)
+    op.execute("DELETE FROM conversations WHERE prompt_name IS NULL")
+
+    op.execute("DROP INDEX IF EXISTS idx_messages_context")
+    op.execute("""
+        CREATE INDEX idx_messages_context
+        ON messages(user_id, chat_id, created_at DESC, id DESC)
+        WHERE deleted_at IS NULL
+    """)
+    op.execute("DROP INDEX IF EXISTS idx_conversations_cleared_at")
+    op.execute("""
+        ALTER TABLE conversations
+            DROP COLUMN cleared_at,
+            DROP COLUMN epoch,
+            ALTER COLUMN prompt_name SET NOT NULL,
+            ALTER COLUMN prompt_version SET NOT NULL
+    """)
+    op.execute("ALTER TABLE messages DROP COLUMN epoch")
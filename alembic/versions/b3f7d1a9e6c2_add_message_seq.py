@@ -0,0 +1,68 @@
+"""add_message_seq
+
+Revision ID: b3f7d1a9e6c2
+Revises: a6d2c8e4f1b9
+Create Date: 2026-10-18 00:52:37.904216
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b3f7d1a9e6c2"
+down_revision: str | Sequence[str] | None = "a6d2c8e4f1b9"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Number messages within a conversation epoch (messages.seq).
+
+    Numbers are allocated from conversations.last_seq under the conversation
+    row lock, which keeps (user_id, chat_id, epoch, seq) unique. A UNIQUE
+    index cannot enforce it: on the partitioned messages table it would have
+    to include created_at. Existing messages keep seq NULL.
+
+    idx_messages_seq finds the messages of a turn by number when a write is
+    retried, including ones already trimmed by soft delete.
+    """
+    # Без DEFAULT и с константным DEFAULT - без перезаписи таблиц
+    op.execute("ALTER TABLE messages ADD COLUMN seq BIGINT")
+    op.execute("ALTER TABLE conversations ADD COLUMN last_seq BIGINT NOT NULL DEFAULT 0")
+
+    # Проверка повтора записи (append_messages) ищет сообщения хода по номеру,
+    # включая уже усеченные (soft delete): индекс без условия на deleted_at.
+    # Как и для idx_messages_context: индекс на родителе (ONLY), на каждой
+    # партиции - CONCURRENTLY, затем присоединение к родителю
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_seq
+        ON ONLY messages(user_id, chat_id, epoch, seq)
+        WHERE seq IS NOT NULL
+    """)
+    partitions = op.get_bind().execute(
+        sa.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname"
+        )
+    )
+    names = [row[0] for row in partitions]
+
+    with op.get_context().autocommit_block():
+        for name in names:
+            op.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}_seq_idx
+                ON {name}(user_id, chat_id, epoch, seq)
+                WHERE seq IS NOT NULL
+            """)
+            op.execute(f"ALTER INDEX idx_messages_seq ATTACH PARTITION {name}_seq_idx")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Drop messages.seq and conversations.last_seq."""
+    op.execute("DROP INDEX IF EXISTS idx_messages_seq")
+    op.execute("ALTER TABLE conversations DROP COLUMN last_seq")
+    op.execute("ALTER TABLE messages DROP COLUMN seq")
@@ -0,0 +1,158 @@
+"""partition_messages_by_month
+
+Revision ID: c4a7e9d1f2b3
+Revises: 9d3b6f2e1c85
+Create Date: 2026-10-17 20:11:36.902417
+
+"""
+
+from collections.abc import Sequence
+from datetime import date
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c4a7e9d1f2b3"
+down_revision: str | Sequence[str] | None = "9d3b6f2e1c85"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+# Месячные партиции, создаваемые миграцией после границы старой таблицы
+# (дальше их создает services.partitions)
+MONTHS_AHEAD = 3
+
+
+def _add_months(day: date, months: int) -> date:
+    """Первое число месяца, отстоящего от day на months"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    """Upgrade schema: Convert messages to monthly range partitions on created_at.
+
+    Existing rows are not copied: the old table is attached as the partition
+    messages_legacy (MINVALUE .. boundary) and is dropped whole by retention.
+    """
+    # Граница - начало месяца после следующего: вставки во время миграции
+    # гарантированно попадают в старую таблицу и проходят CHECK
+    boundary = _add_months(date.today(), 2)
+
+    # Долгие операции над старой таблицей - без блокировки записи:
+    # уникальный индекс под составной первичный ключ и CHECK границы
+    # (с проверенным CHECK ATTACH PARTITION не сканирует таблицу)
+    with op.get_context().autocommit_block():
+        op.execute("""
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_legacy_pkey
+            ON messages(id, created_at)
+        """)
+        op.execute(f"""
+            ALTER TABLE messages ADD CONSTRAINT messages_legacy_bound
+            CHECK (created_at < '{boundary.isoformat()}') NOT VALID
+        """)
+        op.execute("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bound")
+
+    # Ключ партиционированной таблицы включает created_at, поэтому внешний ключ
+    # llm_usage(message_id) -> messages(id) невозможен (строки удаляются вместе с партицией)
+    op.execute("ALTER TABLE llm_usage DROP CONSTRAINT IF EXISTS llm_usage_message_id_fkey")
+    op.execute("ALTER TABLE messages DROP CONSTRAINT messages_pkey")
+    op.execute(
+        "ALTER TABLE messages ADD CONSTRAINT messages_legacy_pkey "
+        "PRIMARY KEY USING INDEX messages_legacy_pkey"
+    )
+    op.execute("ALTER TABLE messages RENAME TO messages_legacy")
+    op.execute("ALTER INDEX idx_messages_context RENAME TO messages_legacy_context_idx")
+    op.execute("ALTER INDEX idx_messages_created_at RENAME TO messages_legacy_created_at_idx")
+
+    op.execute("""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            chat_id INTEGER NOT NULL REFERENCES chats(id),
+            role VARCHAR(20) NOT NULL,
+            content TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            deleted_at TIMESTAMP,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # Последовательность не должна удалиться вместе со старой партицией
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+
+    # Индексы на родительской таблице создаются и на каждой партиции;
+    # совпадающие по определению индексы старой таблицы присоединяются без пересборки
+    op.execute("""
+        CREATE INDEX idx_messages_context
+        ON messages(user_id, chat_id, created_at DESC, id DESC)
+        WHERE deleted_at IS NULL
+    """)
+    op.execute("""
+        CREATE INDEX idx_messages_created_at
+        ON messages(created_at) INCLUDE (length)
+        WHERE deleted_at IS NULL
+    """)
+
+    op.execute(f"""
+        ALTER TABLE messages ATTACH PARTITION messages_legacy
+        FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')
+    """)
+
+    # Без DEFAULT-партиции: с ней планировщик не читает партиции по порядку
+    # (ORDER BY created_at DESC LIMIT n остановился бы только после всех)
+    for offset in range(MONTHS_AHEAD):
+        start = _add_months(boundary, offset)
+        end = _add_months(boundary, offset + 1)
+        op.execute(f"""
+            CREATE TABLE messages_y{start.year}m{start.month:02d}
+            PARTITION OF messages
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+        """)
+
+
+def downgrade() -> None:
+    """Downgrade schema: Copy rows back into a plain messages table.
+
+    Partitions detached by retention (MESSAGE_RETENTION_DROP=false) are not restored.
+    """
+    op.execute("""
+        CREATE TABLE messages_plain (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq') PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            chat_id INTEGER NOT NULL REFERENCES chats(id),
+            role VARCHAR(20) NOT NULL,
+            content TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            deleted_at TIMESTAMP,
+            tokens INTEGER NOT NULL
+        )
+    """)
+    op.execute("""
+        INSERT INTO messages_plain
+            (id, user_id, chat_id, role, content, length, created_at, deleted_at, tokens)
+        SELECT id, user_id, chat_id, role, content, length, created_at, deleted_at, tokens
+        FROM messages
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages_plain.id")
+    op.execute("DROP TABLE messages")
+    op.execute("ALTER TABLE messages_plain RENAME TO messages")
+    op.execute("ALTER TABLE messages RENAME CONSTRAINT messages_plain_pkey TO messages_pkey")
+    op.execute("""
+        CREATE INDEX idx_messages_context
+        ON messages(user_id, chat_id, created_at DESC, id DESC)
+        WHERE deleted_at IS NULL
+    """)
+    op.execute("""
+        CREATE INDEX idx_messages_created_at
+        ON messages(created_at) INCLUDE (length)
+        WHERE deleted_at IS NULL
+    """)
+
+    # Замеры удаленных вместе с партициями сообщений восстановить нельзя
+    op.execute("DELETE FROM llm_usage WHERE message_id NOT IN (SELECT id FROM messages)")
+    op.execute("""
+        ALTER TABLE llm_usage ADD CONSTRAINT llm_usage_message_id_fkey
+        FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+    """)
@@ -0,0 +1,72 @@
+"""add_messages_archive
+
+Revision ID: e8f1a3b5c7d9
+Revises: c4a7e9d1f2b3
+Create Date: 2026-10-17 22:03:58.114630
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e8f1a3b5c7d9"
+down_revision: str | Sequence[str] | None = "c4a7e9d1f2b3"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Upgrade schema: Create messages_archive and an index over soft-deleted messages."""
+    # Архив удаленных сообщений (services/purge.py). Без внешних ключей:
+    # архив не должен мешать удалению пользователей и чатов
+    op.execute("""
+        CREATE TABLE messages_archive (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            role VARCHAR(20) NOT NULL,
+            content TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            deleted_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, created_at)
+        )
+    """)
+
+    # Очистка идет пачками по ключу (deleted_at, id). На партиционированной
+    # таблице CONCURRENTLY недоступен: индекс создается на родителе (ONLY, пока
+    # невалидный), на каждой партиции - CONCURRENTLY, и присоединяется к родителю.
+    # Новые партиции получают индекс автоматически
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_deleted
+        ON ONLY messages(deleted_at, id)
+        WHERE deleted_at IS NOT NULL
+    """)
+    partitions = op.get_bind().execute(
+        sa.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname"
+        )
+    )
+    names = [row[0] for row in partitions]
+
+    with op.get_context().autocommit_block():
+        for name in names:
+            op.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}_deleted_idx
+                ON {name}(deleted_at, id)
+                WHERE deleted_at IS NOT NULL
+            """)
+            op.execute(f"ALTER INDEX idx_messages_deleted ATTACH PARTITION {name}_deleted_idx")
+
+
+def downgrade() -> None:
+    """Downgrade schema: Drop messages_archive and idx_messages_deleted."""
+    op.execute("DROP INDEX IF EXISTS idx_messages_deleted")
+    op.execute("DROP TABLE IF EXISTS messages_archive")
@@ -2,7 +2,7 @@
 
 from abc import ABC, abstractmethod
 
-from api.models import DashboardStats
+from api.models import DashboardStats, LLMStats
 
 
 class StatCollector(ABC):
@@ -27,3 +27,18 @@ class StatCollector(ABC):
             ValueError: Если period_days не из допустимых значений
         """
         pass
+
+    @abstractmethod
+    async def get_llm_stats(self, period_days: int = 7) -> LLMStats:
+        """Получить статистику производительности LLM по дням
+
+        Args:
+            period_days: Период в днях (7, 30, 90)
+
+        Returns:
+            LLMStats с перцентилями задержки и токенами по дням
+
+        Raises:
+            ValueError: Если period_days не из допустимых значений
+        """
+        pass
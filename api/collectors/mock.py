@@ -7,7 +7,7 @@ from typing import Literal
 from faker import Faker
 
 from api.collectors.base import StatCollector
-from api.models import DashboardStats, MetricCard, TimeSeriesPoint
+from api.models import DashboardStats, LLMDayStats, LLMStats, MetricCard, TimeSeriesPoint
 
 
 class MockStatCollector(StatCollector):
@@ -62,6 +62,44 @@ class MockStatCollector(StatCollector):
             activity_chart=self._generate_activity_chart(period_days),
         )
 
+    async def get_llm_stats(self, period_days: int = 7) -> LLMStats:
+        """Получить mock статистику производительности LLM
+
+        Args:
+            period_days: Период в днях (7, 30, 90)
+
+        Returns:
+            LLMStats со сгенерированными данными
+
+        Raises:
+            ValueError: Если period_days не из допустимых значений
+        """
+        if period_days not in [7, 30, 90]:
+            raise ValueError(f"period_days должен быть 7, 30 или 90, получено: {period_days}")
+
+        today = date.today()
+        days: list[LLMDayStats] = []
+
+        for i in range(period_days):
+            current_date = today - timedelta(days=period_days - i - 1)
+            requests = random.randint(50, 300)
+            p50 = random.uniform(800.0, 2500.0)
+            completion_tokens = requests * random.randint(80, 250)
+            days.append(
+                LLMDayStats(
+                    date=current_date,
+                    requests=requests,
+                    p50_latency_ms=round(p50, 1),
+                    p95_latency_ms=round(p50 * random.uniform(2.0, 3.0), 1),
+                    p99_latency_ms=round(p50 * random.uniform(3.0, 5.0), 1),
+                    prompt_tokens=requests * random.randint(500, 2000),
+                    completion_tokens=completion_tokens,
+                    tokens_per_second=round(random.uniform(20.0, 80.0), 1),
+                )
+            )
+
+        return LLMStats(days=days)
+
     def _generate_metric_card(self, value: int | float, metric_type: str) -> MetricCard:
         """Генерация карточки метрики с трендом
 
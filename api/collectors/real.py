@@ -5,7 +5,7 @@ from datetime import date, timedelta
 from typing import Any, Literal
 
 from api.collectors.base import StatCollector
-from api.models import DashboardStats, MetricCard, TimeSeriesPoint
+from api.models import DashboardStats, LLMDayStats, LLMStats, MetricCard, TimeSeriesPoint
 from services.database import get_pool
 
 logger = logging.getLogger(__name__)
@@ -61,6 +61,98 @@ class RealStatCollector(StatCollector):
             activity_chart=activity_chart,
         )
 
+    async def get_llm_stats(self, period_days: int = 7) -> LLMStats:
+        """Получить статистику производительности LLM из таблицы llm_usage
+
+        Args:
+            period_days: Период в днях (7, 30, 90)
+
+        Returns:
+            LLMStats с перцентилями задержки и токенами по дням
+
+        Raises:
+            ValueError: Если period_days не из допустимых значений
+        """
+        if period_days not in [7, 30, 90]:
+            raise ValueError(f"period_days должен быть 7, 30 или 90, получено: {period_days}")
+
+        logger.info(f"Collecting LLM stats for period: {period_days} days")
+
+        pool = await get_pool()
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                days = await self._get_llm_days(cur, period_days)
+
+        return LLMStats(days=days)
+
+    async def _get_llm_days(self, cur: Any, period_days: int) -> list[LLMDayStats]:
+        """Получить перцентили задержки и токены LLM по дням"""
+        await cur.execute(
+            """
+            SELECT
+                DATE(created_at) as date,
+                COUNT(*) as requests,
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY latency_ms) as p50,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) as p95,
+                percentile_cont(0.99) WITHIN GROUP (ORDER BY latency_ms) as p99,
+                COALESCE(SUM(prompt_tokens), 0) as prompt_tokens,
+                COALESCE(SUM(completion_tokens), 0) as completion_tokens,
+                SUM(latency_ms) FILTER (WHERE completion_tokens IS NOT NULL) as generation_ms
+            FROM llm_usage
+            WHERE created_at >= CURRENT_DATE - INTERVAL '%s days'
+            GROUP BY DATE(created_at)
+            ORDER BY date
+            """,
+            (period_days,)
+        )
+
+        results = await cur.fetchall()
+
+        # Создаем словарь с данными
+        data_dict = {row[0]: row[1:] for row in results}
+
+        # Заполняем все дни в периоде (даже те, где не было запросов)
+        today = date.today()
+        days: list[LLMDayStats] = []
+
+        for i in range(period_days):
+            current_date = today - timedelta(days=period_days - i - 1)
+            row = data_dict.get(current_date)
+            if row is None:
+                days.append(
+                    LLMDayStats(
+                        date=current_date,
+                        requests=0,
+                        p50_latency_ms=0.0,
+                        p95_latency_ms=0.0,
+                        p99_latency_ms=0.0,
+                        prompt_tokens=0,
+                        completion_tokens=0,
+                        tokens_per_second=0.0,
+                    )
+                )
+                continue
+
+            requests, p50, p95, p99, prompt_tokens, completion_tokens, generation_ms = row
+            tokens_per_second = (
+                completion_tokens / (generation_ms / 1000) if generation_ms else 0.0
+            )
+            days.append(
+                LLMDayStats(
+                    date=current_date,
+                    requests=requests,
+                    p50_latency_ms=round(float(p50), 1),
+                    p95_latency_ms=round(float(p95), 1),
+                    p99_latency_ms=round(float(p99), 1),
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    tokens_per_second=round(float(tokens_per_second), 1),
+                )
+            )
+
+        return days
+
     async def _get_total_users(self, cur: Any, period_days: int) -> MetricCard:
         """Получить метрику общего количества пользователей с трендом"""
         # Текущее значение
@@ -4,16 +4,21 @@ import logging
 
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
 
 from api.collectors.base import StatCollector
 from api.collectors.mock import MockStatCollector
 from api.config import load_api_config
-from api.models import DashboardStats
+from api.models import DashboardStats, LLMStats
 from config import load_config as load_main_config
+from message_types import LLMUsage, Message
 from services.analytics import process_analytics_query
-from services.context import clear_context, get_context, save_context
+from services.context import append_turn, clear_context, get_context
 from services.database import close_db, init_db
+from services.llm import close_llm_clients, warm_up_llm
+from services.metrics import METRICS_CONTENT_TYPE, render_metrics
+from services.summarizer import schedule_summary
 
 # Настройка логирования
 logging.basicConfig(
@@ -111,6 +116,12 @@ async def startup_event() -> None:
             logger.error(f"❌ Ошибка подключения к БД: {e}")
             raise
 
+        # Соединения с LLM для аналитического чата устанавливаются заранее
+        try:
+            await warm_up_llm(load_main_config())
+        except ValueError as e:
+            logger.warning(f"Прогрев LLM пропущен: {e}")
+
 
 @app.on_event("shutdown")
 async def shutdown_event() -> None:
@@ -119,6 +130,7 @@ async def shutdown_event() -> None:
         logger.info("Закрытие подключения к БД...")
         await close_db()
         logger.info("✅ Подключение к БД закрыто")
+        await close_llm_clients()
 
 
 @app.get("/", tags=["Root"])
@@ -147,6 +159,16 @@ async def health_check() -> dict[str, str]:
     return {"status": "healthy", "mode": config.mode}
 
 
+@app.get("/metrics", tags=["Health"], include_in_schema=False)
+async def metrics() -> Response:
+    """Метрики Prometheus: латентность, время до первого токена и токены запросов к LLM
+
+    Returns:
+        Метрики в текстовом формате Prometheus
+    """
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get(
     "/api/v1/stats",
     response_model=DashboardStats,
@@ -201,6 +223,55 @@ async def get_stats(
         raise HTTPException(status_code=500, detail="Ошибка при получении статистики") from e
 
 
+@app.get(
+    "/api/v1/stats/llm",
+    response_model=LLMStats,
+    tags=["Statistics"],
+    summary="Получить статистику производительности LLM",
+    description="""
+    Возвращает показатели ответов LLM по дням:
+    - p50/p95/p99 времени ответа
+    - Токены запросов и ответов, скорость генерации
+
+    Поддерживаемые периоды: 7, 30, 90 дней
+    """,
+)
+async def get_llm_stats(
+    period: int = Query(
+        default=7,
+        description="Период в днях (7, 30 или 90)",
+        ge=7,
+        le=90,
+    ),
+) -> LLMStats:
+    """Получить статистику производительности LLM
+
+    Args:
+        period: Период в днях (7, 30 или 90)
+
+    Returns:
+        LLMStats с показателями по дням
+
+    Raises:
+        HTTPException: При ошибке получения статистики
+    """
+    if period not in [7, 30, 90]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Недопустимое значение period. Допустимые значения: 7, 30, 90. Получено: {period}",
+        )
+
+    try:
+        logger.info(f"Запрос статистики LLM за {period} дней")
+        return await collector.get_llm_stats(period_days=period)
+    except ValueError as e:
+        logger.error(f"Ошибка валидации: {e}")
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики LLM: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении статистики") from e
+
+
 @app.post(
     "/api/v1/chat",
     response_model=ChatResponse,
@@ -241,25 +312,39 @@ async def chat_endpoint(request: ChatRequest) -> ChatResponse:
         messages = context.get("messages", [])
 
         # Обрабатываем аналитический запрос
+        # Замеры запросов к LLM (модель, задержка, токены) сохраняются вместе с ответом
+        usage: list[LLMUsage] = []
         response, sql_executed = await process_analytics_query(
             request.message,
             messages,
-            main_config
+            main_config,
+            user_id=request.user_id,
+            on_usage=usage.append,
         )
 
-        # Сохраняем контекст (user message + assistant response)
+        # Сохраняем ход диалога (user message + assistant response)
         from constants import MessageRole
-        messages.append({"role": MessageRole.USER, "content": request.message})
-        messages.append({"role": MessageRole.ASSISTANT, "content": response})
-
-        await save_context(
+        answer: Message = {"role": MessageRole.ASSISTANT, "content": response}
+        if usage:
+            # Ответ - результат последнего запроса к LLM
+            answer["usage"] = usage[-1]
+        turn: list[Message] = [
+            {"role": MessageRole.USER, "content": request.message},
+            answer,
+        ]
+
+        await append_turn(
             request.user_id,
             request.user_id,
-            messages,
+            turn,
             f"WebUser_{request.user_id}",
-            main_config.max_context_messages
+            main_config.max_context_messages,
+            first_seq=context["seq"] + 1,
         )
 
+        # Сжатие длинного диалога - в фоне (порог - по уже загруженному контексту)
+        schedule_summary(request.user_id, request.user_id, main_config, messages + turn)
+
         logger.info(f"Chat запрос обработан успешно для user_id={request.user_id}")
 
         return ChatResponse(response=response, sql_executed=sql_executed)
@@ -76,3 +76,52 @@ class DashboardStats(BaseModel):
             }
         }
     }
+
+
+class LLMDayStats(BaseModel):
+    """Производительность LLM за один день
+
+    Attributes:
+        date: Дата
+        requests: Количество ответов LLM
+        p50_latency_ms: Медиана времени ответа, мс
+        p95_latency_ms: 95-й перцентиль времени ответа, мс
+        p99_latency_ms: 99-й перцентиль времени ответа, мс
+        prompt_tokens: Сумма токенов запросов
+        completion_tokens: Сумма токенов ответов
+        tokens_per_second: Скорость генерации (токены ответа в секунду)
+    """
+
+    date: dt_date = Field(..., description="Дата")
+    requests: int = Field(..., ge=0, description="Количество ответов LLM")
+    p50_latency_ms: float = Field(..., ge=0, description="Медиана времени ответа, мс")
+    p95_latency_ms: float = Field(..., ge=0, description="95-й перцентиль времени ответа, мс")
+    p99_latency_ms: float = Field(..., ge=0, description="99-й перцентиль времени ответа, мс")
+    prompt_tokens: int = Field(..., ge=0, description="Сумма токенов запросов")
+    completion_tokens: int = Field(..., ge=0, description="Сумма токенов ответов")
+    tokens_per_second: float = Field(..., ge=0, description="Токены ответа в секунду генерации")
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "date": "2025-10-17",
+                "requests": 142,
+                "p50_latency_ms": 1850.0,
+                "p95_latency_ms": 5200.0,
+                "p99_latency_ms": 9100.0,
+                "prompt_tokens": 98000,
+                "completion_tokens": 21000,
+                "tokens_per_second": 42.7,
+            }
+        }
+    }
+
+
+class LLMStats(BaseModel):
+    """Статистика производительности LLM по дням
+
+    Attributes:
+        days: Показатели по дням периода (дни без ответов - с нулями)
+    """
+
+    days: list[LLMDayStats] = Field(..., description="Показатели LLM по дням")
@@ -1,5 +1,7 @@
 """Тесты для FastAPI endpoint статистики"""
 
+from unittest.mock import AsyncMock, MagicMock, patch
+
 import pytest
 from fastapi.testclient import TestClient
 
@@ -30,6 +32,45 @@ def test_health_check() -> None:
     assert "mode" in data
 
 
+def test_metrics_endpoint() -> None:
+    """Тест endpoint метрик Prometheus"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE llm_request_duration_seconds histogram" in response.text
+
+
+def test_chat_saves_llm_usage() -> None:
+    """Тест: ответ аналитического чата сохраняется с замерами запроса к LLM"""
+    usage = {
+        "model": "m",
+        "endpoint": "https://a",
+        "latency_ms": 900,
+        "prompt_tokens": 50,
+        "completion_tokens": 10,
+    }
+
+    async def process(message, history, config, user_id=None, on_usage=None):  # type: ignore[no-untyped-def]
+        on_usage(usage)
+        return "42", None
+
+    config = MagicMock(max_context_messages=10, summary_enabled=False)
+    mock_append = AsyncMock()
+    with (
+        patch("api.main.load_main_config", return_value=config),
+        patch("api.main.get_context", new=AsyncMock(return_value={"messages": [], "seq": 3})),
+        patch("api.main.process_analytics_query", new=process),
+        patch("api.main.append_turn", new=mock_append),
+    ):
+        response = client.post("/api/v1/chat", json={"user_id": 1, "message": "Сколько?"})
+
+    assert response.status_code == 200
+    turn = mock_append.call_args.args[2]
+    assert turn[1]["content"] == "42"
+    assert turn[1]["usage"] == usage
+    assert mock_append.call_args.kwargs["first_seq"] == 4
+
+
 def test_get_stats_default_period() -> None:
     """Тест получения статистики с периодом по умолчанию (90 дней)"""
     response = client.get("/api/v1/stats")
@@ -82,6 +123,27 @@ def test_get_stats_invalid_period() -> None:
     assert response.status_code == 400  # Validation error (custom check)
 
 
+@pytest.mark.parametrize("period", [7, 30, 90])
+def test_get_llm_stats(period: int) -> None:
+    """Тест статистики производительности LLM по дням"""
+    response = client.get(f"/api/v1/stats/llm?period={period}")
+    assert response.status_code == 200
+    days = response.json()["days"]
+    assert len(days) == period
+
+    day = days[0]
+    assert day["p50_latency_ms"] <= day["p95_latency_ms"] <= day["p99_latency_ms"]
+    for key in ["requests", "prompt_tokens", "completion_tokens", "tokens_per_second"]:
+        assert day[key] >= 0
+    assert [d["date"] for d in days] == sorted(d["date"] for d in days)
+
+
+def test_get_llm_stats_invalid_period() -> None:
+    """Тест статистики LLM с недопустимым периодом"""
+    response = client.get("/api/v1/stats/llm?period=15")
+    assert response.status_code == 400
+
+
 def test_get_stats_reproducibility() -> None:
     """Тест что Mock генерирует разумные данные при повторных вызовах"""
     # Два запроса должны вернуть данные (могут быть разные - это Mock)
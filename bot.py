@@ -9,6 +9,10 @@ from aiogram import Bot, Dispatcher
 from config import load_config
 from handlers import commands, messages
 from services.database import close_db, init_db
+from services.llm import close_llm_clients, warm_up_llm
+from services.metrics import start_metrics_server
+from services.partitions import run_partition_maintenance
+from services.purge import run_message_purge
 
 # Настройка логирования
 logging.basicConfig(
@@ -48,6 +52,20 @@ async def main() -> None:
         logger.error("Убедитесь, что PostgreSQL запущен и DATABASE_URL правильный")
         return
 
+    # Соединения с LLM устанавливаются заранее, а не на первом сообщении
+    await warm_up_llm(config)
+
+    # Метрики Prometheus (латентность LLM, токены) на отдельном порту
+    metrics_runner = (
+        await start_metrics_server(config.metrics_port) if config.metrics_port else None
+    )
+
+    # Партиции messages создаются заранее, устаревшие отсоединяются (раз в час)
+    partition_task = asyncio.create_task(run_partition_maintenance(config))
+    # Сообщения очищенных диалогов помечаются удаленными, удаленные
+    # (MESSAGE_PURGE_ENABLED) переносятся в архив пачками, без долгих блокировок
+    purge_task = asyncio.create_task(run_message_purge(config))
+
     # Запуск бота
     try:
         logger.info("✅ Bot started successfully")
@@ -55,8 +73,13 @@ async def main() -> None:
     except Exception as e:
         logger.error(f"Bot error: {e}")
     finally:
+        partition_task.cancel()
+        purge_task.cancel()
         await bot.session.close()
+        await close_llm_clients()
         await close_db()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         logger.info("Bot stopped")
 
 
@@ -20,7 +20,36 @@ class Config:
     max_tokens: int = 1000
     temperature: float = 0.7
     max_context_messages: int = 15
+    context_window_tokens: int = 0  # 0 - определить по названию модели
     openai_timeout: int = 30
+    llm_endpoints: str = ""  # base_url|model|weight|API_KEY_ENV через запятую
+    llm_max_concurrency: int = 8
+    llm_cache_enabled: bool = False
+    llm_max_retries: int = 2
+    llm_circuit_threshold: int = 5
+    llm_circuit_reset_seconds: float = 30.0
+    llm_hedge_enabled: bool = False
+    llm_hedge_percentile: float = 0.95
+    llm_http_max_connections: int = 100
+    llm_http_max_keepalive: int = 20
+    llm_http_keepalive_expiry: float = 30.0
+    llm_http2: bool = False
+    metrics_port: int = 0  # 0 - сервер метрик бота выключен
+    llm_streaming: bool = False
+    stream_edit_interval: float = 1.0
+    summary_enabled: bool = False
+    summary_trigger_tokens: int = 2000
+    summary_keep_messages: int = 4
+    analytics_compact_prompt: bool = False
+    partition_months_ahead: int = 2
+    message_retention_months: int = 0  # 0 - хранить все партиции messages
+    message_retention_drop: bool = False  # False - только отсоединять партиции
+    message_purge_enabled: bool = False
+    message_purge_grace_hours: float = 168.0  # Soft-deleted строки хранятся неделю
+    message_purge_archive: bool = True  # False - удалять без архива
+    message_purge_batch_size: int = 500
+    message_purge_batch_pause: float = 0.5  # Пауза между пачками, секунды
+    message_purge_interval: float = 300.0  # Пауза между проходами, секунды
 
 
 def load_config() -> Config:
@@ -34,7 +63,36 @@ def load_config() -> Config:
         max_tokens=int(getenv("MAX_TOKENS", "1000")),
         temperature=float(getenv("TEMPERATURE", "0.7")),
         openai_timeout=int(getenv("OPENAI_TIMEOUT", "30")),
+        llm_endpoints=getenv("LLM_ENDPOINTS", ""),
         max_context_messages=int(getenv("MAX_CONTEXT_MESSAGES", "10")),
+        context_window_tokens=int(getenv("CONTEXT_WINDOW_TOKENS", "0")),
+        llm_max_concurrency=int(getenv("LLM_MAX_CONCURRENCY", "8")),
+        llm_cache_enabled=getenv("LLM_CACHE_ENABLED", "false").lower() == "true",
+        llm_max_retries=int(getenv("LLM_MAX_RETRIES", "2")),
+        llm_circuit_threshold=int(getenv("LLM_CIRCUIT_THRESHOLD", "5")),
+        llm_circuit_reset_seconds=float(getenv("LLM_CIRCUIT_RESET_SECONDS", "30")),
+        llm_hedge_enabled=getenv("LLM_HEDGE_ENABLED", "false").lower() == "true",
+        llm_hedge_percentile=float(getenv("LLM_HEDGE_PERCENTILE", "0.95")),
+        llm_http_max_connections=int(getenv("LLM_HTTP_MAX_CONNECTIONS", "100")),
+        llm_http_max_keepalive=int(getenv("LLM_HTTP_MAX_KEEPALIVE", "20")),
+        llm_http_keepalive_expiry=float(getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "30")),
+        llm_http2=getenv("LLM_HTTP2", "false").lower() == "true",
+        metrics_port=int(getenv("METRICS_PORT", "0")),
+        llm_streaming=getenv("LLM_STREAMING", "false").lower() == "true",
+        stream_edit_interval=float(getenv("STREAM_EDIT_INTERVAL", "1.0")),
+        summary_enabled=getenv("SUMMARY_ENABLED", "false").lower() == "true",
+        summary_trigger_tokens=int(getenv("SUMMARY_TRIGGER_TOKENS", "2000")),
+        summary_keep_messages=int(getenv("SUMMARY_KEEP_MESSAGES", "4")),
+        analytics_compact_prompt=getenv("ANALYTICS_COMPACT_PROMPT", "false").lower() == "true",
+        partition_months_ahead=int(getenv("PARTITION_MONTHS_AHEAD", "2")),
+        message_retention_months=int(getenv("MESSAGE_RETENTION_MONTHS", "0")),
+        message_retention_drop=getenv("MESSAGE_RETENTION_DROP", "false").lower() == "true",
+        message_purge_enabled=getenv("MESSAGE_PURGE_ENABLED", "false").lower() == "true",
+        message_purge_grace_hours=float(getenv("MESSAGE_PURGE_GRACE_HOURS", "168")),
+        message_purge_archive=getenv("MESSAGE_PURGE_ARCHIVE", "true").lower() == "true",
+        message_purge_batch_size=int(getenv("MESSAGE_PURGE_BATCH_SIZE", "500")),
+        message_purge_batch_pause=float(getenv("MESSAGE_PURGE_BATCH_PAUSE", "0.5")),
+        message_purge_interval=float(getenv("MESSAGE_PURGE_INTERVAL", "300")),
     )
 
     if not config.telegram_token:
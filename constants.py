@@ -1,6 +1,6 @@
 """Константы приложения"""
 
-from enum import Enum
+from enum import Enum, StrEnum
 
 
 class MessageRole(str, Enum):
@@ -9,3 +9,76 @@ class MessageRole(str, Enum):
     SYSTEM = "system"
     USER = "user"
     ASSISTANT = "assistant"
+    # Краткое содержание старой части диалога (хранится в БД, модели передается как system)
+    SUMMARY = "summary"
+
+
+# Роли, которые не удаляются при усечении истории по количеству сообщений
+PINNED_ROLES = (MessageRole.SYSTEM, MessageRole.SUMMARY)
+
+
+class LLMPriority(StrEnum):
+    """Классы (полосы) запросов к LLM для планировщика"""
+
+    CHAT = "chat"  # Диалог в Telegram-боте
+    API = "api"  # Аналитический чат /api/v1/chat
+    BACKGROUND = "background"  # Фоновые задачи
+
+
+# Кэш контекста диалогов (services/context.py)
+CONTEXT_CACHE_SIZE = 1000  # Максимум диалогов в памяти
+CONTEXT_CACHE_TTL = 600  # Время жизни записи, секунды
+
+# Кэш соответствия Telegram ID -> ID в БД (services/database.py)
+ID_CACHE_SIZE = 10000
+ID_CACHE_TTL = 3600
+
+# Кэш ответов LLM на одинаковые запросы (services/llm.py, LLM_CACHE_ENABLED)
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 300
+
+# Пауза между повторами запроса к LLM: base * 2^attempt с jitter, не более max (секунды)
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8.0
+# Минимум оставшегося бюджета openai_timeout для повтора или переключения, секунды:
+# попытка с меньшим таймаутом почти наверняка не успеет
+RETRY_MIN_BUDGET = 2.0
+
+# Маршрутизация между endpoint'ами LLM (services/router.py)
+ROUTER_EWMA_ALPHA = 0.2  # Вес нового замера в скользящих задержке и доле ошибок
+ROUTER_ERROR_PENALTY = 4.0  # Во сколько раз доля ошибок 100% ухудшает оценку endpoint'а
+
+# Хеджирование запросов к LLM (services/hedging.py, LLM_HEDGE_ENABLED)
+HEDGE_LATENCY_WINDOW = 200  # Сколько последних задержек учитывается в перцентиле
+HEDGE_MIN_SAMPLES = 20  # Меньше замеров - дубль не отправляется
+
+# Границы корзин гистограмм метрик LLM (services/metrics.py)
+LLM_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)  # Секунды
+LLM_QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Секунды
+LLM_TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# Веса полос планировщика LLM: доля слотов при конкуренции (services/scheduler.py)
+LLM_LANE_WEIGHTS = {
+    LLMPriority.CHAT: 4.0,
+    LLMPriority.API: 2.0,
+    LLMPriority.BACKGROUND: 1.0,
+}
+
+# Окна контекста известных моделей в токенах (services/tokens.py).
+# Ищется первое вхождение ключа в названии модели
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+    "gpt-oss": 131072,
+    "deepseek": 65536,
+    "llama-3": 131072,
+    "qwen": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192  # Для неизвестных моделей
+MESSAGE_TOKEN_OVERHEAD = 4  # Служебные токены на каждое сообщение (роль, разделители)
+
+# Обслуживание месячных партиций messages (services/partitions.py)
+PARTITION_MAINTENANCE_INTERVAL = 3600  # Период проверки, секунды
+PARTITION_MAINTENANCE_LOCK_ID = 7_402_215_001  # Advisory lock: одна реплика за раз
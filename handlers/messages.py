@@ -1,70 +1,208 @@
 """Обработчики текстовых сообщений"""
 
+import asyncio
 import logging
+import time
+from collections.abc import Callable
 
 from aiogram import Router
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message
 
-from config import load_config
+from config import Config, load_config
 from constants import MessageRole
-from roles.prompts import get_system_prompt
-from services.context import get_context, save_context, trim_context
-from services.llm import get_llm_response
+from message_types import LLMUsage
+from message_types import Message as ChatMessage
+from roles.prompts import PromptName, get_prompt, get_user_prompt
+from services.coalescer import MessageCoalescer, merge_user_messages
+from services.context import append_turn, get_context, insert_after_system, trim_context
+from services.llm import get_llm_response, stream_llm_response
+from services.summarizer import schedule_summary
+from services.tokens import count_tokens, get_context_budget, message_tokens
 
 logger = logging.getLogger(__name__)
 router = Router()
 
 
+# Очередь сообщений по диалогам: сообщения, пришедшие во время запроса к LLM,
+# объединяются в один ход и получают один ответ
+_coalescer: MessageCoalescer[Message] = MessageCoalescer()
+
+# Ограничение Telegram на длину текста одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Заглушка, которая показывается до первых токенов потокового ответа
+STREAM_PLACEHOLDER = "⏳"
+
+
 @router.message()
 async def handle_message(message: Message) -> None:
     """Обработчик всех текстовых сообщений (кроме команд)"""
     if not message.from_user or not message.bot:
         return
 
-    config = load_config()  # Загружаем конфигурацию внутри функции
-
     user_id = message.from_user.id
     chat_id = message.chat.id
-    user_name = message.from_user.first_name
-    user_message = message.text
 
     logger.info(
-        f"User {user_id} sent message: length={len(user_message) if user_message else 0}, chat_id={chat_id}"
+        f"User {user_id} sent message: length={len(message.text) if message.text else 0}, chat_id={chat_id}"
     )
 
-    # Получаем существующий контекст
-    context = await get_context(user_id, chat_id)
-    messages = context.get("messages", [])
+    await _coalescer.submit((user_id, chat_id), message, _answer_messages)
 
-    # Если контекста нет, создаем с system prompt
-    if not messages:
-        messages = [{"role": MessageRole.SYSTEM, "content": get_system_prompt(user_name)}]
 
-    # Добавляем сообщение пользователя
-    messages.append({"role": MessageRole.USER, "content": user_message})
+async def _answer_messages(batch: list[Message]) -> None:
+    """Ответить на пачку подряд идущих сообщений одного диалога одним ходом"""
+    message = batch[-1]
+    if not message.from_user or not message.bot:
+        return
 
-    # Усекаем контекст если нужно
-    messages = trim_context(messages, max_messages=config.max_context_messages)
+    config = load_config()  # Загружаем конфигурацию внутри функции
+
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    user_name = message.from_user.first_name
+    user_message = merge_user_messages([m.text for m in batch])
 
-    # Получаем ответ от LLM
     try:
+        # Получаем существующий контекст (без ссылки на промпт - с текущим промптом чата)
+        context = await get_context(user_id, chat_id, default_prompt=get_prompt(PromptName.CHAT))
+        messages = context.get("messages", [])
+        tokens = context.get("tokens", [])
+
+        # Новые сообщения этого хода (сохраняются одним запросом после ответа LLM)
+        turn: list[ChatMessage] = []
+        turn_tokens: list[int] = []
+
+        # Если контекста нет, начинаем диалог с system prompt (одинаковым для всех пользователей,
+        # чтобы префикс запроса попадал в кэш промптов провайдера). В БД сохраняется
+        # только его имя и версия, текст берется из реестра при загрузке контекста
+        prompt = None
+        if not messages:
+            prompt = get_prompt(PromptName.CHAT)
+            messages = [prompt.message]
+            tokens = [prompt.tokens]
+
+        # Добавляем сообщение пользователя
+        turn.append({"role": MessageRole.USER, "content": user_message})
+        turn_tokens.append(message_tokens(count_tokens(user_message)))
+
+        # Имя пользователя передается отдельным сообщением после system prompt (в БД не хранится)
+        profile = get_user_prompt(user_name)
+        profile_tokens = message_tokens(count_tokens(profile["content"])) if profile else 0
+
+        # Усекаем контекст по количеству сообщений и бюджету токенов модели
+        # (для истории используются сохраненные счетчики токенов)
+        messages = trim_context(
+            messages + turn,
+            max_messages=config.max_context_messages,
+            token_budget=max(get_context_budget(config) - profile_tokens, 0),
+            tokens=tokens + turn_tokens,
+        )
+        request = insert_after_system(messages, profile) if profile else messages
+
+        # Получаем ответ от LLM
         # Показываем, что бот печатает
         await message.bot.send_chat_action(chat_id, "typing")
 
-        response = await get_llm_response(messages, config)
+        # Замеры запроса (модель, задержка, токены) сохраняются вместе с ответом
+        usage: list[LLMUsage] = []
+        if config.llm_streaming:
+            response = await _stream_answer(message, request, config, user_id, usage.append)
+        else:
+            response = await get_llm_response(
+                request, config, user_id=user_id, on_usage=usage.append
+            )
 
         # Добавляем ответ в контекст
         messages.append({"role": MessageRole.ASSISTANT, "content": response})
+        answer: ChatMessage = {"role": MessageRole.ASSISTANT, "content": response}
+        if usage:
+            answer["usage"] = usage[-1]
+        turn.append(answer)
+
+        # Сохраняем новые сообщения хода (с номерами после контекста, на котором построен ход)
+        await append_turn(
+            user_id,
+            chat_id,
+            turn,
+            user_name,
+            config.max_context_messages,
+            prompt=prompt,
+            first_seq=context["seq"] + 1,
+        )
 
-        # Сохраняем обновленный контекст
-        await save_context(user_id, chat_id, messages, user_name)
-
-        await message.answer(response)
+        if not config.llm_streaming:
+            await message.answer(response)
 
         logger.info(
-            f"User {user_id} received response: length={len(response)}, context_size={len(messages)}"
+            f"User {user_id} received response: length={len(response)}, "
+            f"merged_messages={len(batch)}, context_size={len(messages)}"
         )
 
+        # Сжатие длинного диалога - в фоне, уже после ответа
+        schedule_summary(user_id, chat_id, config, context["messages"] + turn)
+
     except Exception as e:
         logger.error(f"Error handling message: {e}")
         await message.answer("❌ Произошла ошибка при обработке сообщения.")
+
+
+async def _stream_answer(
+    message: Message,
+    messages: list[ChatMessage],
+    config: Config,
+    user_id: int,
+    on_usage: Callable[[LLMUsage], None] | None = None,
+) -> str:
+    """
+    Показать ответ LLM по мере генерации
+
+    Отправляет заглушку и редактирует ее не чаще stream_edit_interval секунд
+    (лимит Telegram на редактирование). Если Telegram просит подождать
+    (RetryAfter), промежуточные обновления пропускаются.
+
+    Returns:
+        Окончательный текст ответа
+    """
+    placeholder = await message.answer(STREAM_PLACEHOLDER)
+
+    response = ""
+    shown = STREAM_PLACEHOLDER
+    next_edit_at = 0.0
+    async for response in stream_llm_response(messages, config, user_id=user_id, on_usage=on_usage):
+        text = response[:TELEGRAM_MESSAGE_LIMIT]
+        now = time.monotonic()
+        if not text or text == shown or now < next_edit_at:
+            continue
+        try:
+            await _edit_text(placeholder, text)
+            shown = text
+            next_edit_at = now + config.stream_edit_interval
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram edit rate limit, retry after {e.retry_after}s")
+            next_edit_at = now + e.retry_after
+
+    # Окончательный текст показываем обязательно, длинный ответ - несколькими сообщениями
+    chunks = [
+        response[i : i + TELEGRAM_MESSAGE_LIMIT]
+        for i in range(0, len(response), TELEGRAM_MESSAGE_LIMIT)
+    ]
+    if chunks and chunks[0] != shown:
+        try:
+            await _edit_text(placeholder, chunks[0])
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await _edit_text(placeholder, chunks[0])
+    for chunk in chunks[1:]:
+        await message.answer(chunk)
+
+    return response
+
+
+async def _edit_text(placeholder: Message, text: str) -> None:
+    """Отредактировать сообщение, игнорируя ошибку «message is not modified»"""
+    try:
+        await placeholder.edit_text(text)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            raise
@@ -1,6 +1,24 @@
 """Типы данных приложения"""
 
-from typing import TypedDict
+from typing import NotRequired, TypedDict
+
+
+class LLMUsage(TypedDict):
+    """Замеры запроса к LLM, сохраняемые вместе с ответом ассистента.
+
+    Attributes:
+        model: Модель, сгенерировавшая ответ
+        endpoint: Endpoint (base_url) провайдера
+        latency_ms: Время генерации ответа, миллисекунды
+        prompt_tokens: Токены запроса (None, если провайдер не вернул usage)
+        completion_tokens: Токены ответа (None, если провайдер не вернул usage)
+    """
+
+    model: str
+    endpoint: str
+    latency_ms: int
+    prompt_tokens: int | None
+    completion_tokens: int | None
 
 
 class Message(TypedDict):
@@ -9,7 +27,10 @@ class Message(TypedDict):
     Attributes:
         role: Роль отправителя (system/user/assistant)
         content: Текст сообщения
+        usage: Замеры запроса к LLM (только у нового ответа ассистента,
+            сохраняются в llm_usage и модели не передаются)
     """
 
     role: str
     content: str
+    usage: NotRequired[LLMUsage]
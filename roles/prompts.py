@@ -1,5 +1,15 @@
 """Системные промпты для разных ролей бота"""
 
+import logging
+from dataclasses import dataclass, field
+from enum import StrEnum
+
+from constants import MessageRole
+from message_types import Message
+from services.tokens import count_tokens, message_tokens
+
+logger = logging.getLogger(__name__)
+
 DEFAULT_SYSTEM_PROMPT = """Ты — полезный AI-ассистент.
 
 ПРАВИЛА:
@@ -50,7 +60,7 @@ ANALYTICS_SYSTEM_PROMPT = """Ты — Daily Reporter, AI-ассистент дл
 - id (integer)
 - user_id (integer, FK -> users.id) - с подчеркиванием!
 - chat_id (integer, FK -> chats.id) - с подчеркиванием!
-- role (varchar: 'system', 'user', 'assistant')
+- role (varchar: 'system', 'user', 'assistant', 'summary')
 - content (text)
 - length (integer)
 - created_at (timestamp) - с подчеркиванием!
@@ -108,8 +118,145 @@ SELECT COUNT(*) FROM chats WHERE deleted_at IS NULL
 """
 
 
+# Короткий вариант ANALYTICS_SYSTEM_PROMPT (ANALYTICS_COMPACT_PROMPT=true): та же схема
+# и правила без повторов. Отправляется дважды на вопрос (генерация SQL и ответ по результатам)
+ANALYTICS_COMPACT_SYSTEM_PROMPT = """Ты — Daily Reporter, AI-ассистент сотрудников systtech. Специализация — ежедневная отчетность и анализ рабочих задач, но отвечать можно на любые вопросы.
+
+База PostgreSQL (имена колонок в snake_case, пиши их точно как здесь):
+- users(id, telegram_user_id, first_name, created_at, deleted_at)
+- chats(id, telegram_chat_id, created_at, deleted_at)
+- messages(id, user_id -> users.id, chat_id -> chats.id, role ('system', 'user', 'assistant', 'summary'), content, length, created_at, deleted_at)
+
+Если для ответа нужны данные из БД, ответь только SQL в блоке кода, без текста:
+```sql
+SELECT COUNT(*) FROM users WHERE deleted_at IS NULL
+```
+Только SELECT, всегда с условием deleted_at IS NULL. Система выполнит запрос и пришлет результаты — тогда ответь понятным текстом на русском.
+Если данные не нужны (например, "Привет"), отвечай сразу.
+"""
+
+
+SUMMARY_SYSTEM_PROMPT = """Ты сжимаешь историю диалога пользователя с ассистентом.
+
+Составь краткое содержание переданной части диалога:
+- Сохрани факты о пользователе, его задачи, договоренности, имена, даты и числа
+- Сохрани незавершенные вопросы и то, о чем пользователь просил помнить
+- Если передано предыдущее краткое содержание, объедини его с новыми сообщениями
+- Пиши простым текстом без markdown, на языке диалога
+- Не более 200 слов
+"""
+
+# Заголовок сохраненного краткого содержания (модель видит его как system-сообщение)
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+
+class PromptName(StrEnum):
+    """Системные промпты в реестре"""
+
+    CHAT = "chat"  # Диалог в Telegram-боте
+    ANALYTICS = "analytics"  # Аналитический чат /api/v1/chat
+    ANALYTICS_COMPACT = "analytics_compact"  # Короткий вариант analytics
+    SUMMARY = "summary"  # Сжатие истории диалога
+
+
+@dataclass(frozen=True)
+class Prompt:
+    """Версионированный системный промпт.
+
+    Текст одинаков для всех пользователей, поэтому запросы начинаются с
+    одного и того же префикса и попадают в кэш промптов провайдера.
+    Персональные данные передаются отдельным сообщением после промпта.
+    При изменении текста нужно добавить новую версию, не меняя старые:
+    диалоги хранят в БД только имя и версию промпта.
+
+    Attributes:
+        name: Имя промпта
+        version: Версия текста
+        content: Текст промпта
+        content_tokens: Токены текста промпта (считаются один раз)
+        tokens: Стоимость промпта в контексте с учетом служебных токенов
+        message: Готовое system-сообщение (не изменять)
+    """
+
+    name: PromptName
+    version: int
+    content: str
+    content_tokens: int = field(init=False)
+    tokens: int = field(init=False)
+    message: Message = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "content_tokens", count_tokens(self.content))
+        object.__setattr__(self, "tokens", message_tokens(self.content_tokens))
+        object.__setattr__(self, "message", {"role": MessageRole.SYSTEM, "content": self.content})
+
+    @property
+    def id(self) -> str:
+        """Идентификатор для логов: name@vN"""
+        return f"{self.name.value}@v{self.version}"
+
+
+# Все версии промптов: (имя, версия) -> промпт. Старые версии нужны диалогам,
+# начатым до их замены
+_PROMPTS: dict[tuple[str, int], Prompt] = {
+    (prompt.name.value, prompt.version): prompt
+    for prompt in (
+        Prompt(PromptName.CHAT, 2, DEFAULT_SYSTEM_PROMPT),
+        Prompt(PromptName.ANALYTICS, 1, ANALYTICS_SYSTEM_PROMPT),
+        Prompt(PromptName.ANALYTICS_COMPACT, 1, ANALYTICS_COMPACT_SYSTEM_PROMPT),
+        Prompt(PromptName.SUMMARY, 1, SUMMARY_SYSTEM_PROMPT),
+    )
+}
+
+# Актуальная (максимальная) версия каждого промпта
+_LATEST: dict[str, Prompt] = {
+    prompt.name.value: prompt
+    for prompt in sorted(_PROMPTS.values(), key=lambda prompt: prompt.version)
+}
+
+
+def get_prompt(name: PromptName | str, version: int | None = None) -> Prompt:
+    """
+    Получить системный промпт из реестра
+
+    Args:
+        name: Имя промпта
+        version: Версия (None - актуальная). Если версии нет в реестре
+            (например, ее удалили), возвращается актуальная
+
+    Raises:
+        ValueError: Неизвестное имя промпта
+    """
+    name = PromptName(name)
+    if version is not None:
+        prompt = _PROMPTS.get((name.value, version))
+        if prompt is not None:
+            return prompt
+        logger.warning(f"Prompt {name.value}@v{version} not found, using latest version")
+    return _LATEST[name.value]
+
+
+def get_user_prompt(user_name: str | None) -> Message | None:
+    """
+    Получить сообщение с данными пользователя для персонализации
+
+    Передается после системного промпта, чтобы сам промпт (префикс
+    запроса) был одинаковым для всех пользователей.
+
+    Returns:
+        System-сообщение с именем пользователя или None, если имя неизвестно
+    """
+    if not user_name:
+        return None
+    return {"role": MessageRole.SYSTEM, "content": f"Имя пользователя: {user_name}"}
+
+
 def get_system_prompt(user_name: str | None = None) -> str:
-    """Получить системный промпт с персонализацией"""
+    """Получить системный промпт с персонализацией (одной строкой).
+
+    Бот передает имя отдельным сообщением (get_user_prompt), чтобы
+    не менять префикс запроса.
+    """
     if user_name:
         return DEFAULT_SYSTEM_PROMPT + f"\n\nИмя пользователя: {user_name}"
     return DEFAULT_SYSTEM_PROMPT
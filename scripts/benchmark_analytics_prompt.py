@@ -0,0 +1,175 @@
+"""Бенчмарк вариантов system prompt аналитического чата: токены и корректность SQL
+
+Для каждого вопроса из фиксированного набора модель генерирует SQL с полным
+и коротким промптом (ANALYTICS_COMPACT_PROMPT). SQL считается верным, если
+его результат совпадает с результатом эталонного запроса на той же БД.
+
+Нужны .env с доступом к LLM и БД с данными (scripts/create_test_data.py):
+    python scripts/benchmark_analytics_prompt.py
+"""
+
+import asyncio
+import logging
+import sys
+from dataclasses import dataclass, field, replace
+from decimal import Decimal
+from pathlib import Path
+from typing import Any
+
+# Добавляем родительскую директорию в path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config, load_config
+from constants import LLMPriority
+from message_types import LLMUsage
+from services.analytics import (
+    build_analytics_request,
+    execute_sql_query,
+    extract_sql_from_response,
+    get_analytics_prompt,
+)
+from services.database import close_db, init_db
+from services.llm import close_llm_clients, get_llm_response
+from services.tokens import count_tokens, message_tokens
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Вопрос -> эталонный SQL. Ответ модели может содержать дополнительные колонки,
+# но значения эталона должны присутствовать в каждой строке
+QUESTIONS: list[tuple[str, str]] = [
+    ("Сколько пользователей?", "SELECT COUNT(*) FROM users WHERE deleted_at IS NULL"),
+    ("Сколько чатов?", "SELECT COUNT(*) FROM chats WHERE deleted_at IS NULL"),
+    ("Сколько всего сообщений?", "SELECT COUNT(*) FROM messages WHERE deleted_at IS NULL"),
+    (
+        "Какая средняя длина сообщений?",
+        "SELECT AVG(length) FROM messages WHERE deleted_at IS NULL",
+    ),
+    (
+        "Сколько сообщений написали пользователи (без ответов бота)?",
+        "SELECT COUNT(*) FROM messages WHERE role = 'user' AND deleted_at IS NULL",
+    ),
+    ("Покажи имена всех пользователей", "SELECT first_name FROM users WHERE deleted_at IS NULL"),
+    (
+        "Сколько сообщений было за последние 7 дней?",
+        "SELECT COUNT(*) FROM messages "
+        "WHERE created_at >= NOW() - INTERVAL '7 days' AND deleted_at IS NULL",
+    ),
+    (
+        "Какая максимальная длина сообщения ассистента?",
+        "SELECT MAX(length) FROM messages WHERE role = 'assistant' AND deleted_at IS NULL",
+    ),
+    (
+        "Кто из пользователей написал больше всего сообщений?",
+        "SELECT u.first_name FROM users u JOIN messages m ON m.user_id = u.id "
+        "WHERE m.role = 'user' AND u.deleted_at IS NULL AND m.deleted_at IS NULL "
+        "GROUP BY u.id, u.first_name ORDER BY COUNT(*) DESC LIMIT 1",
+    ),
+    (
+        "Сколько пользователей зарегистрировалось за последние 30 дней?",
+        "SELECT COUNT(*) FROM users "
+        "WHERE created_at >= NOW() - INTERVAL '30 days' AND deleted_at IS NULL",
+    ),
+]
+
+
+@dataclass
+class VariantResult:
+    """Итоги варианта промпта"""
+
+    prompt_id: str
+    correct: int = 0
+    estimated_tokens: list[int] = field(default_factory=list)
+    prompt_tokens: list[int] = field(default_factory=list)
+
+
+def _normalize(value: Any) -> str:
+    """Значение ячейки для сравнения (числа округляются до 2 знаков)"""
+    if isinstance(value, int | float | Decimal) and not isinstance(value, bool):
+        return f"{float(value):.2f}"
+    return str(value)
+
+
+def results_match(reference: list[dict[str, Any]], candidate: list[dict[str, Any]]) -> bool:
+    """Совпадают ли результаты: столько же строк, значения эталона есть в строке ответа"""
+    if len(reference) != len(candidate):
+        return False
+    remaining = [[_normalize(value) for value in row.values()] for row in candidate]
+    for row in reference:
+        want = [_normalize(value) for value in row.values()]
+        match = next((got for got in remaining if all(value in got for value in want)), None)
+        if match is None:
+            return False
+        remaining.remove(match)
+    return True
+
+
+async def run_variant(config: Config) -> VariantResult:
+    """Прогнать все вопросы с промптом, выбранным в config"""
+    result = VariantResult(get_analytics_prompt(config).id)
+    for question, reference_sql in QUESTIONS:
+        messages = build_analytics_request(question, [], config)
+        result.estimated_tokens.append(
+            sum(message_tokens(count_tokens(msg["content"])) for msg in messages)
+        )
+
+        usage: list[LLMUsage] = []
+        response = await get_llm_response(
+            messages, config, priority=LLMPriority.API, on_usage=usage.append
+        )
+        prompt_tokens = usage[-1]["prompt_tokens"] if usage else None
+        if prompt_tokens is not None:
+            result.prompt_tokens.append(prompt_tokens)
+
+        sql = extract_sql_from_response(response)
+        ok = False
+        if sql:
+            try:
+                ok = results_match(
+                    await execute_sql_query(reference_sql), await execute_sql_query(sql)
+                )
+            except Exception as e:
+                logger.warning(f"{result.prompt_id}: SQL failed for {question!r}: {e}")
+        if ok:
+            result.correct += 1
+        print(f"  [{'ok' if ok else 'FAIL'}] {result.prompt_id}: {question} -> {sql!r}")
+    return result
+
+
+async def main() -> None:
+    """Сравнить полный и короткий промпт"""
+    # Кэш ответов отключен, temperature 0 - для воспроизводимости
+    config = replace(load_config(), llm_cache_enabled=False, temperature=0.0)
+    await init_db()
+    try:
+        results = [
+            await run_variant(replace(config, analytics_compact_prompt=compact))
+            for compact in (False, True)
+        ]
+    finally:
+        await close_llm_clients()
+        await close_db()
+
+    print(f"\n{'prompt':<24}{'correct':>10}{'est. tokens':>13}{'provider tokens':>17}")
+    for result in results:
+        estimated = sum(result.estimated_tokens) / len(QUESTIONS)
+        provider = (
+            f"{sum(result.prompt_tokens) / len(result.prompt_tokens):.0f}"
+            if result.prompt_tokens
+            else "n/a"
+        )
+        print(
+            f"{result.prompt_id:<24}{f'{result.correct}/{len(QUESTIONS)}':>10}"
+            f"{estimated:>13.0f}{provider:>17}"
+        )
+
+
+if __name__ == "__main__":
+    # Fix for Windows
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    asyncio.run(main())
@@ -11,6 +11,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from config import load_config
 from services.database import close_db, get_pool, init_db
+from services.tokens import count_tokens
 
 logging.basicConfig(
     level=logging.INFO,
@@ -101,13 +102,15 @@ async def create_test_data() -> None:
                     # Генерируем контент разной длины
                     content = f"Test message {message_count}: " + "Lorem ipsum " * (msg % 10 + 1)
                     length = len(content)
+                    tokens = count_tokens(content)
 
                     await cur.execute(
                         """
-                        INSERT INTO messages (user_id, chat_id, role, content, length, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s)
+                        INSERT INTO messages
+                            (user_id, chat_id, role, content, length, tokens, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
                         """,
-                        (user_id, chat_id, role, content, length, current_date)
+                        (user_id, chat_id, role, content, length, tokens, current_date)
                     )
                     message_count += 1
 
@@ -0,0 +1,96 @@
+"""Аудит бюджета промптов: токены каждого system prompt и собранных запросов к LLM
+
+Запуск (без БД и LLM, оценка токенов - services.tokens.count_tokens):
+    python scripts/prompt_budget.py
+    python scripts/prompt_budget.py --question "Сколько сообщений за неделю?"
+"""
+
+import argparse
+import sys
+from dataclasses import replace
+from pathlib import Path
+
+# Добавляем родительскую директорию в path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config
+from constants import MessageRole
+from message_types import Message
+from roles.prompts import PromptName, get_prompt, get_user_prompt
+from services.analytics import (
+    build_analytics_request,
+    build_follow_up_message,
+    format_sql_results,
+    get_analytics_prompt,
+)
+from services.tokens import count_tokens, message_tokens
+
+DEFAULT_QUESTION = "Сколько пользователей?"
+
+# Типичный ответ модели и результат SQL для оценки второго запроса аналитики
+SAMPLE_SQL_ANSWER = "```sql\nSELECT COUNT(*) FROM users WHERE deleted_at IS NULL\n```"
+SAMPLE_SQL_RESULTS = [{"count": 42}]
+
+
+def request_tokens(messages: list[Message]) -> int:
+    """Токены запроса: сумма стоимости сообщений (как при усечении контекста)"""
+    return sum(message_tokens(count_tokens(msg["content"])) for msg in messages)
+
+
+def analytics_requests(question: str, config: Config) -> tuple[list[Message], list[Message]]:
+    """Два запроса аналитического вопроса: генерация SQL и ответ по результатам"""
+    sql_request = build_analytics_request(question, [], config)
+    follow_up = sql_request + [
+        {"role": MessageRole.ASSISTANT, "content": SAMPLE_SQL_ANSWER},
+        {
+            "role": MessageRole.USER,
+            "content": build_follow_up_message(format_sql_results(SAMPLE_SQL_RESULTS)),
+        },
+    ]
+    return sql_request, follow_up
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--question", default=DEFAULT_QUESTION, help="Вопрос пользователя")
+    args = parser.parse_args()
+
+    # Конфигурация по умолчанию: секреты для оценки не нужны
+    config = Config(telegram_token="", openai_api_key="", database_url="")
+
+    print("System prompts:")
+    print(f"  {'prompt':<24}{'chars':>8}{'tokens':>8}")
+    for name in PromptName:
+        prompt = get_prompt(name)
+        print(f"  {prompt.id:<24}{len(prompt.content):>8}{prompt.tokens:>8}")
+
+    print(f"\nRequests for question {args.question!r}:")
+    print(f"  {'request':<36}{'messages':>9}{'tokens':>8}")
+
+    chat_prompt = get_prompt(PromptName.CHAT)
+    chat_request: list[Message] = [chat_prompt.message]
+    profile = get_user_prompt("Иван")
+    if profile:
+        chat_request.append(profile)
+    chat_request.append({"role": MessageRole.USER, "content": args.question})
+    print(f"  {'chat (first turn)':<36}{len(chat_request):>9}{request_tokens(chat_request):>8}")
+
+    totals: dict[str, int] = {}
+    for compact in (False, True):
+        variant = replace(config, analytics_compact_prompt=compact)
+        prompt_id = get_analytics_prompt(variant).id
+        sql_request, follow_up = analytics_requests(args.question, variant)
+        sql_tokens = request_tokens(sql_request)
+        follow_up_tokens = request_tokens(follow_up)
+        totals[prompt_id] = sql_tokens + follow_up_tokens
+        print(f"  {prompt_id + ' sql':<36}{len(sql_request):>9}{sql_tokens:>8}")
+        print(f"  {prompt_id + ' follow-up':<36}{len(follow_up):>9}{follow_up_tokens:>8}")
+        print(f"  {prompt_id + ' total per question':<36}{'':>9}{totals[prompt_id]:>8}")
+
+    full, compact_total = totals.values()
+    saved = full - compact_total
+    print(f"\nCompact analytics prompt saves {saved} tokens per question ({saved / full:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,17 @@
 
 import logging
 import re
+from collections.abc import Callable
 from typing import Any
 
 from config import Config
-from constants import MessageRole
-from message_types import Message
-from roles.prompts import ANALYTICS_SYSTEM_PROMPT
+from constants import LLMPriority, MessageRole
+from message_types import LLMUsage, Message
+from roles.prompts import Prompt, PromptName, get_prompt
+from services.context import trim_context
 from services.database import get_pool
 from services.llm import get_llm_response
+from services.tokens import get_context_budget
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +20,9 @@ logger = logging.getLogger(__name__)
 async def process_analytics_query(
     user_message: str,
     conversation_history: list[Message],
-    config: Config
+    config: Config,
+    user_id: int | None = None,
+    on_usage: Callable[[LLMUsage], None] | None = None,
 ) -> tuple[str, str | None]:
     """
     Обработать аналитический запрос пользователя
@@ -33,32 +38,21 @@ async def process_analytics_query(
         user_message: Сообщение пользователя
         conversation_history: История диалога
         config: Конфигурация приложения
+        user_id: ID пользователя для честной очереди запросов к LLM (опционально)
+        on_usage: Получатель замеров каждого запроса к LLM (модель, задержка, токены)
 
     Returns:
         Tuple (ответ LLM, выполненный SQL или None)
     """
-    # Добавляем system prompt для аналитики если его нет
-    messages = conversation_history.copy()
-    if not messages or messages[0]["role"] != MessageRole.SYSTEM:
-        messages.insert(0, {"role": MessageRole.SYSTEM, "content": ANALYTICS_SYSTEM_PROMPT})
-    else:
-        # Заменяем system prompt на аналитический
-        messages[0] = {"role": MessageRole.SYSTEM, "content": ANALYTICS_SYSTEM_PROMPT}
-
-    # Обрезаем контекст до MAX_CONTEXT_MESSAGES (оставляем system + последние N сообщений)
-    if len(messages) > config.max_context_messages:
-        # Сохраняем system prompt и последние (MAX_CONTEXT_MESSAGES - 1) сообщений
-        system_prompt = messages[0]
-        recent_messages = messages[-(config.max_context_messages - 1):]
-        messages = [system_prompt] + recent_messages
+    messages = build_analytics_request(user_message, conversation_history, config)
+    if len(messages) < len(conversation_history) + 1:
         logger.info(f"Context truncated to {len(messages)} messages (was {len(conversation_history)})")
 
-    # Добавляем сообщение пользователя
-    messages.append({"role": MessageRole.USER, "content": user_message})
-
     # Первый запрос к LLM - генерация SQL (если нужно)
     logger.info("Отправка запроса в LLM для генерации SQL...")
-    llm_response = await get_llm_response(messages, config)
+    llm_response = await get_llm_response(
+        messages, config, user_id=user_id, priority=LLMPriority.API, on_usage=on_usage
+    )
 
     # Пытаемся извлечь SQL из ответа
     sql = extract_sql_from_response(llm_response)
@@ -78,15 +72,13 @@ async def process_analytics_query(
             messages.append({"role": MessageRole.ASSISTANT, "content": llm_response})
 
             # Отправляем результаты SQL обратно в LLM для формирования финального ответа
-            follow_up_message = (
-                f"Результаты запроса к базе данных:\n\n{results_text}\n\n"
-                f"ВАЖНО: Сформируй понятный текстовый ответ пользователю на основе этих данных. "
-                f"НЕ ВЫВОДИ SQL КОД! Только естественный текст на русском языке."
-            )
+            follow_up_message = build_follow_up_message(results_text)
             messages.append({"role": MessageRole.USER, "content": follow_up_message})
 
             logger.info("Отправка результатов SQL в LLM для формирования финального ответа...")
-            final_response = await get_llm_response(messages, config)
+            final_response = await get_llm_response(
+                messages, config, user_id=user_id, priority=LLMPriority.API, on_usage=on_usage
+            )
 
             # Удаляем SQL блоки из финального ответа если они есть
             # (иногда бесплатные модели всё равно их возвращают)
@@ -107,6 +99,57 @@ async def process_analytics_query(
         return llm_response, None
 
 
+def get_analytics_prompt(config: Config) -> Prompt:
+    """System prompt аналитического чата (короткий вариант - ANALYTICS_COMPACT_PROMPT)"""
+    if config.analytics_compact_prompt:
+        return get_prompt(PromptName.ANALYTICS_COMPACT)
+    return get_prompt(PromptName.ANALYTICS)
+
+
+def build_analytics_request(
+    user_message: str, conversation_history: list[Message], config: Config
+) -> list[Message]:
+    """
+    Собрать первый запрос к LLM (генерация SQL): system prompt, история и вопрос
+
+    Args:
+        user_message: Сообщение пользователя
+        conversation_history: История диалога
+        config: Конфигурация приложения
+
+    Returns:
+        Сообщения запроса, усеченные до MAX_CONTEXT_MESSAGES и бюджета токенов модели
+    """
+    # Добавляем system prompt для аналитики если его нет
+    # (готовое сообщение из реестра: одинаковый префикс для кэша промптов провайдера)
+    prompt = get_analytics_prompt(config).message
+    messages = conversation_history.copy()
+    if not messages or messages[0]["role"] != MessageRole.SYSTEM:
+        messages.insert(0, prompt)
+    else:
+        # Заменяем system prompt на аналитический
+        messages[0] = prompt
+
+    # Добавляем сообщение пользователя
+    messages.append({"role": MessageRole.USER, "content": user_message})
+
+    # Обрезаем контекст (system prompt и сообщение пользователя сохраняются всегда)
+    return trim_context(
+        messages,
+        max_messages=config.max_context_messages,
+        token_budget=get_context_budget(config),
+    )
+
+
+def build_follow_up_message(results_text: str) -> str:
+    """Сообщение с результатами SQL для второго запроса к LLM (формирование ответа)"""
+    return (
+        f"Результаты запроса к базе данных:\n\n{results_text}\n\n"
+        f"ВАЖНО: Сформируй понятный текстовый ответ пользователю на основе этих данных. "
+        f"НЕ ВЫВОДИ SQL КОД! Только естественный текст на русском языке."
+    )
+
+
 def extract_sql_from_response(text: str) -> str | None:
     """
     Извлечь SQL запрос из ответа LLM
@@ -0,0 +1,109 @@
+"""In-process кэши с ограничением размера и времени жизни"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """LRU кэш с TTL и счетчиками попаданий.
+
+    Хранит не более max_size записей; при переполнении вытесняет
+    давно не использовавшиеся. Записи старше ttl секунд считаются
+    промахом и удаляются при обращении.
+
+    Attributes:
+        hits: Количество попаданий
+        misses: Количество промахов
+        evictions: Количество вытесненных (по размеру или TTL) записей
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def get(self, key: K) -> V | None:
+        """Получить значение по ключу (None при промахе)"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        stored_at, value = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        """Сохранить значение, вытеснив самые старые записи при переполнении"""
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: K) -> None:
+        """Удалить запись (если есть)"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Очистить кэш и сбросить счетчики"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики кэша для логов и метрик"""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight(Generic[K, V]):
+    """Объединение конкурентных вызовов с одинаковым ключом.
+
+    Пока выполняется вызов для ключа, остальные вызывающие ждут его
+    результат (или исключение) вместо повторного запуска.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: dict[K, asyncio.Future[V]] = {}
+
+    def __contains__(self, key: object) -> bool:
+        """Идет ли сейчас вызов для ключа"""
+        return key in self._inflight
+
+    async def do(self, key: K, fn: Callable[[], Awaitable[V]]) -> V:
+        """Выполнить fn для ключа или присоединиться к уже идущему вызову"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(task)
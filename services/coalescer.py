@@ -0,0 +1,68 @@
+"""Объединение подряд идущих сообщений пользователя в один ход диалога"""
+
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class MessageCoalescer(Generic[T]):
+    """Очередь сообщений для каждого диалога (user, chat).
+
+    Пока для диалога идет обработка (запрос к LLM), новые сообщения
+    не запускают отдельную обработку, а копятся в буфере. Когда текущая
+    обработка завершится, накопленные сообщения передаются одной пачкой.
+    Обработки одного диалога никогда не выполняются параллельно.
+    """
+
+    def __init__(self) -> None:
+        self._pending: dict[Hashable, list[T]] = {}
+        self._busy: set[Hashable] = set()
+
+    def is_busy(self, key: Hashable) -> bool:
+        """Идет ли сейчас обработка для диалога"""
+        return key in self._busy
+
+    async def submit(
+        self, key: Hashable, item: T, process: Callable[[list[T]], Awaitable[None]]
+    ) -> None:
+        """
+        Добавить сообщение в очередь диалога
+
+        Если обработка уже идет, сообщение будет обработано ею позже
+        (вместе с другими накопленными), и вызов сразу возвращается.
+
+        Args:
+            key: Ключ диалога
+            item: Сообщение
+            process: Обработчик пачки сообщений
+        """
+        self._pending.setdefault(key, []).append(item)
+        if key in self._busy:
+            logger.info(f"Conversation {key} is busy, message buffered")
+            return
+
+        self._busy.add(key)
+        try:
+            while self._pending.get(key):
+                batch = self._pending.pop(key)
+                if len(batch) > 1:
+                    logger.info(f"Coalesced {len(batch)} messages for conversation {key}")
+                try:
+                    await process(batch)
+                except Exception as e:
+                    # Ошибка одной пачки не отменяет сообщения, накопленные за время ее обработки
+                    logger.error(f"Failed to process messages for conversation {key}: {e}")
+        finally:
+            self._busy.discard(key)
+            # При отмене накопленные сообщения остаются и обрабатываются со следующим
+            if not self._pending.get(key):
+                self._pending.pop(key, None)
+
+
+def merge_user_messages(texts: list[str | None]) -> str:
+    """Объединить тексты нескольких сообщений пользователя в одно"""
+    return "\n".join(text for text in texts if text)
@@ -1,45 +1,173 @@
 """Управление контекстом диалогов через PostgreSQL"""
 
 import logging
+from dataclasses import dataclass
+from typing import Any
 
-from constants import MessageRole
+from constants import CONTEXT_CACHE_SIZE, CONTEXT_CACHE_TTL, PINNED_ROLES, MessageRole
 from message_types import Message
+from roles.prompts import Prompt, get_prompt
+from services.cache import TTLCache
 from services.database import (
-    get_messages,
+    append_messages,
+    clear_conversation,
     get_or_create_chat,
     get_or_create_user,
-    save_message,
-    soft_delete_messages,
+    load_conversation,
+    session,
+    set_conversation_prompt,
 )
+from services.metrics import CACHES
+from services.tokens import count_tokens, message_tokens
 
 logger = logging.getLogger(__name__)
 
 
-async def get_context(user_id: int, chat_id: int) -> dict:
+@dataclass
+class _CachedConversation:
+    """Последние сообщения диалога и номер последнего сообщения эпохи (last_seq)"""
+
+    rows: list[dict[str, Any]]
+    seq: int
+
+
+# Кэш последних сообщений диалога: (telegram user, telegram chat) -> строки из БД
+# Поддерживается write-through в append_turn и clear_context.
+# Кэш свой у каждого процесса, межпроцессной инвалидации нет: после записи или
+# очистки диалога другим процессом (бот и API) запись кэша устаревает до
+# CONTEXT_CACHE_TTL или до своей записи с разрывом seq (тогда она сбрасывается)
+_context_cache: TTLCache[tuple[int, int], _CachedConversation] = TTLCache(
+    max_size=CONTEXT_CACHE_SIZE, ttl=CONTEXT_CACHE_TTL
+)
+CACHES.register("context", _context_cache)
+
+
+def _clear_context_cache() -> None:
+    """Очистить кэш контекста (для тестов)."""
+    _context_cache.clear()
+
+
+def get_context_cache_stats() -> dict[str, int]:
+    """Получить счетчики кэша контекста (size/hits/misses/evictions)"""
+    return _context_cache.stats()
+
+
+def invalidate_context(user_id: int, chat_id: int) -> None:
+    """Сбросить кэш диалога (следующий get_context загрузит его из БД)"""
+    _context_cache.delete((user_id, chat_id))
+
+
+async def get_context(user_id: int, chat_id: int, default_prompt: Prompt | None = None) -> dict:
     """
     Получить контекст пользователя из БД
 
     Args:
         user_id: ID пользователя в Telegram
         chat_id: ID чата в Telegram
+        default_prompt: System prompt для начатого диалога без промпта (диалог
+            очистили, пока готовился ответ, и ход записан уже в новую эпоху)
 
     Returns:
-        Словарь с контекстом {"messages": [...]}
+        Словарь с контекстом {"messages": [...], "tokens": [...], "seq": ...},
+        где tokens - стоимость каждого сообщения в токенах (см. trim_context),
+        seq - номер последнего сообщения диалога (first_seq хода - seq + 1)
     """
-    # Получить внутренние ID
-    db_user_id = await get_or_create_user(user_id, "Unknown")
-    db_chat_id = await get_or_create_chat(chat_id)
+    cached = _context_cache.get((user_id, chat_id))
+
+    if cached is None:
+        # Пользователь, чат и сообщения загружаются одним запросом
+        conversation = await load_conversation(user_id, chat_id, limit=100)
+        db_messages = conversation["messages"]
+        prompt_ref = conversation.get("prompt")
+        if prompt_ref is not None:
+            db_messages = [_prompt_row(get_prompt(*prompt_ref)), *db_messages]
+        cached = _CachedConversation(db_messages, conversation.get("seq", 0))
+        _context_cache.set((user_id, chat_id), cached)
+        source = "db"
+    else:
+        source = "cache"
+
+    rows = cached.rows
+    if default_prompt is not None and rows and not _has_prompt(rows):
+        rows = [_prompt_row(default_prompt), *rows]
+
+    # Преобразовать в формат OpenAI; количество токенов берется из БД, а не считается заново.
+    # Краткое содержание старой части диалога идет сразу после system prompt
+    messages: list[Message] = []
+    tokens: list[int] = []
+    for msg in _system_first(rows):
+        role = MessageRole.SYSTEM if msg["role"] == MessageRole.SUMMARY else msg["role"]
+        messages.append({"role": role, "content": msg["content"]})
+        content_tokens = msg.get("tokens")
+        if content_tokens is None:
+            content_tokens = count_tokens(msg["content"])
+        tokens.append(message_tokens(content_tokens))
 
-    # Получить сообщения из БД
-    db_messages = await get_messages(db_user_id, db_chat_id, limit=100)
+    logger.info(
+        f"Context loaded for user {user_id} in chat {chat_id} from {source}: "
+        f"{len(messages)} messages, {sum(tokens)} tokens"
+    )
+    return {"messages": messages, "tokens": tokens, "seq": cached.seq}
 
-    # Преобразовать в формат OpenAI
-    messages: list[Message] = []
-    for msg in db_messages:
-        messages.append({"role": msg["role"], "content": msg["content"]})
 
-    logger.info(f"Context loaded for user {user_id} in chat {chat_id}: {len(messages)} messages")
-    return {"messages": messages}
+async def append_turn(
+    user_id: int,
+    chat_id: int,
+    turn: list[Message],
+    user_name: str | None = None,
+    max_context_messages: int = 15,
+    prompt: Prompt | None = None,
+    first_seq: int | None = None,
+) -> None:
+    """
+    Сохранить новые сообщения хода диалога (user + assistant) одним запросом
+
+    Старые сообщения сверх лимита помечаются удаленными тем же запросом.
+    System-сообщения не участвуют в усечении. Ход нумеруется с first_seq
+    (seq из get_context плюс один): повторная запись того же хода ничего
+    не меняет, а параллельный ход из другого процесса получает следующие
+    свободные номера и не теряется (см. append_messages).
+
+    Args:
+        user_id: ID пользователя в Telegram
+        chat_id: ID чата в Telegram
+        turn: Новые сообщения хода в формате OpenAI
+        user_name: Имя пользователя (опционально)
+        max_context_messages: Максимальное количество не-system сообщений для хранения
+        prompt: System prompt нового диалога (в БД сохраняются только имя и версия)
+        first_seq: Номер первого сообщения в диалоге (None - следующий свободный)
+    """
+    if not turn:
+        return
+
+    async with session():
+        # Получить или создать пользователя и чат (обычно из кэша, без обращения к БД)
+        db_user_id = await get_or_create_user(user_id, user_name)
+        db_chat_id = await get_or_create_chat(chat_id)
+
+        if prompt is not None:
+            await set_conversation_prompt(db_user_id, db_chat_id, prompt.name.value, prompt.version)
+        inserted = await append_messages(
+            db_user_id, db_chat_id, turn, keep_last=max_context_messages, first_seq=first_seq
+        )
+
+    # Write-through: дописываем в кэш только если диалог в нем уже есть,
+    # иначе следующий get_context загрузит актуальное состояние из БД
+    # Разрыв в номерах значит, что в диалог писал другой процесс: кэш устарел
+    cached = _context_cache.get((user_id, chat_id))
+    if cached is not None and inserted:
+        if inserted[0]["seq"] != cached.seq + 1:
+            _context_cache.delete((user_id, chat_id))
+        else:
+            rows = [_prompt_row(prompt), *cached.rows] if prompt is not None else cached.rows
+            _context_cache.set(
+                (user_id, chat_id),
+                _CachedConversation(
+                    _keep_recent(rows + inserted, max_context_messages), inserted[-1]["seq"]
+                ),
+            )
+
+    logger.info(f"Context saved for user {user_id} in chat {chat_id}: {len(inserted)} new messages")
 
 
 async def save_context(
@@ -48,97 +176,112 @@ async def save_context(
     messages: list[Message],
     user_name: str | None = None,
     max_context_messages: int = 15,
+    *,
+    context: dict,
 ) -> None:
     """
     Сохранить контекст пользователя в БД с автоматической очисткой старых сообщений
 
+    messages - сообщения context (результата get_context) с новыми сообщениями
+    в конце. Сохраняются только новые, с номерами от context["seq"] + 1,
+    поэтому повторное сохранение того же списка ничего не меняет.
+    Для сохранения одного хода используйте append_turn.
+
     Args:
         user_id: ID пользователя в Telegram
         chat_id: ID чата в Telegram
-        messages: Список сообщений в формате OpenAI
+        messages: Сообщения диалога в формате OpenAI
         user_name: Имя пользователя (опционально)
-        max_context_messages: Максимальное количество сообщений для хранения
+        max_context_messages: Максимальное количество не-system сообщений для хранения
+        context: Контекст, на котором построен messages (из get_context)
     """
-    # Получить или создать пользователя и чат
-    db_user_id = await get_or_create_user(user_id, user_name or "Unknown")
-    db_chat_id = await get_or_create_chat(chat_id)
-
-    # Получить существующие сообщения
-    existing_messages = await get_messages(db_user_id, db_chat_id, limit=200)
-    existing_count = len(existing_messages)
-
-    # Сохранить только новые сообщения (те, что после existing_count)
-    new_messages = messages[existing_count:]
-    for msg in new_messages:
-        await save_message(db_user_id, db_chat_id, msg["role"], msg["content"])
-
-    # Проверяем общее количество после добавления
-    total_count = existing_count + len(new_messages)
-
-    # Если превышен лимит - удаляем самые старые сообщения
-    if total_count > max_context_messages:
-        # Обновляем список всех сообщений после добавления
-        all_messages = await get_messages(db_user_id, db_chat_id, limit=200)
-
-        # Количество сообщений для удаления
-        messages_to_delete = len(all_messages) - max_context_messages
-
-        if messages_to_delete > 0:
-            # Удаляем самые старые (первые в списке, т.к. они отсортированы по created_at ASC)
-            from services.database import get_pool
-
-            pool = await get_pool()
-            async with pool.connection() as conn:
-                async with conn.cursor() as cur:
-                    # Получаем ID самых старых сообщений
-                    ids_to_delete = [msg["id"] for msg in all_messages[:messages_to_delete]]
-
-                    # Soft delete
-                    await cur.execute(
-                        """
-                        UPDATE messages
-                        SET deleted_at = NOW()
-                        WHERE id = ANY(%s)
-                        """,
-                        (ids_to_delete,),
-                    )
-                    await conn.commit()
-
-            logger.info(
-                f"Deleted {messages_to_delete} old messages for user {user_id} in chat {chat_id}"
-            )
-
-    logger.info(
-        f"Context saved for user {user_id} in chat {chat_id}: "
-        f"{len(new_messages)} new messages, {min(total_count, max_context_messages)} kept in DB"
+    await append_turn(
+        user_id,
+        chat_id,
+        messages[len(context["messages"]) :],
+        user_name,
+        max_context_messages,
+        first_seq=context["seq"] + 1,
     )
 
 
 async def clear_context(user_id: int, chat_id: int) -> None:
     """
-    Очистить контекст пользователя (soft delete)
+    Очистить контекст пользователя
+
+    Стоимость не зависит от длины истории: диалог переходит в новую эпоху,
+    старые сообщения удаляет фоновая очистка (services/purge.py).
 
     Args:
         user_id: ID пользователя в Telegram
         chat_id: ID чата в Telegram
     """
-    # Получить внутренние ID
-    db_user_id = await get_or_create_user(user_id, "Unknown")
-    db_chat_id = await get_or_create_chat(chat_id)
+    async with session():
+        # Получить внутренние ID
+        db_user_id = await get_or_create_user(user_id)
+        db_chat_id = await get_or_create_chat(chat_id)
 
-    # Soft delete сообщений
-    await soft_delete_messages(db_user_id, db_chat_id)
+        await clear_conversation(db_user_id, db_chat_id)
+    _context_cache.set((user_id, chat_id), _CachedConversation([], 0))
     logger.info(f"Context cleared for user {user_id} in chat {chat_id}")
 
 
-def trim_context(messages: list[Message], max_messages: int = 10) -> list[Message]:
+def _prompt_row(prompt: Prompt) -> dict[str, Any]:
+    """Строка system prompt для кэша контекста (в таблице messages ее нет)"""
+    return {
+        "id": None,
+        "role": MessageRole.SYSTEM,
+        "content": prompt.content,
+        "tokens": prompt.content_tokens,
+    }
+
+
+def _has_prompt(rows: list[dict[str, Any]]) -> bool:
+    """Есть ли в строках диалога system prompt (из реестра или сохраненный в messages)"""
+    return any(row["role"] == MessageRole.SYSTEM for row in rows)
+
+
+def _system_first(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Переставить system prompt и краткое содержание в начало (порядок внутри групп сохраняется)"""
+    system = [row for row in rows if row["role"] == MessageRole.SYSTEM]
+    summary = [row for row in rows if row["role"] == MessageRole.SUMMARY]
+    dialogue = [row for row in rows if row["role"] not in PINNED_ROLES]
+    return system + summary + dialogue
+
+
+def _keep_recent(rows: list[dict[str, Any]], max_messages: int) -> list[dict[str, Any]]:
+    """Оставить system-сообщения и последние max_messages остальных (как при усечении в БД)"""
+    non_system_count = sum(1 for row in rows if row["role"] not in PINNED_ROLES)
+    to_drop = non_system_count - max_messages
+    kept: list[dict[str, Any]] = []
+    for row in rows:
+        if to_drop > 0 and row["role"] not in PINNED_ROLES:
+            to_drop -= 1
+            continue
+        kept.append(row)
+    return kept
+
+
+def trim_context(
+    messages: list[Message],
+    max_messages: int = 10,
+    token_budget: int | None = None,
+    tokens: list[int] | None = None,
+) -> list[Message]:
     """
     Усечь контекст до максимального количества сообщений
-    Всегда сохраняет system prompt (первое сообщение)
+    Всегда сохраняет system prompt (идущие подряд system-сообщения в начале,
+    включая краткое содержание старой части диалога)
+
+    Если задан token_budget, дополнительно оставляет только последние
+    сообщения, суммарно укладывающиеся в бюджет вместе с system prompt.
 
     Args:
         messages: Список сообщений
         max_messages: Максимальное количество сообщений (не считая system)
+        token_budget: Бюджет токенов на весь контекст (опционально)
+        tokens: Стоимость каждого сообщения в токенах (из get_context);
+            если не передано, считается по тексту
 
     Returns:
         Усеченный список сообщений
@@ -146,15 +289,66 @@ def trim_context(messages: list[Message], max_messages: int = 10) -> list[Messag
     if not messages:
         return messages
 
-    # Если сообщений меньше или равно лимиту (+1 для system prompt)
-    if len(messages) <= max_messages + 1:
+    head = _system_head(messages)
+
+    if token_budget is not None:
+        return _trim_to_budget(messages, head, max_messages, token_budget, tokens)
+
+    # Если сообщений меньше или равно лимиту (+ system prompt)
+    if len(messages) <= max_messages + max(head, 1):
         return messages
 
     # Сохраняем system prompt + последние max_messages сообщений
-    system_prompt = messages[0] if messages[0]["role"] == MessageRole.SYSTEM else None
-    recent_messages = messages[-(max_messages):]
+    return messages[:head] + messages[-(max_messages):]
+
+
+def insert_after_system(messages: list[Message], message: Message) -> list[Message]:
+    """
+    Вставить сообщение сразу после system-сообщений в начале контекста
 
-    if system_prompt:
-        return [system_prompt] + recent_messages
+    Например, данные пользователя: общий system prompt остается первым
+    и одинаковым для всех пользователей.
 
-    return recent_messages
+    Returns:
+        Новый список сообщений
+    """
+    head = _system_head(messages)
+    return messages[:head] + [message] + messages[head:]
+
+
+def _system_head(messages: list[Message]) -> int:
+    """Количество идущих подряд system-сообщений в начале контекста"""
+    head = 0
+    while head < len(messages) and messages[head]["role"] == MessageRole.SYSTEM:
+        head += 1
+    return head
+
+
+def _trim_to_budget(
+    messages: list[Message],
+    head: int,
+    max_messages: int,
+    token_budget: int,
+    tokens: list[int] | None,
+) -> list[Message]:
+    """Оставить system prompt и самые новые сообщения, укладывающиеся в бюджет токенов"""
+    if tokens is None:
+        tokens = [message_tokens(count_tokens(msg["content"])) for msg in messages]
+
+    remaining = token_budget - sum(tokens[:head])
+
+    # Идем от новых к старым, складывая сохраненные счетчики
+    start = len(messages)
+    while start > head and len(messages) - start < max_messages:
+        cost = tokens[start - 1]
+        # Последнее (текущее) сообщение оставляем всегда
+        if cost > remaining and start < len(messages):
+            break
+        remaining -= cost
+        start -= 1
+
+    if start > head:
+        logger.info(
+            f"Context trimmed to {len(messages) - start} messages by token budget {token_budget}"
+        )
+    return messages[:head] + messages[start:]
@@ -1,18 +1,50 @@
 """Data Access Layer для работы с PostgreSQL через raw SQL"""
 
 import logging
+from collections.abc import AsyncIterator, Callable, Mapping, Sequence
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
 from typing import Any
 
+from psycopg import AsyncConnection, sql
 from psycopg.rows import dict_row
 from psycopg_pool import AsyncConnectionPool
 
 from config import load_config
+from constants import ID_CACHE_SIZE, ID_CACHE_TTL, MessageRole
+from services.cache import SingleFlight, TTLCache
+from services.metrics import CACHES
+from services.tokens import count_tokens
 
 logger = logging.getLogger(__name__)
 
 # Singleton connection pool
 _pool: AsyncConnectionPool | None = None
 
+# Кэш Telegram ID -> ID в БД (SERIAL id не меняются)
+# Для пользователей дополнительно хранится first_name, чтобы писать только при его изменении
+_user_id_cache: TTLCache[int, tuple[int, str | None]] = TTLCache(
+    max_size=ID_CACHE_SIZE, ttl=ID_CACHE_TTL
+)
+_chat_id_cache: TTLCache[int, int] = TTLCache(max_size=ID_CACHE_SIZE, ttl=ID_CACHE_TTL)
+CACHES.register("user_id", _user_id_cache)
+CACHES.register("chat_id", _chat_id_cache)
+_user_flight: SingleFlight[tuple[int, str | None], int] = SingleFlight()
+_chat_flight: SingleFlight[int, int] = SingleFlight()
+
+# Текущая сессия (unit of work), см. session()
+_current_session: ContextVar["_SessionState | None"] = ContextVar("db_session", default=None)
+
+
+class _SessionState:
+    """Состояние сессии: соединение берется из пула при первом запросе"""
+
+    def __init__(self) -> None:
+        self.conn: AsyncConnection | None = None
+        self.stack = AsyncExitStack()
+        self.hooks: list[Callable[[], None]] = []
+
 
 async def get_pool() -> AsyncConnectionPool:
     """
@@ -50,6 +82,81 @@ async def init_db() -> None:
         raise
 
 
+@asynccontextmanager
+async def session() -> AsyncIterator[None]:
+    """
+    Unit of work: одно соединение из пула и одна транзакция на группу операций
+
+    Все функции этого модуля, вызванные внутри блока, используют общее
+    соединение вместо отдельного checkout из пула. Соединение берется лениво,
+    при первом запросе к БД (если все данные в кэше - пул не трогаем).
+    Вложенные сессии переиспользуют внешнюю. Транзакция фиксируется при
+    выходе из внешнего блока и откатывается при исключении.
+
+    Сессия рассчитана на последовательные вызовы в одной задаче и не должна
+    охватывать долгие операции (например, запрос к LLM): соединение и
+    транзакция удерживаются до выхода из блока.
+
+    Example:
+        async with session():
+            user_id = await get_or_create_user(telegram_user_id)
+            await clear_conversation(user_id, chat_id)
+    """
+    if _current_session.get() is not None:
+        yield
+        return
+
+    state = _SessionState()
+    token = _current_session.set(state)
+    try:
+        async with state.stack:
+            yield
+    finally:
+        _current_session.reset(token)
+
+    # Транзакция зафиксирована - применяем отложенные действия (например, запись в кэш)
+    for hook in state.hooks:
+        hook()
+
+
+@asynccontextmanager
+async def _connection() -> AsyncIterator[AsyncConnection]:
+    """Соединение текущей сессии или отдельное соединение из пула"""
+    state = _current_session.get()
+    if state is None:
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            yield conn
+        return
+
+    if state.conn is None:
+        pool = await get_pool()
+        conn = await state.stack.enter_async_context(pool.connection())
+        await state.stack.enter_async_context(conn.transaction())
+        state.conn = conn
+    yield state.conn
+
+
+def _on_commit(hook: Callable[[], None]) -> None:
+    """Выполнить hook после коммита текущей сессии (или сразу, если сессии нет)"""
+    state = _current_session.get()
+    if state is None:
+        hook()
+    else:
+        state.hooks.append(hook)
+
+
+def _clear_id_cache() -> None:
+    """Очистить кэш соответствия ID (для тестов)."""
+    _user_id_cache.clear()
+    _chat_id_cache.clear()
+
+
+def get_id_cache_stats() -> dict[str, dict[str, int]]:
+    """Получить счетчики кэша соответствия Telegram ID -> ID в БД"""
+    return {"users": _user_id_cache.stats(), "chats": _chat_id_cache.stats()}
+
+
 async def close_db() -> None:
     """Закрыть connection pool"""
     global _pool
@@ -62,34 +169,72 @@ async def close_db() -> None:
 # ===== Users =====
 
 
-async def get_or_create_user(telegram_user_id: int, first_name: str) -> int:
+async def get_or_create_user(telegram_user_id: int, first_name: str | None = None) -> int:
     """
     Получить или создать пользователя
 
+    ID берется из кэша; запись в БД происходит только для нового
+    пользователя или при изменении first_name.
+
     Args:
         telegram_user_id: ID пользователя в Telegram
-        first_name: Имя пользователя
+        first_name: Имя пользователя (None - не менять сохраненное имя)
 
     Returns:
         ID пользователя в БД
     """
+    cached = _user_id_cache.get(telegram_user_id)
+    if cached is not None and (first_name is None or cached[1] == first_name):
+        return cached[0]
+
+    return await _user_flight.do(
+        (telegram_user_id, first_name), lambda: _upsert_user(telegram_user_id, first_name)
+    )
+
+
+async def _upsert_user(telegram_user_id: int, first_name: str | None) -> int:
+    """Найти или создать пользователя в БД, обновив имя только если оно изменилось
+
+    Всегда использует отдельное соединение (не соединение сессии): результат
+    разделяется между конкурентными запросами и кэшируется, поэтому не должен
+    зависеть от отката чужой транзакции.
+    """
     pool = await get_pool()
     async with pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
                 """
-                INSERT INTO users (telegram_user_id, first_name)
-                VALUES (%s, %s)
-                ON CONFLICT (telegram_user_id)
-                DO UPDATE SET first_name = EXCLUDED.first_name
-                RETURNING id
+                WITH existing AS (
+                    SELECT id, first_name FROM users WHERE telegram_user_id = %(tg_id)s
+                ),
+                inserted AS (
+                    INSERT INTO users (telegram_user_id, first_name)
+                    SELECT %(tg_id)s, COALESCE(%(name)s, 'Unknown')
+                    WHERE NOT EXISTS (SELECT 1 FROM existing)
+                    ON CONFLICT (telegram_user_id)
+                    DO UPDATE SET first_name = users.first_name
+                    RETURNING id, first_name
+                ),
+                updated AS (
+                    UPDATE users SET first_name = %(name)s
+                    WHERE telegram_user_id = %(tg_id)s
+                      AND %(name)s::varchar IS NOT NULL
+                      AND first_name IS DISTINCT FROM %(name)s
+                    RETURNING id, first_name
+                )
+                SELECT id, first_name FROM updated
+                UNION ALL
+                SELECT id, first_name FROM inserted
+                UNION ALL
+                SELECT id, first_name FROM existing WHERE NOT EXISTS (SELECT 1 FROM updated)
                 """,
-                (telegram_user_id, first_name),
+                {"tg_id": telegram_user_id, "name": first_name},
             )
             result = await cur.fetchone()
             if result is None:
                 raise RuntimeError(f"Failed to get or create user {telegram_user_id}")
             user_id: int = result["id"]
+            _user_id_cache.set(telegram_user_id, (user_id, result["first_name"]))
             logger.debug(f"User {telegram_user_id} -> DB ID {user_id}")
             return user_id
 
@@ -104,8 +249,7 @@ async def get_user_by_telegram_id(telegram_user_id: int) -> dict[str, Any] | Non
     Returns:
         Словарь с данными пользователя или None
     """
-    pool = await get_pool()
-    async with pool.connection() as conn:
+    async with _connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
                 """
@@ -126,29 +270,50 @@ async def get_or_create_chat(telegram_chat_id: int) -> int:
     """
     Получить или создать чат
 
+    ID берется из кэша; в БД обращаемся только при первом обращении к чату.
+
     Args:
         telegram_chat_id: ID чата в Telegram
 
     Returns:
         ID чата в БД
     """
+    cached = _chat_id_cache.get(telegram_chat_id)
+    if cached is not None:
+        return cached
+
+    return await _chat_flight.do(telegram_chat_id, lambda: _upsert_chat(telegram_chat_id))
+
+
+async def _upsert_chat(telegram_chat_id: int) -> int:
+    """Найти или создать чат в БД (в отдельном соединении, см. _upsert_user)"""
     pool = await get_pool()
     async with pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
                 """
-                INSERT INTO chats (telegram_chat_id)
-                VALUES (%s)
-                ON CONFLICT (telegram_chat_id)
-                DO UPDATE SET telegram_chat_id = EXCLUDED.telegram_chat_id
-                RETURNING id
+                WITH existing AS (
+                    SELECT id FROM chats WHERE telegram_chat_id = %(tg_id)s
+                ),
+                inserted AS (
+                    INSERT INTO chats (telegram_chat_id)
+                    SELECT %(tg_id)s
+                    WHERE NOT EXISTS (SELECT 1 FROM existing)
+                    ON CONFLICT (telegram_chat_id)
+                    DO UPDATE SET telegram_chat_id = EXCLUDED.telegram_chat_id
+                    RETURNING id
+                )
+                SELECT id FROM existing
+                UNION ALL
+                SELECT id FROM inserted
                 """,
-                (telegram_chat_id,),
+                {"tg_id": telegram_chat_id},
             )
             result = await cur.fetchone()
             if result is None:
                 raise RuntimeError(f"Failed to get or create chat {telegram_chat_id}")
             chat_id: int = result["id"]
+            _chat_id_cache.set(telegram_chat_id, chat_id)
             logger.debug(f"Chat {telegram_chat_id} -> DB ID {chat_id}")
             return chat_id
 
@@ -163,8 +328,7 @@ async def get_chat_by_telegram_id(telegram_chat_id: int) -> dict[str, Any] | Non
     Returns:
         Словарь с данными чата или None
     """
-    pool = await get_pool()
-    async with pool.connection() as conn:
+    async with _connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
                 """
@@ -180,6 +344,27 @@ async def get_chat_by_telegram_id(telegram_chat_id: int) -> dict[str, Any] | Non
 
 # ===== Messages =====
 
+# Текущая эпоха диалога (0, пока диалог ни разу не очищался); параметры user_id, chat_id
+_CURRENT_EPOCH = """
+    COALESCE(
+        (SELECT epoch FROM conversations
+         WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s),
+        0
+    )
+"""
+
+# Выделить номера сообщений диалога: следующие %(claim)s номеров после
+# conversations.last_seq. Строка conversations блокируется до конца
+# транзакции, поэтому параллельные записи в диалог (в том числе из разных
+# процессов) получают разные номера. Возвращает epoch и last_seq после выделения
+_CLAIM_SEQ = """
+    INSERT INTO conversations (user_id, chat_id, last_seq)
+    VALUES (%(user_id)s, %(chat_id)s, %(claim)s)
+    ON CONFLICT (user_id, chat_id) DO UPDATE
+    SET last_seq = conversations.last_seq + EXCLUDED.last_seq
+    RETURNING epoch, last_seq
+"""
+
 
 async def save_message(user_id: int, chat_id: int, role: str, content: str) -> int:
     """
@@ -194,18 +379,31 @@ async def save_message(user_id: int, chat_id: int, role: str, content: str) -> i
     Returns:
         ID созданного сообщения
     """
-    pool = await get_pool()
     length = len(content)
+    tokens = count_tokens(content)
 
-    async with pool.connection() as conn:
+    async with _connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
-                """
-                INSERT INTO messages (user_id, chat_id, role, content, length)
-                VALUES (%s, %s, %s, %s, %s)
+                f"""
+                WITH claimed AS ({_CLAIM_SEQ})
+                INSERT INTO messages (
+                    user_id, chat_id, role, content, length, tokens, epoch, seq
+                )
+                SELECT %(user_id)s, %(chat_id)s, %(role)s, %(content)s, %(length)s, %(tokens)s,
+                       c.epoch, c.last_seq
+                FROM claimed c
                 RETURNING id
                 """,
-                (user_id, chat_id, role, content, length),
+                {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "role": role,
+                    "content": content,
+                    "length": length,
+                    "tokens": tokens,
+                    "claim": 1,
+                },
             )
             result = await cur.fetchone()
             if result is None:
@@ -217,9 +415,277 @@ async def save_message(user_id: int, chat_id: int, role: str, content: str) -> i
             return message_id
 
 
+async def append_messages(
+    user_id: int,
+    chat_id: int,
+    messages: Sequence[Mapping[str, Any]],
+    keep_last: int,
+    first_seq: int | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Добавить сообщения хода диалога и усечь историю одним запросом
+
+    Выделение номеров, вставка всех сообщений, их замеров LLM (llm_usage) и
+    soft delete старых выполняются одним statement (одна транзакция, один
+    round trip, без предварительного чтения). Сообщения пишутся в текущую
+    эпоху диалога, усекается только она. System-сообщения и краткое
+    содержание диалога не участвуют в усечении.
+
+    Сообщения получают номера seq в эпохе диалога: по умолчанию - следующие
+    свободные (параллельные ходы не пересекаются). С first_seq номера задает
+    вызывающий (first_seq, first_seq + 1, ...) - обычно last_seq диалога, на
+    котором построен ход, плюс один:
+
+    - сообщения, уже сохраненные под своими номерами (повтор записи, в том
+      числе уже усеченные), не вставляются повторно;
+    - если все занятые номера хода заняты им самим, остальные сообщения
+      получают свои номера;
+    - иначе (номер занят другим ходом, например из другого процесса)
+      несохраненные сообщения получают следующие свободные номера и не теряются.
+
+    Args:
+        user_id: ID пользователя (внутренний)
+        chat_id: ID чата (внутренний)
+        messages: Сообщения хода в формате {"role": ..., "content": ...};
+            у ответа ассистента может быть "usage" (замеры запроса к LLM)
+        keep_last: Сколько не-system сообщений оставить в диалоге
+        first_seq: Номер первого сообщения (None - следующий свободный)
+
+    Returns:
+        Вставленные сообщения (id, role, content, tokens, seq) в порядке добавления
+    """
+    roles = [MessageRole(msg["role"]).value for msg in messages]
+    contents = [msg["content"] for msg in messages]
+    lengths = [len(content) for content in contents]
+    tokens = [count_tokens(content) for content in contents]
+    usages = [msg.get("usage") or {} for msg in messages]
+
+    async with _connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                f"""
+                WITH turn AS (
+                    SELECT t.role, t.content, t.length, t.tokens, t.ord,
+                           %(first_seq)s::bigint + t.ord - 1 AS planned
+                    FROM unnest(
+                        %(roles)s::varchar[], %(contents)s::text[],
+                        %(lengths)s::int[], %(tokens)s::int[]
+                    ) WITH ORDINALITY AS t(role, content, length, tokens, ord)
+                ),
+                stored AS (
+                    -- Сообщения хода, уже сохраненные под своими номерами (повтор
+                    -- записи). Без условия на deleted_at: их могло уже усечь
+                    SELECT t.ord
+                    FROM turn t
+                    WHERE EXISTS (
+                        SELECT 1 FROM messages m
+                        WHERE m.user_id = %(user_id)s AND m.chat_id = %(chat_id)s
+                          AND m.epoch = {_CURRENT_EPOCH} AND m.seq = t.planned
+                          AND m.role = t.role AND m.content = t.content
+                    )
+                ),
+                claimed AS (
+                    -- Строка диалога блокируется до конца транзакции, last_seq - последний
+                    -- номер после вставки (см. _CLAIM_SEQ)
+                    INSERT INTO conversations (user_id, chat_id, last_seq)
+                    VALUES (
+                        %(user_id)s, %(chat_id)s,
+                        COALESCE(%(first_seq)s::bigint - 1, 0) + %(count)s
+                    )
+                    ON CONFLICT (user_id, chat_id) DO UPDATE
+                    SET last_seq = CASE
+                        -- Все номера хода до last_seq заняты им самим:
+                        -- остальные сообщения - под своими номерами
+                        WHEN %(first_seq)s::bigint IS NOT NULL
+                             AND (SELECT COUNT(*) FROM stored) = GREATEST(
+                                 LEAST(conversations.last_seq - %(first_seq)s::bigint + 1,
+                                       %(count)s),
+                                 0
+                             )
+                        THEN GREATEST(
+                            conversations.last_seq, %(first_seq)s::bigint + %(count)s - 1
+                        )
+                        -- Номера не заданы или заняты другим ходом: следующие свободные
+                        ELSE conversations.last_seq + %(count)s - (SELECT COUNT(*) FROM stored)
+                    END
+                    RETURNING epoch, last_seq
+                ),
+                new_rows AS (
+                    -- Несохраненные сообщения занимают последние номера до last_seq
+                    SELECT t.role, t.content, t.length, t.tokens, t.ord,
+                           ROW_NUMBER() OVER (ORDER BY t.ord) - COUNT(*) OVER () AS offset_seq
+                    FROM turn t
+                    WHERE t.ord NOT IN (SELECT ord FROM stored)
+                ),
+                inserted AS (
+                    INSERT INTO messages (
+                        user_id, chat_id, role, content, length, tokens, epoch, seq
+                    )
+                    SELECT %(user_id)s, %(chat_id)s, n.role, n.content, n.length, n.tokens,
+                           c.epoch, c.last_seq + n.offset_seq
+                    FROM new_rows n
+                    CROSS JOIN claimed c
+                    ORDER BY n.ord
+                    RETURNING id, role, content, tokens, seq
+                ),
+                usage AS (
+                    INSERT INTO llm_usage (
+                        message_id, model, endpoint, latency_ms, prompt_tokens, completion_tokens
+                    )
+                    SELECT i.id, u.model, u.endpoint, u.latency_ms,
+                           u.prompt_tokens, u.completion_tokens
+                    FROM new_rows n
+                    CROSS JOIN claimed c
+                    JOIN inserted i ON i.seq = c.last_seq + n.offset_seq
+                    JOIN unnest(
+                        %(models)s::varchar[], %(endpoints)s::varchar[], %(latencies)s::int[],
+                        %(prompt_tokens)s::int[], %(completion_tokens)s::int[]
+                    ) WITH ORDINALITY AS u(
+                        model, endpoint, latency_ms, prompt_tokens, completion_tokens, ord
+                    ) ON u.ord = n.ord
+                    WHERE u.model IS NOT NULL
+                ),
+                trimmed AS (
+                    UPDATE messages
+                    SET deleted_at = NOW()
+                    -- С created_at (ключ партиционирования) поиск идет по первичному
+                    -- ключу одной партиции, а не по всем
+                    WHERE (id, created_at) IN (
+                        SELECT id, created_at FROM (
+                            SELECT id, created_at,
+                                   ROW_NUMBER() OVER (ORDER BY created_at DESC, id DESC) AS rn
+                            FROM messages
+                            WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s
+                              AND epoch = (SELECT epoch FROM claimed)
+                              AND deleted_at IS NULL AND role NOT IN ('system', 'summary')
+                        ) ranked
+                        -- Из существующих остается keep_last минус новые не-system
+                        WHERE rn > %(keep_last)s - (
+                            SELECT COUNT(*) FROM new_rows
+                            WHERE role NOT IN ('system', 'summary')
+                        )
+                    )
+                    RETURNING id
+                )
+                SELECT id, role, content, tokens, seq,
+                       (SELECT COUNT(*) FROM trimmed) AS trimmed_count
+                FROM inserted
+                ORDER BY seq
+                """,
+                {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "roles": roles,
+                    "contents": contents,
+                    "lengths": lengths,
+                    "tokens": tokens,
+                    "first_seq": first_seq,
+                    "count": len(messages),
+                    "models": [usage.get("model") for usage in usages],
+                    "endpoints": [usage.get("endpoint") for usage in usages],
+                    "latencies": [usage.get("latency_ms") for usage in usages],
+                    "prompt_tokens": [usage.get("prompt_tokens") for usage in usages],
+                    "completion_tokens": [usage.get("completion_tokens") for usage in usages],
+                    "keep_last": keep_last,
+                },
+            )
+            results = await cur.fetchall()
+            trimmed_count = results[0]["trimmed_count"] if results else 0
+            inserted = [
+                {
+                    "id": row["id"],
+                    "role": row["role"],
+                    "content": row["content"],
+                    "tokens": row["tokens"],
+                    "seq": row["seq"],
+                }
+                for row in results
+            ]
+            if len(inserted) < len(messages):
+                logger.debug(
+                    f"{len(messages) - len(inserted)} messages already stored: "
+                    f"user={user_id}, chat={chat_id}"
+                )
+            logger.debug(
+                f"Appended {len(inserted)} messages, trimmed {trimmed_count}: "
+                f"user={user_id}, chat={chat_id}"
+            )
+            return inserted
+
+
+async def replace_with_summary(
+    user_id: int, chat_id: int, message_ids: list[int], summary: str
+) -> dict[str, Any] | None:
+    """
+    Заменить сообщения диалога их кратким содержанием одним запросом
+
+    Сообщения помечаются удаленными, и добавляется сообщение с ролью summary.
+    Если в текущей эпохе диалога таких сообщений уже нет (например, контекст
+    очищен, пока готовилось краткое содержание), ничего не добавляется.
+
+    Args:
+        user_id: ID пользователя (внутренний)
+        chat_id: ID чата (внутренний)
+        message_ids: ID сжимаемых сообщений (включая предыдущее краткое содержание)
+        summary: Текст краткого содержания
+
+    Returns:
+        Добавленное сообщение (id, role, content, tokens, seq) или None
+    """
+    async with _connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                f"""
+                WITH current_epoch AS (
+                    SELECT {_CURRENT_EPOCH} AS epoch
+                ),
+                summarized AS (
+                    UPDATE messages
+                    SET deleted_at = NOW()
+                    WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s
+                      AND id = ANY(%(message_ids)s) AND deleted_at IS NULL
+                      AND epoch = (SELECT epoch FROM current_epoch)
+                    RETURNING id
+                ),
+                claimed AS (
+                    INSERT INTO conversations (user_id, chat_id, last_seq)
+                    SELECT %(user_id)s, %(chat_id)s, 1
+                    WHERE EXISTS (SELECT 1 FROM summarized)
+                    ON CONFLICT (user_id, chat_id)
+                    DO UPDATE SET last_seq = conversations.last_seq + 1
+                    RETURNING epoch, last_seq
+                )
+                INSERT INTO messages (
+                    user_id, chat_id, role, content, length, tokens, epoch, seq
+                )
+                SELECT %(user_id)s, %(chat_id)s, %(role)s, %(content)s, %(length)s, %(tokens)s,
+                       c.epoch, c.last_seq
+                FROM claimed c
+                -- Диалог могли очистить, пока ждали блокировку
+                WHERE c.epoch = (SELECT epoch FROM current_epoch)
+                RETURNING id, role, content, tokens, seq
+                """,
+                {
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "message_ids": message_ids,
+                    "role": MessageRole.SUMMARY.value,
+                    "content": summary,
+                    "length": len(summary),
+                    "tokens": count_tokens(summary),
+                },
+            )
+            result = await cur.fetchone()
+            logger.debug(
+                f"Summarized {len(message_ids)} messages: user={user_id}, chat={chat_id}, "
+                f"stored={result is not None}"
+            )
+            return dict(result) if result else None
+
+
 async def get_messages(user_id: int, chat_id: int, limit: int = 10) -> list[dict[str, Any]]:
     """
-    Получить последние сообщения диалога
+    Получить последние сообщения текущей эпохи диалога
 
     Args:
         user_id: ID пользователя (внутренний)
@@ -229,18 +695,18 @@ async def get_messages(user_id: int, chat_id: int, limit: int = 10) -> list[dict
     Returns:
         Список сообщений (от старых к новым)
     """
-    pool = await get_pool()
-    async with pool.connection() as conn:
+    async with _connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
             await cur.execute(
-                """
-                SELECT id, user_id, chat_id, role, content, length, created_at
+                f"""
+                SELECT id, user_id, chat_id, role, content, length, tokens, created_at
                 FROM messages
-                WHERE user_id = %s AND chat_id = %s AND deleted_at IS NULL
-                ORDER BY created_at DESC
-                LIMIT %s
+                WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s
+                  AND epoch = {_CURRENT_EPOCH} AND deleted_at IS NULL
+                ORDER BY created_at DESC, id DESC
+                LIMIT %(limit)s
                 """,
-                (user_id, chat_id, limit),
+                {"user_id": user_id, "chat_id": chat_id, "limit": limit},
             )
             results = await cur.fetchall()
             # Reverse to get chronological order (old to new)
@@ -249,23 +715,418 @@ async def get_messages(user_id: int, chat_id: int, limit: int = 10) -> list[dict
             return messages
 
 
-async def soft_delete_messages(user_id: int, chat_id: int) -> None:
+async def load_conversation(
+    telegram_user_id: int, telegram_chat_id: int, limit: int = 100
+) -> dict[str, Any]:
+    """
+    Загрузить диалог одним запросом: найти/создать пользователя и чат
+    и получить последние сообщения текущей эпохи
+
+    Args:
+        telegram_user_id: ID пользователя в Telegram
+        telegram_chat_id: ID чата в Telegram
+        limit: Максимальное количество сообщений
+
+    Returns:
+        Словарь {"user_id": ..., "chat_id": ..., "messages": [...], "prompt": ..., "seq": ...}
+        (внутренние ID, сообщения от старых к новым, ссылка на system prompt
+        диалога (имя, версия) или None, если диалог еще не начат, и номер
+        последнего сообщения эпохи - от него нумеруется следующий ход)
+    """
+    async with _connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                """
+                WITH existing_user AS (
+                    SELECT id FROM users WHERE telegram_user_id = %(tg_user_id)s
+                ),
+                inserted_user AS (
+                    INSERT INTO users (telegram_user_id, first_name)
+                    SELECT %(tg_user_id)s, 'Unknown'
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_user)
+                    ON CONFLICT (telegram_user_id)
+                    DO UPDATE SET first_name = users.first_name
+                    RETURNING id
+                ),
+                u AS (
+                    SELECT id FROM existing_user UNION ALL SELECT id FROM inserted_user
+                ),
+                existing_chat AS (
+                    SELECT id FROM chats WHERE telegram_chat_id = %(tg_chat_id)s
+                ),
+                inserted_chat AS (
+                    INSERT INTO chats (telegram_chat_id)
+                    SELECT %(tg_chat_id)s
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_chat)
+                    ON CONFLICT (telegram_chat_id)
+                    DO UPDATE SET telegram_chat_id = EXCLUDED.telegram_chat_id
+                    RETURNING id
+                ),
+                c AS (
+                    SELECT id FROM existing_chat UNION ALL SELECT id FROM inserted_chat
+                )
+                SELECT u.id AS user_id, c.id AS chat_id,
+                       cv.prompt_name, cv.prompt_version, COALESCE(cv.last_seq, 0) AS last_seq,
+                       m.id AS message_id, m.role, m.content, m.tokens
+                FROM u
+                CROSS JOIN c
+                LEFT JOIN conversations cv ON cv.user_id = u.id AND cv.chat_id = c.id
+                LEFT JOIN LATERAL (
+                    SELECT id, role, content, tokens, created_at
+                    FROM messages
+                    WHERE user_id = u.id AND chat_id = c.id
+                      AND epoch = COALESCE(cv.epoch, 0) AND deleted_at IS NULL
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %(limit)s
+                ) m ON TRUE
+                ORDER BY m.created_at, m.id
+                """,
+                {"tg_user_id": telegram_user_id, "tg_chat_id": telegram_chat_id, "limit": limit},
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                raise RuntimeError(
+                    f"Failed to load conversation user={telegram_user_id}, chat={telegram_chat_id}"
+                )
+
+            user_id: int = rows[0]["user_id"]
+            chat_id: int = rows[0]["chat_id"]
+            prompt = (
+                (rows[0]["prompt_name"], rows[0]["prompt_version"])
+                if rows[0]["prompt_name"] is not None
+                else None
+            )
+
+            # Прогреваем кэш ID, чтобы последующая запись хода не обращалась к БД.
+            # Внутри сессии - только после коммита (пользователь/чат могли быть созданы в ней)
+            def warm_id_cache() -> None:
+                if telegram_user_id not in _user_id_cache:
+                    _user_id_cache.set(telegram_user_id, (user_id, None))
+                _chat_id_cache.set(telegram_chat_id, chat_id)
+
+            _on_commit(warm_id_cache)
+
+            messages = [
+                {
+                    "id": row["message_id"],
+                    "role": row["role"],
+                    "content": row["content"],
+                    "tokens": row["tokens"],
+                }
+                for row in rows
+                if row["message_id"] is not None
+            ]
+            logger.debug(
+                f"Loaded conversation user={user_id}, chat={chat_id}: {len(messages)} messages"
+            )
+            return {
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "messages": messages,
+                "prompt": prompt,
+                "seq": rows[0]["last_seq"],
+            }
+
+
+async def set_conversation_prompt(
+    user_id: int, chat_id: int, prompt_name: str, prompt_version: int
+) -> None:
     """
-    Soft delete всех сообщений диалога
+    Запомнить system prompt диалога (имя и версию из реестра roles.prompts)
+
+    Сам текст промпта в БД не хранится и подставляется при загрузке контекста.
 
     Args:
         user_id: ID пользователя (внутренний)
         chat_id: ID чата (внутренний)
+        prompt_name: Имя промпта в реестре
+        prompt_version: Версия промпта
     """
-    pool = await get_pool()
-    async with pool.connection() as conn:
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO conversations (user_id, chat_id, prompt_name, prompt_version)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id, chat_id)
+                DO UPDATE SET prompt_name = EXCLUDED.prompt_name,
+                              prompt_version = EXCLUDED.prompt_version,
+                              created_at = NOW()
+                """,
+                (user_id, chat_id, prompt_name, prompt_version),
+            )
+
+
+async def clear_conversation(user_id: int, chat_id: int) -> None:
+    """
+    Очистить диалог: начать новую эпоху
+
+    Одна запись в conversations независимо от длины истории: сообщения
+    прошлых эпох больше не читаются, фоновая задача помечает их удаленными
+    пачками (reclaim_cleared_messages). Нумерация сообщений (seq) начинается
+    заново. Ссылка на system prompt сбрасывается: следующее сообщение начнет
+    новый диалог с актуальной версией промпта.
+
+    Args:
+        user_id: ID пользователя (внутренний)
+        chat_id: ID чата (внутренний)
+    """
+    async with _connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
-                UPDATE messages
-                SET deleted_at = NOW()
-                WHERE user_id = %s AND chat_id = %s AND deleted_at IS NULL
+                INSERT INTO conversations (user_id, chat_id, epoch, cleared_at)
+                VALUES (%s, %s, 1, NOW())
+                ON CONFLICT (user_id, chat_id)
+                DO UPDATE SET epoch = conversations.epoch + 1,
+                              last_seq = 0,
+                              cleared_at = NOW(),
+                              prompt_name = NULL,
+                              prompt_version = NULL
                 """,
                 (user_id, chat_id),
             )
-            logger.info(f"Soft deleted messages for user={user_id}, chat={chat_id}")
+            logger.info(f"Cleared conversation user={user_id}, chat={chat_id}")
+
+
+async def try_advisory_lock(key: int) -> bool:
+    """
+    Захватить advisory lock до конца транзакции (без ожидания)
+
+    Вызывается внутри session(): блокировка снимается при ее завершении.
+    Нужна, чтобы фоновые задачи нескольких процессов не выполнялись одновременно.
+
+    Returns:
+        True, если блокировка получена
+    """
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (key,))
+            row = await cur.fetchone()
+            return bool(row and row[0])
+
+
+async def list_message_partitions() -> list[dict[str, Any]] | None:
+    """
+    Партиции таблицы messages
+
+    Returns:
+        [{"name": ..., "bound": "FOR VALUES FROM (...) TO (...)"}, ...]
+        или None, если messages не партиционирована (миграция не применена)
+    """
+    async with _connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                """
+                SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+                FROM pg_class p
+                LEFT JOIN pg_inherits i ON i.inhparent = p.oid
+                LEFT JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE p.oid = 'messages'::regclass AND p.relkind = 'p'
+                ORDER BY c.relname
+                """
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None
+            return [
+                {"name": row["name"], "bound": row["bound"]}
+                for row in rows
+                if row["name"] is not None
+            ]
+
+
+async def create_message_partition(name: str, start: str, end: str) -> None:
+    """
+    Создать партицию messages для диапазона created_at [start, end)
+
+    Args:
+        name: Имя таблицы партиции
+        start: Начало диапазона (ISO-дата, включительно)
+        end: Конец диапазона (ISO-дата, не включительно)
+    """
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF messages "
+                    "FOR VALUES FROM ({}) TO ({})"
+                ).format(sql.Identifier(name), sql.Literal(start), sql.Literal(end))
+            )
+            logger.info(f"Created messages partition {name} [{start}, {end})")
+
+
+async def detach_message_partition(name: str, drop: bool = False) -> None:
+    """
+    Отсоединить партицию messages (данные остаются в отдельной таблице)
+
+    Args:
+        name: Имя таблицы партиции
+        drop: Удалить таблицу после отсоединения
+    """
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                sql.SQL("ALTER TABLE messages DETACH PARTITION {}").format(sql.Identifier(name))
+            )
+            if drop:
+                await cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            logger.info(f"{'Dropped' if drop else 'Detached'} messages partition {name}")
+
+
+async def purge_deleted_messages(
+    grace_seconds: float,
+    after: tuple[datetime, int] | None,
+    limit: int,
+    archive: bool = True,
+) -> tuple[int, tuple[datetime, int] | None]:
+    """
+    Удалить пачку soft-deleted сообщений старше grace_seconds (с переносом в архив)
+
+    Пачка выбирается по ключу (deleted_at, id) после after, чтобы следующая
+    не просматривала уже обработанные записи индекса. Строки, заблокированные
+    другими транзакциями, пропускаются (SKIP LOCKED).
+
+    Args:
+        grace_seconds: Сколько секунд после soft delete строка не трогается
+        after: Ключ последней строки предыдущей пачки (None - с начала)
+        limit: Размер пачки
+        archive: Перенести строки в messages_archive (иначе только удалить)
+
+    Returns:
+        (количество удаленных строк, ключ последней строки пачки или None, если пачка пуста)
+    """
+    after_deleted_at, after_id = after or (datetime.min, 0)
+    async with _connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                """
+                WITH batch AS (
+                    SELECT id, created_at, deleted_at
+                    FROM messages
+                    WHERE deleted_at IS NOT NULL
+                      AND deleted_at < NOW() - make_interval(secs => %(grace)s)
+                      AND (deleted_at, id) > (%(after_deleted_at)s, %(after_id)s)
+                    ORDER BY deleted_at, id
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                ),
+                purged AS (
+                    DELETE FROM messages m
+                    USING batch b
+                    WHERE m.id = b.id AND m.created_at = b.created_at
+                    RETURNING m.id, m.user_id, m.chat_id, m.role, m.content, m.length,
+                              m.tokens, m.created_at, m.deleted_at
+                ),
+                archived AS (
+                    INSERT INTO messages_archive (
+                        id, user_id, chat_id, role, content, length, tokens, created_at, deleted_at
+                    )
+                    SELECT id, user_id, chat_id, role, content, length, tokens, created_at, deleted_at
+                    FROM purged
+                    WHERE %(archive)s
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT b.deleted_at, b.id, (SELECT COUNT(*) FROM purged) AS purged
+                FROM batch b
+                ORDER BY b.deleted_at DESC, b.id DESC
+                LIMIT 1
+                """,
+                {
+                    "grace": grace_seconds,
+                    "after_deleted_at": after_deleted_at,
+                    "after_id": after_id,
+                    "limit": limit,
+                    "archive": archive,
+                },
+            )
+            row = await cur.fetchone()
+            if row is None:
+                return 0, None
+            return row["purged"], (row["deleted_at"], row["id"])
+
+
+async def reclaim_cleared_messages(limit: int) -> int | None:
+    """
+    Пометить удаленными пачку сообщений прошлых эпох одного очищенного диалога
+
+    Временем удаления считается время очистки диалога (cleared_at), поэтому
+    дальше строки обрабатывает обычная очистка soft-deleted сообщений
+    (purge_deleted_messages) с тем же периодом ожидания, а статистика и
+    запросы с условием deleted_at IS NULL перестают их учитывать. Когда
+    сообщений прошлых эпох в диалоге не остается, отметка cleared_at
+    снимается. Диалоги, которые обрабатывает другой процесс, пропускаются
+    (SKIP LOCKED).
+
+    Args:
+        limit: Размер пачки
+
+    Returns:
+        Количество помеченных строк или None, если очищенных диалогов не осталось
+    """
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                WITH conv AS (
+                    SELECT user_id, chat_id, epoch, cleared_at
+                    FROM conversations
+                    WHERE cleared_at IS NOT NULL
+                    ORDER BY cleared_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                ),
+                batch AS (
+                    SELECT m.id, m.created_at
+                    FROM conv
+                    JOIN messages m ON m.user_id = conv.user_id AND m.chat_id = conv.chat_id
+                    WHERE m.epoch < conv.epoch AND m.deleted_at IS NULL
+                    LIMIT %(limit)s
+                ),
+                marked AS (
+                    UPDATE messages m
+                    SET deleted_at = conv.cleared_at
+                    FROM batch b, conv
+                    WHERE m.id = b.id AND m.created_at = b.created_at
+                    RETURNING m.id
+                ),
+                reclaimed AS (
+                    UPDATE conversations cv
+                    SET cleared_at = NULL
+                    FROM conv
+                    WHERE cv.user_id = conv.user_id AND cv.chat_id = conv.chat_id
+                      AND (SELECT COUNT(*) FROM batch) < %(limit)s
+                )
+                SELECT (SELECT COUNT(*) FROM marked) AS marked
+                FROM conv
+                """,
+                {"limit": limit},
+            )
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+
+async def get_purge_lag(grace_seconds: float) -> float:
+    """
+    Отставание очистки: возраст самого старого soft-deleted сообщения
+    или очищенного диалога сверх grace_seconds
+
+    Returns:
+        Секунды (0, если ожидающих очистки строк нет)
+    """
+    async with _connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT GREATEST(
+                    EXTRACT(EPOCH FROM NOW() - LEAST(
+                        (SELECT MIN(deleted_at) FROM messages WHERE deleted_at IS NOT NULL),
+                        (SELECT MIN(cleared_at) FROM conversations WHERE cleared_at IS NOT NULL)
+                    )) - %s,
+                    0
+                )
+                """,
+                (grace_seconds,),
+            )
+            row = await cur.fetchone()
+            return float(row[0]) if row and row[0] is not None else 0.0
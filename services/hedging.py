@@ -0,0 +1,169 @@
+"""Хеджирование запросов к LLM: дублирующий запрос при долгом ответе"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TypeVar
+
+from constants import HEDGE_LATENCY_WINDOW, HEDGE_MIN_SAMPLES
+from services.metrics import (
+    LLM_HEDGE_DELAY_SECONDS,
+    LLM_HEDGE_REQUESTS,
+    LLM_HEDGE_WINS,
+    LLM_HEDGES_SENT,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек для расчета перцентилей"""
+
+    def __init__(self, window: int) -> None:
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float) -> None:
+        """Добавить замер"""
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """Перцентиль q (0..1) по окну или None, если замеров недостаточно"""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(int(q * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+
+@dataclass
+class HedgeStats:
+    """Счетчики хеджирования (те же значения экспортируются в /metrics)"""
+
+    requests: int = 0
+    hedged: int = 0
+    hedge_wins: int = 0
+
+
+_latency = LatencyTracker(HEDGE_LATENCY_WINDOW)
+_stats = HedgeStats()
+
+
+def _reset_hedging() -> None:
+    """Сбросить замеры и счетчики (для тестов)."""
+    global _latency, _stats
+    _latency = LatencyTracker(HEDGE_LATENCY_WINDOW)
+    _stats = HedgeStats()
+
+
+def get_hedge_stats(percentile: float = 0.95) -> dict[str, float | int | None]:
+    """
+    Метрики хеджирования для подбора перцентиля
+
+    Returns:
+        requests, hedged, hedge_wins, hedge_rate (доля запросов с дублем),
+        win_rate (доля дублей, ответивших первыми) и текущая задержка дубля
+    """
+    return {
+        "requests": _stats.requests,
+        "hedged": _stats.hedged,
+        "hedge_wins": _stats.hedge_wins,
+        "hedge_rate": round(_stats.hedged / _stats.requests, 4) if _stats.requests else 0.0,
+        "win_rate": round(_stats.hedge_wins / _stats.hedged, 4) if _stats.hedged else 0.0,
+        "hedge_delay": _latency.percentile(percentile),
+    }
+
+
+async def hedged(
+    call: Callable[[], Awaitable[T]],
+    percentile: float | None,
+    started: asyncio.Event | None = None,
+    latency: Callable[[T], float] | None = None,
+    can_hedge: Callable[[], bool] | None = None,
+) -> T:
+    """
+    Выполнить запрос, при долгом ответе продублировав его
+
+    Если за время, равное перцентилю наблюдаемых задержек, ответа нет,
+    запускается второй такой же запрос. Возвращается первый успешный
+    результат, второй запрос отменяется. Если оба завершились ошибкой,
+    пробрасывается ошибка основного.
+
+    Ожидание в очереди (например, слота планировщика) не должно влиять ни
+    на замеры, ни на решение о дубле: время до дубля отсчитывается от
+    started, а замер берется из latency.
+
+    Args:
+        call: Запрос (вызывается один или два раза)
+        percentile: Перцентиль задержки (0..1) для запуска дубля;
+            None - без хеджирования (задержка все равно замеряется)
+        started: Событие, которое запрос устанавливает, дойдя до провайдера
+            (None - время до дубля отсчитывается сразу)
+        latency: Задержка провайдера по результату запроса
+            (None - время от вызова до результата)
+        can_hedge: Можно ли сейчас отправить дубль (например, не занят ли
+            планировщик); None - всегда
+
+    Returns:
+        Результат первого успешного запроса
+    """
+    delay = _latency.percentile(percentile) if percentile is not None else None
+    _stats.requests += 1
+    LLM_HEDGE_REQUESTS.inc()
+    if delay is not None:
+        LLM_HEDGE_DELAY_SECONDS.set(delay)
+    called = time.monotonic()
+
+    def observe(result: T) -> None:
+        _latency.observe(latency(result) if latency else time.monotonic() - called)
+
+    primary = asyncio.ensure_future(call())
+    tasks = [primary]
+    try:
+        if delay is None:
+            result = await primary
+            observe(result)
+            return result
+
+        if started is not None:
+            waiting = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait([primary, waiting], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiting.cancel()
+
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            if can_hedge is None or can_hedge():
+                _stats.hedged += 1
+                LLM_HEDGES_SENT.inc()
+                logger.info(f"LLM request exceeded {delay:.2f}s, sending hedge request")
+                tasks.append(asyncio.ensure_future(call()))
+            else:
+                logger.debug(f"LLM request exceeded {delay:.2f}s, hedge skipped: no free slot")
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        _stats.hedge_wins += 1
+                        LLM_HEDGE_WINS.inc()
+                    observe(task.result())
+                    return task.result()
+
+        # Оба запроса завершились ошибкой
+        return primary.result()
+    finally:
+        # Проигравший запрос (или оба при отмене вызывающего) отменяется
+        for task in tasks:
+            if not task.done():
+                task.cancel()
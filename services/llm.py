@@ -1,119 +1,580 @@
 """Сервис для работы с LLM через OpenAI-совместимое API"""
 
+import asyncio
+import hashlib
+import importlib.util
+import json
 import logging
 import re
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
 
-from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, RateLimitError
+import httpx
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    AsyncStream,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
 from config import Config
+from constants import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, LLMPriority
+from message_types import LLMUsage
+from services.cache import SingleFlight, TTLCache
+from services.hedging import hedged
+from services.metrics import (
+    CACHES,
+    LLM_RESPONSE_CACHE_SAVED_SECONDS,
+    LLM_RESPONSE_CACHE_SHARED,
+    LLMCallStats,
+    record_llm_call,
+)
+from services.resilience import CircuitOpenError
+from services.router import LLMEndpoint, get_router
+from services.scheduler import get_scheduler
 
 logger = logging.getLogger(__name__)
 
 # Кэш клиентов OpenAI для переиспользования
 _client_cache: dict[tuple[str, str], AsyncOpenAI] = {}
 
+# Общий HTTP-транспорт всех клиентов: один пул keep-alive соединений на процесс
+_http_client: httpx.AsyncClient | None = None
+
+
+# Кэш ответов: хэш запроса -> (ответ, время его генерации в секундах).
+# Кэшируются только успешные непустые ответы (complete_chat при ошибке бросает исключение)
+_response_cache: TTLCache[str, tuple[str, float]] = TTLCache(
+    max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL
+)
+_response_flight: SingleFlight[str, str | None] = SingleFlight()
+_response_cache_counters = {"shared": 0, "saved_seconds": 0.0}
+CACHES.register("llm_response", _response_cache)
+
 
 def _clear_client_cache() -> None:
     """Очистить кэш клиентов (для тестов)."""
+    global _http_client
     _client_cache.clear()
+    _http_client = None
+
+
+def _clear_response_cache() -> None:
+    """Очистить кэш ответов и его счетчики (для тестов)."""
+    _response_cache.clear()
+    _response_cache_counters.update(shared=0, saved_seconds=0.0)
+
+
+def get_response_cache_stats() -> dict[str, float]:
+    """
+    Метрики кэша ответов LLM
+
+    Returns:
+        size/hits/misses/evictions кэша, hit_ratio, shared (запросы,
+        присоединившиеся к уже идущему такому же запросу) и saved_seconds
+        (суммарное время генерации ответов, отданных из кэша)
+    """
+    stats: dict[str, float] = dict(_response_cache.stats())
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    stats["shared"] = _response_cache_counters["shared"]
+    stats["saved_seconds"] = round(_response_cache_counters["saved_seconds"], 3)
+    return stats
+
+
+def _get_http_client(config: Config) -> httpx.AsyncClient:
+    """Получить общий HTTP-клиент с настроенным пулом соединений (singleton pattern)"""
+    global _http_client
+    if _http_client is None:
+        http2 = config.llm_http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("LLM_HTTP2 requires the 'h2' package (httpx[http2]), using HTTP/1.1")
+            http2 = False
+        _http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=config.llm_http_max_connections,
+                max_keepalive_connections=config.llm_http_max_keepalive,
+                keepalive_expiry=config.llm_http_keepalive_expiry,
+            ),
+            http2=http2,
+        )
+        logger.info(
+            f"LLM HTTP pool: max_connections={config.llm_http_max_connections}, "
+            f"keepalive={config.llm_http_max_keepalive}, "
+            f"expiry={config.llm_http_keepalive_expiry}s, http2={http2}"
+        )
+    return _http_client
 
 
-def _get_or_create_client(config: Config) -> AsyncOpenAI:
-    """Получить или создать клиента OpenAI (singleton pattern).
+def _get_or_create_client(endpoint: LLMEndpoint, config: Config) -> AsyncOpenAI:
+    """Получить или создать клиента OpenAI для endpoint'а (singleton pattern).
 
     Args:
-        config: Конфигурация приложения
+        endpoint: Endpoint LLM из маршрутизатора
+        config: Конфигурация приложения (настройки HTTP-транспорта)
 
     Returns:
         Экземпляр AsyncOpenAI клиента
     """
-    key = (config.openai_api_key, config.openai_base_url)
+    key = (endpoint.api_key, endpoint.base_url)
     if key not in _client_cache:
+        # Повторы выполняет services.resilience (с учетом бюджета и circuit breaker)
         _client_cache[key] = AsyncOpenAI(
-            api_key=config.openai_api_key, base_url=config.openai_base_url
+            api_key=endpoint.api_key,
+            base_url=endpoint.base_url,
+            max_retries=0,
+            http_client=_get_http_client(config),
         )
-        logger.debug(f"Created new OpenAI client for {config.openai_base_url}")
+        logger.debug(f"Created new OpenAI client for {endpoint.base_url}")
     return _client_cache[key]
 
 
-async def get_llm_response(messages: list, config: Config) -> str:
+async def warm_up_llm(config: Config) -> None:
+    """
+    Заранее установить соединения со всеми endpoint'ами LLM
+
+    Выполняет легкий запрос списка моделей, чтобы DNS, TCP и TLS
+    не выполнялись на первом сообщении пользователя. Ошибки только
+    логируются: ни недоступный при старте endpoint, ни некорректный
+    LLM_ENDPOINTS не мешают запуску (ошибка конфигурации повторится
+    на первом запросе к LLM).
+
+    Args:
+        config: Конфигурация приложения
+    """
+
+    async def warm_up(endpoint: LLMEndpoint) -> None:
+        started = time.monotonic()
+        try:
+            client = _get_or_create_client(endpoint, config)
+            await client.with_options(timeout=config.openai_timeout).models.list()
+        except Exception as e:
+            # Даже ответ с ошибкой (например, 404) оставляет соединение в пуле
+            logger.warning(f"LLM warm-up {endpoint.name}: {type(e).__name__}: {e}")
+            return
+        logger.info(f"LLM warm-up {endpoint.name}: {time.monotonic() - started:.2f}s")
+
+    try:
+        endpoints = get_router(config).endpoints
+    except ValueError as e:
+        logger.warning(f"LLM warm-up skipped: {e}")
+        return
+    await asyncio.gather(*(warm_up(endpoint) for endpoint in endpoints))
+
+
+async def close_llm_clients() -> None:
+    """Закрыть клиентов OpenAI и общий пул соединений"""
+    global _http_client
+    _client_cache.clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        logger.info("LLM HTTP pool closed")
+
+
+# Служебные токены DeepSeek и других моделей, которые нужно вырезать из ответа
+SPECIAL_TOKENS = [
+    "<｜begin▁of▁sentence｜>",
+    "<|begin_of_sentence|>",
+    "<｜end▁of▁sentence｜>",
+    "<|end_of_sentence|>",
+    "<｜end▁of▁text｜>",
+    "<|end_of_text|>",
+]
+
+EMPTY_RESPONSE_MESSAGE = "🤔 Получен пустой ответ от модели. Попробуйте еще раз."
+
+
+async def get_llm_response(
+    messages: list,
+    config: Config,
+    user_id: int | None = None,
+    priority: LLMPriority = LLMPriority.CHAT,
+    on_usage: Callable[[LLMUsage], None] | None = None,
+) -> str:
     """
     Получить ответ от LLM
 
+    Запрос проходит через планировщик: число одновременных запросов
+    ограничено, очередь распределяется честно между пользователями и полосами.
+
     Args:
         messages: Список сообщений в формате OpenAI
         config: Конфигурация приложения
+        user_id: ID пользователя для честной очереди (опционально)
+        priority: Полоса запроса (бот, API, фоновые задачи)
+        on_usage: Получает замеры запроса, сгенерировавшего ответ
+            (не вызывается для ответа из кэша и при ошибке)
 
     Returns:
         Текст ответа от LLM
     """
     try:
-        client = _get_or_create_client(config)
+        answer = await complete_chat(
+            messages, config, user_id=user_id, priority=priority, on_usage=on_usage
+        )
+    except Exception as e:
+        return _error_message(e)
+
+    # Проверка на пустой ответ
+    if answer is None:
+        return EMPTY_RESPONSE_MESSAGE
+    return answer
+
+
+async def complete_chat(
+    messages: list,
+    config: Config,
+    user_id: int | None = None,
+    priority: LLMPriority = LLMPriority.CHAT,
+    on_usage: Callable[[LLMUsage], None] | None = None,
+) -> str | None:
+    """
+    Запрос к LLM без преобразования ошибок в текст для пользователя
+
+    Для фоновых задач, которым нужно отличать ответ модели от ошибки.
+    Исключения OpenAI пробрасываются. При LLM_CACHE_ENABLED одинаковые
+    запросы отдаются из кэша, а одновременные одинаковые запросы
+    выполняются одним обращением к провайдеру.
+
+    Returns:
+        Очищенный текст ответа или None, если модель вернула пустой ответ
+    """
+    if not config.llm_cache_enabled:
+        answer, call = await _request_completion(messages, config, user_id, priority)
+        if on_usage and answer:
+            on_usage(call.usage())
+        return answer
+
+    key = _cache_key(messages, config)
+    cached = _cached_answer(key)
+    if cached is not None:
+        return cached
+
+    if key in _response_flight:
+        _response_cache_counters["shared"] += 1
+        LLM_RESPONSE_CACHE_SHARED.inc()
+        logger.info("LLM request joined identical in-flight request")
+
+    async def fetch() -> str | None:
+        answer, call = await _request_completion(messages, config, user_id, priority)
+        if answer:
+            _response_cache.set(key, (answer, call.latency))
+            # Замеры получает только вызвавший запрос, присоединившиеся - нет
+            if on_usage:
+                on_usage(call.usage())
+        return answer
+
+    return await _response_flight.do(key, fetch)
+
 
-        logger.info(f"LLM request: model={config.openai_model}, messages_count={len(messages)}")
+async def _request_completion(
+    messages: list, config: Config, user_id: int | None, priority: LLMPriority
+) -> tuple[str | None, LLMCallStats]:
+    """Выполнить запрос к провайдеру; возвращает ответ и замеры успешной попытки"""
+    logger.info(f"LLM request: model={config.openai_model}, messages_count={len(messages)}")
 
-        response = await client.chat.completions.create(
-            model=config.openai_model,
-            messages=messages,
-            temperature=config.temperature,
-            max_tokens=config.max_tokens,
-            timeout=config.openai_timeout,
+    async def attempt(endpoint: LLMEndpoint, timeout: float) -> tuple[ChatCompletion, LLMCallStats]:
+        started = time.monotonic()
+        try:
+            response = await _get_or_create_client(endpoint, config).chat.completions.create(
+                model=endpoint.model,
+                messages=messages,
+                temperature=config.temperature,
+                max_tokens=config.max_tokens,
+                timeout=timeout,
+            )
+        except (Exception, asyncio.CancelledError) as e:
+            _record_call(endpoint, _outcome(e), time.monotonic() - started)
+            raise
+        empty = not response.choices or not response.choices[0].message.content
+        call = _record_call(
+            endpoint, "empty" if empty else "ok", time.monotonic() - started, usage=response.usage
         )
+        return response, call
 
-        # Проверка на пустой ответ
-        if not response.choices or not response.choices[0].message.content:
+    scheduler = get_scheduler(config)
+    # Дубль укладывается в срок основного запроса, а не получает новый openai_timeout
+    deadline = time.monotonic() + config.openai_timeout
+    started = asyncio.Event()
+
+    @asynccontextmanager
+    async def slot() -> AsyncIterator[None]:
+        async with scheduler.slot(user_id, priority):
+            started.set()
+            yield
+
+    async def request() -> tuple[ChatCompletion, LLMCallStats]:
+        # Слот планировщика занимается на время одной попытки и освобождается на паузу перед повтором
+        return await get_router(config).call(attempt, config, slot=slot, deadline=deadline)
+
+    # Дубль выбирает endpoint заново: основной уже нагружен этим запросом, поэтому
+    # при нескольких endpoint'ах дубль обычно уходит на другой. Перцентиль считается
+    # по времени ответа провайдера, без ожидания слота; при занятом планировщике
+    # дубль не отправляется - он только встал бы в очередь
+    response, call = await hedged(
+        request,
+        config.llm_hedge_percentile if config.llm_hedge_enabled else None,
+        started=started,
+        latency=lambda result: result[1].latency,
+        can_hedge=lambda: not scheduler.saturated(),
+    )
+
+    if not response.choices or not response.choices[0].message.content:
+        logger.warning("Empty response from LLM")
+        return None, call
+
+    answer = _clean_answer(response.choices[0].message.content)
+
+    logger.info(f"LLM response: length={len(answer)}, latency={call.latency:.2f}s")
+
+    return answer, call
+
+
+def _cache_key(messages: list, config: Config) -> str:
+    """Стабильный ключ запроса: хэш endpoints (модель@base_url), сообщений и параметров генерации
+
+    Модели берутся из маршрутизатора (LLM_ENDPOINTS), а не из OPENAI_MODEL:
+    смена моделей endpoints не должна отдавать ответы прежних моделей.
+    """
+    payload = json.dumps(
+        {
+            "endpoints": [endpoint.name for endpoint in get_router(config).endpoints],
+            "messages": messages,
+            "temperature": config.temperature,
+            "max_tokens": config.max_tokens,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cached_answer(key: str) -> str | None:
+    """Ответ из кэша (с учетом сэкономленного времени) или None"""
+    cached = _response_cache.get(key)
+    if cached is None:
+        return None
+    answer, latency = cached
+    _response_cache_counters["saved_seconds"] += latency
+    LLM_RESPONSE_CACHE_SAVED_SECONDS.inc(latency)
+    logger.info(f"LLM response cache hit: saved {latency:.2f}s")
+    return answer
+
+
+async def stream_llm_response(
+    messages: list,
+    config: Config,
+    user_id: int | None = None,
+    priority: LLMPriority = LLMPriority.CHAT,
+    on_usage: Callable[[LLMUsage], None] | None = None,
+) -> AsyncIterator[str]:
+    """
+    Получить ответ от LLM в потоковом режиме (stream=True)
+
+    Каждое значение - весь очищенный текст ответа, полученный к этому моменту.
+    Незавершенные служебные токены и markdown-разметка в конце частичного
+    текста не показываются. Последнее значение - окончательный ответ
+    (такой же, как вернул бы get_llm_response) или текст ошибки.
+
+    Args:
+        messages: Список сообщений в формате OpenAI
+        config: Конфигурация приложения
+        user_id: ID пользователя для честной очереди (опционально)
+        priority: Полоса запроса (бот, API, фоновые задачи)
+        on_usage: Получает замеры запроса перед окончательным ответом
+            (не вызывается для ответа из кэша и при ошибке)
+
+    Yields:
+        Накопленный очищенный текст ответа
+    """
+    key = _cache_key(messages, config) if config.llm_cache_enabled else None
+    cached = _cached_answer(key) if key else None
+    if cached is not None:
+        yield cached
+        return
+
+    try:
+        logger.info(
+            f"LLM stream request: model={config.openai_model}, messages_count={len(messages)}"
+        )
+
+        raw = ""
+        started = time.monotonic()
+        ttft: float | None = None
+        usage = None
+
+        async def open_stream(
+            endpoint: LLMEndpoint, timeout: float
+        ) -> tuple[LLMEndpoint, AsyncStream[ChatCompletionChunk]]:
+            nonlocal started
+            started = time.monotonic()
+            try:
+                stream = await _get_or_create_client(endpoint, config).chat.completions.create(
+                    model=endpoint.model,
+                    messages=messages,
+                    temperature=config.temperature,
+                    max_tokens=config.max_tokens,
+                    timeout=timeout,
+                    stream=True,
+                    # Последний чанк содержит usage (без choices)
+                    stream_options={"include_usage": True},
+                )
+            except (Exception, asyncio.CancelledError) as e:
+                _record_call(endpoint, _outcome(e), time.monotonic() - started, stream=True)
+                raise
+            # Замеры потока записываются по endpoint'у, на котором он открыт
+            return endpoint, stream
+
+        async with get_scheduler(config).slot(user_id, priority):
+            # Повторяется только установка потока: после первых чанков ответ уже показан
+            opened, stream = await get_router(config).call(open_stream, config)
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    raw += chunk.choices[0].delta.content
+                    yield _clean_partial_answer(raw)
+            except (Exception, asyncio.CancelledError) as e:
+                _record_call(
+                    opened, _outcome(e), time.monotonic() - started, stream=True, ttft=ttft
+                )
+                raise
+
+        latency = time.monotonic() - started
+        call = _record_call(
+            opened, "ok" if raw else "empty", latency, stream=True, ttft=ttft, usage=usage
+        )
+
+        if not raw:
             logger.warning("Empty response from LLM")
-            return "🤔 Получен пустой ответ от модели. Попробуйте еще раз."
+            yield EMPTY_RESPONSE_MESSAGE
+            return
 
-        answer = response.choices[0].message.content
+        answer = _clean_answer(raw)
+        logger.info(
+            f"LLM stream response: length={len(answer)}, latency={latency:.2f}s, "
+            f"ttft={ttft or 0:.2f}s"
+        )
+        if key and answer:
+            _response_cache.set(key, (answer, latency))
+        if on_usage and answer:
+            on_usage(call.usage())
+        yield answer
 
-        # Очистка от служебных токенов модели
-        if answer:
-            # Удаляем служебные токены DeepSeek и других моделей
-            tokens_to_remove = [
-                "<｜begin▁of▁sentence｜>",
-                "<|begin_of_sentence|>",
-                "<｜end▁of▁sentence｜>",
-                "<|end_of_sentence|>",
-                "<｜end▁of▁text｜>",
-                "<|end_of_text|>",
-            ]
-
-            for token in tokens_to_remove:
-                answer = answer.replace(token, "")
-
-            # Удаляем markdown форматирование
-            # Удаляем ** для жирного текста
-            answer = answer.replace("**", "")
-            # Удаляем одинарные * для курсива (но только окружающие слова)
-            answer = re.sub(r"\*([^\*]+)\*", r"\1", answer)
-            # Удаляем _ для курсива
-            answer = re.sub(r"_([^_]+)_", r"\1", answer)
-            # Удаляем ` для кода
-            answer = answer.replace("`", "")
-
-            # Убираем лишние пробелы в конце
-            answer = answer.strip()
-
-        logger.info(f"LLM response: length={len(answer)}")
+    except Exception as e:
+        yield _error_message(e)
 
-        return answer
 
-    except RateLimitError:
+def _clean_answer(answer: str) -> str:
+    """Очистить ответ от служебных токенов модели и markdown форматирования"""
+    # Удаляем служебные токены DeepSeek и других моделей
+    for token in SPECIAL_TOKENS:
+        answer = answer.replace(token, "")
+
+    # Удаляем markdown форматирование
+    # Удаляем ** для жирного текста
+    answer = answer.replace("**", "")
+    # Удаляем одинарные * для курсива (но только окружающие слова)
+    answer = re.sub(r"\*([^\*]+)\*", r"\1", answer)
+    # Удаляем _ для курсива
+    answer = re.sub(r"_([^_]+)_", r"\1", answer)
+    # Удаляем ` для кода
+    answer = answer.replace("`", "")
+
+    # Убираем лишние пробелы в конце
+    return answer.strip()
+
+
+def _clean_partial_answer(answer: str) -> str:
+    """Очистить частичный (еще генерируемый) ответ для промежуточного показа
+
+    Отрезает с конца начало служебного токена, который еще не пришел целиком,
+    и незакрытую * (курсив или половину **), чтобы при дописывании ответа
+    уже показанный текст не менялся.
+    """
+    tail_start = answer.rfind("<")
+    if tail_start != -1:
+        tail = answer[tail_start:]
+        if any(token.startswith(tail) and token != tail for token in SPECIAL_TOKENS):
+            answer = answer[:tail_start]
+
+    cleaned = _clean_answer(answer)
+    if cleaned.count("*") % 2 == 1:
+        cleaned = cleaned[: cleaned.rfind("*")].rstrip()
+    return cleaned
+
+
+def _record_call(
+    endpoint: LLMEndpoint,
+    outcome: str,
+    latency: float,
+    stream: bool = False,
+    ttft: float | None = None,
+    usage: object = None,
+) -> LLMCallStats:
+    """Записать замеры запроса к провайдеру в метрики"""
+    # usage есть не у всех провайдеров (и не во всех ответах)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    call = LLMCallStats(
+        model=endpoint.model,
+        endpoint=endpoint.base_url,
+        outcome=outcome,
+        latency=latency,
+        stream=stream,
+        ttft=ttft,
+        prompt_tokens=prompt_tokens if isinstance(prompt_tokens, int) else None,
+        completion_tokens=completion_tokens if isinstance(completion_tokens, int) else None,
+    )
+    record_llm_call(call)
+    return call
+
+
+def _outcome(e: BaseException) -> str:
+    """Класс результата запроса к LLM для метрик"""
+    if isinstance(e, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(e, RateLimitError):
+        return "rate_limited"
+    if isinstance(e, APITimeoutError):
+        return "timeout"
+    if isinstance(e, APIConnectionError):
+        return "connection_error"
+    if isinstance(e, APIStatusError):
+        return "server_error" if e.status_code >= 500 else "client_error"
+    return "error"
+
+
+def _error_message(e: Exception) -> str:
+    """Преобразовать ошибку запроса к LLM в сообщение для пользователя"""
+    if isinstance(e, CircuitOpenError):
+        logger.error("LLM error: CircuitOpenError - provider is unavailable")
+        return "⚠️ Сервис LLM временно недоступен. Попробуйте через минуту."
+    if isinstance(e, RateLimitError):
         logger.error("LLM error: RateLimitError - Too many requests")
         return "⚠️ Слишком много запросов. Попробуйте через минуту."
-    except APITimeoutError:
+    if isinstance(e, APITimeoutError):
         logger.error("LLM error: APITimeoutError - Request timed out")
         return "⏱️ Превышено время ожидания ответа."
-    except APIConnectionError as e:
+    if isinstance(e, APIConnectionError):
         logger.error(f"LLM error: APIConnectionError - {e}")
         return "❌ Не удалось подключиться к сервису. Проверьте ваше интернет-соединение или URL."
-    except APIStatusError as e:
+    if isinstance(e, APIStatusError):
         logger.error(f"LLM error: APIStatusError - {e.status_code} - {e.response}")
         if e.status_code == 404:
             return "❌ Модель не найдена или недоступна. Проверьте название модели."
         return f"❌ Ошибка сервиса LLM: {e.status_code}. Попробуйте позже."
-    except Exception as e:
-        error_type = type(e).__name__
-        logger.error(f"LLM error: {error_type} - {str(e)}")
-        return "❌ Произошла непредвиденная ошибка при обработке запроса."
+
+    error_type = type(e).__name__
+    logger.error(f"LLM error: {error_type} - {str(e)}")
+    return "❌ Произошла непредвиденная ошибка при обработке запроса."
@@ -0,0 +1,383 @@
+"""Метрики приложения в текстовом формате Prometheus"""
+
+import logging
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import web
+
+from constants import LLM_LATENCY_BUCKETS, LLM_QUEUE_WAIT_BUCKETS, LLM_TOKEN_BUCKETS
+from message_types import LLMUsage
+from services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    """Экранирование значения метки по правилам формата Prometheus"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Отрисовать набор меток {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    """Число в формате Prometheus (целые без дробной части)"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин и набором меток.
+
+    Хранит по каждому сочетанию значений меток число наблюдений в каждой
+    корзине, их сумму и количество.
+    """
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Учесть наблюдение с заданными значениями меток"""
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = ([0] * len(self.buckets), [0.0, 0.0])
+            self._series[key] = series
+        counts, totals = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def clear(self) -> None:
+        """Сбросить все наблюдения"""
+        self._series.clear()
+
+    def render(self) -> list[str]:
+        """Строки гистограммы в текстовом формате Prometheus"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for key, (counts, (total, count)) in sorted(self._series.items()):
+            for bound, bucket_count in zip(self.buckets, counts, strict=True):
+                le = _labels(self.labelnames, key, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {bucket_count}")
+            inf = _labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {_number(count)}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {_number(count)}")
+        return lines
+
+
+class Counter:
+    """Монотонно растущий счетчик с набором меток"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Увеличить счетчик для заданных значений меток"""
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def clear(self) -> None:
+        """Сбросить все значения"""
+        self._values.clear()
+
+    def render(self) -> list[str]:
+        """Строки счетчика в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Gauge:
+    """Текущее значение с набором меток (по умолчанию без меток)"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        """Установить значение для заданных значений меток"""
+        self._values[tuple(labels[name] for name in self.labelnames)] = value
+
+    def clear(self) -> None:
+        """Сбросить значения (до следующего set метрика не выводится)"""
+        self._values.clear()
+
+    def render(self) -> list[str]:
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class CacheCollector:
+    """Метрики in-process кэшей (TTLCache) по имени кэша.
+
+    Значения читаются из счетчиков кэшей при отрисовке: размер, обращения
+    (hit/miss), вытеснения и доля попаданий.
+    """
+
+    def __init__(self) -> None:
+        self._caches: dict[str, TTLCache[Any, Any]] = {}
+
+    def register(self, name: str, cache: TTLCache[Any, Any]) -> None:
+        """Экспортировать кэш под именем name (метка cache)"""
+        self._caches[name] = cache
+
+    def clear(self) -> None:
+        """Счетчики хранятся в самих кэшах и сбрасываются их _clear_* функциями"""
+
+    def render(self) -> list[str]:
+        """Строки метрик кэшей в текстовом формате Prometheus"""
+        caches = sorted(self._caches.items())
+        lines = [
+            "# HELP cache_size Entries in the in-process cache",
+            "# TYPE cache_size gauge",
+        ]
+        lines += [f"cache_size{_labels(['cache'], [name])} {len(cache)}" for name, cache in caches]
+        lines += [
+            "# HELP cache_requests_total In-process cache lookups",
+            "# TYPE cache_requests_total counter",
+        ]
+        for name, cache in caches:
+            for result, value in (("hit", cache.hits), ("miss", cache.misses)):
+                labels = _labels(["cache", "result"], [name, result])
+                lines.append(f"cache_requests_total{labels} {value}")
+        lines += [
+            "# HELP cache_evictions_total Entries evicted by size or TTL",
+            "# TYPE cache_evictions_total counter",
+        ]
+        lines += [
+            f"cache_evictions_total{_labels(['cache'], [name])} {cache.evictions}"
+            for name, cache in caches
+        ]
+        lines += [
+            "# HELP cache_hit_ratio Share of lookups served from the cache since start",
+            "# TYPE cache_hit_ratio gauge",
+        ]
+        for name, cache in caches:
+            lookups = cache.hits + cache.misses
+            ratio = cache.hits / lookups if lookups else 0.0
+            lines.append(f"cache_hit_ratio{_labels(['cache'], [name])} {_number(round(ratio, 4))}")
+        return lines
+
+
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds",
+    "Duration of LLM provider requests",
+    ["model", "endpoint", "outcome", "stream"],
+    LLM_LATENCY_BUCKETS,
+)
+LLM_TTFT_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time to first streamed token of LLM responses",
+    ["model", "endpoint"],
+    LLM_LATENCY_BUCKETS,
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens",
+    "Prompt tokens per LLM request",
+    ["model", "endpoint"],
+    LLM_TOKEN_BUCKETS,
+)
+LLM_COMPLETION_TOKENS = Histogram(
+    "llm_completion_tokens",
+    "Completion tokens per LLM request",
+    ["model", "endpoint"],
+    LLM_TOKEN_BUCKETS,
+)
+
+LLM_QUEUE_DEPTH = Gauge(
+    "llm_queue_depth",
+    "LLM requests waiting for a scheduler slot",
+    ["lane"],
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "llm_queue_wait_seconds",
+    "Time LLM requests waited for a scheduler slot (0 when granted at once)",
+    ["lane"],
+    LLM_QUEUE_WAIT_BUCKETS,
+)
+
+LLM_HEDGE_REQUESTS = Counter(
+    "llm_hedge_requests_total",
+    "LLM requests that went through hedging",
+    [],
+)
+LLM_HEDGES_SENT = Counter(
+    "llm_hedges_sent_total",
+    "Duplicate (hedge) LLM requests sent",
+    [],
+)
+LLM_HEDGE_WINS = Counter(
+    "llm_hedge_wins_total",
+    "Hedge requests that answered before the primary",
+    [],
+)
+LLM_HEDGE_DELAY_SECONDS = Gauge(
+    "llm_hedge_delay_seconds",
+    "Current delay before a hedge request is sent (latency percentile)",
+)
+
+MESSAGES_PURGED = Counter(
+    "messages_purged_total",
+    "Soft-deleted messages removed by the purge job",
+    ["action"],
+)
+MESSAGES_PURGE_LAG_SECONDS = Gauge(
+    "messages_purge_lag_seconds",
+    "Age of the oldest soft-deleted message past the purge grace period",
+)
+
+LLM_RESPONSE_CACHE_SHARED = Counter(
+    "llm_response_cache_shared_total",
+    "LLM requests that joined an identical in-flight request",
+    [],
+)
+LLM_RESPONSE_CACHE_SAVED_SECONDS = Counter(
+    "llm_response_cache_saved_seconds_total",
+    "Generation time of LLM responses served from the response cache",
+    [],
+)
+
+# Кэши регистрируют модули-владельцы: CACHES.register(name, cache)
+CACHES = CacheCollector()
+
+_METRICS: tuple[Histogram | Counter | Gauge | CacheCollector, ...] = (
+    LLM_REQUEST_SECONDS,
+    LLM_TTFT_SECONDS,
+    LLM_PROMPT_TOKENS,
+    LLM_COMPLETION_TOKENS,
+    LLM_QUEUE_DEPTH,
+    LLM_QUEUE_WAIT_SECONDS,
+    LLM_HEDGE_REQUESTS,
+    LLM_HEDGES_SENT,
+    LLM_HEDGE_WINS,
+    LLM_HEDGE_DELAY_SECONDS,
+    LLM_RESPONSE_CACHE_SHARED,
+    LLM_RESPONSE_CACHE_SAVED_SECONDS,
+    CACHES,
+    MESSAGES_PURGED,
+    MESSAGES_PURGE_LAG_SECONDS,
+)
+
+
+@dataclass
+class LLMCallStats:
+    """Замеры одного запроса к провайдеру LLM
+
+    Attributes:
+        model: Модель
+        endpoint: Endpoint (base_url)
+        outcome: Класс результата: ok, empty, rate_limited, timeout,
+            connection_error, server_error, client_error, cancelled, error
+        latency: Полное время запроса, секунды
+        stream: Потоковый ли запрос
+        ttft: Время до первого токена (только для потока), секунды
+        prompt_tokens: Токены запроса (если провайдер вернул usage)
+        completion_tokens: Токены ответа (если провайдер вернул usage)
+    """
+
+    model: str
+    endpoint: str
+    outcome: str
+    latency: float
+    stream: bool = False
+    ttft: float | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+    def usage(self) -> LLMUsage:
+        """Замеры для сохранения вместе с ответом в БД"""
+        return {
+            "model": self.model,
+            "endpoint": self.endpoint,
+            "latency_ms": round(self.latency * 1000),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+def record_llm_call(call: LLMCallStats) -> None:
+    """Учесть запрос к LLM в гистограммах"""
+    LLM_REQUEST_SECONDS.observe(
+        call.latency,
+        model=call.model,
+        endpoint=call.endpoint,
+        outcome=call.outcome,
+        stream=str(call.stream).lower(),
+    )
+    if call.ttft is not None:
+        LLM_TTFT_SECONDS.observe(call.ttft, model=call.model, endpoint=call.endpoint)
+    if call.prompt_tokens is not None:
+        LLM_PROMPT_TOKENS.observe(call.prompt_tokens, model=call.model, endpoint=call.endpoint)
+    if call.completion_tokens is not None:
+        LLM_COMPLETION_TOKENS.observe(
+            call.completion_tokens, model=call.model, endpoint=call.endpoint
+        )
+
+
+def render_metrics() -> str:
+    """Все метрики процесса в текстовом формате Prometheus (text/plain; version=0.0.4)"""
+    lines: list[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(port: int) -> web.AppRunner:
+    """
+    Запустить HTTP-сервер с эндпоинтом /metrics (для бота, у которого нет своего HTTP)
+
+    Args:
+        port: Порт для прослушивания
+
+    Returns:
+        Runner сервера; остановка - await runner.cleanup()
+    """
+
+    async def metrics(_: web.Request) -> web.Response:
+        return web.Response(
+            body=render_metrics().encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Metrics server started on port {port}")
+    return runner
+
+
+def _reset_metrics() -> None:
+    """Сбросить все метрики (для тестов)."""
+    for metric in _METRICS:
+        metric.clear()
@@ -0,0 +1,130 @@
+"""Обслуживание месячных партиций таблицы messages: создание заранее и хранение"""
+
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from datetime import date
+
+from config import Config
+from constants import PARTITION_MAINTENANCE_INTERVAL, PARTITION_MAINTENANCE_LOCK_ID
+from services.database import (
+    create_message_partition,
+    detach_message_partition,
+    list_message_partitions,
+    session,
+    try_advisory_lock,
+)
+
+logger = logging.getLogger(__name__)
+
+# Граница партиции в выводе pg_get_expr: FOR VALUES FROM ('2026-11-01 00:00:00') TO (...)
+_BOUND_RE = re.compile(
+    r"FROM \((?:MINVALUE|'(\d{4}-\d{2}-\d{2})[^']*')\) TO \('(\d{4}-\d{2}-\d{2})"
+)
+
+
+@dataclass(frozen=True)
+class Partition:
+    """Партиция messages с диапазоном created_at [start, end)
+
+    Attributes:
+        name: Имя таблицы
+        start: Начало диапазона (None - MINVALUE, старая таблица messages_legacy)
+        end: Конец диапазона (не включительно)
+    """
+
+    name: str
+    start: date | None
+    end: date
+
+
+def add_months(day: date, months: int) -> date:
+    """Первое число месяца, отстоящего от day на months"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(start: date) -> str:
+    """Имя месячной партиции: messages_y2026m11"""
+    return f"messages_y{start.year}m{start.month:02d}"
+
+
+def parse_partition(name: str, bound: str) -> Partition | None:
+    """Разобрать границы партиции (None для DEFAULT и нераспознанных)"""
+    match = _BOUND_RE.search(bound)
+    if match is None:
+        return None
+    start, end = match.groups()
+    return Partition(name, date.fromisoformat(start) if start else None, date.fromisoformat(end))
+
+
+def missing_partitions(
+    existing: list[Partition], today: date, months_ahead: int
+) -> list[tuple[str, date, date]]:
+    """Недостающие партиции от текущего месяца на months_ahead вперед: (имя, начало, конец)"""
+    missing = []
+    for offset in range(months_ahead + 1):
+        start = add_months(today, offset)
+        end = add_months(today, offset + 1)
+        covered = any(
+            (part.start is None or part.start < end) and start < part.end for part in existing
+        )
+        if not covered:
+            missing.append((partition_name(start), start, end))
+    return missing
+
+
+def expired_partitions(
+    existing: list[Partition], today: date, retention_months: int
+) -> list[Partition]:
+    """Партиции, целиком старше retention_months полных месяцев до текущего"""
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(today, -retention_months)
+    return [part for part in existing if part.end <= cutoff]
+
+
+async def maintain_partitions(config: Config, today: date | None = None) -> bool:
+    """
+    Создать партиции messages заранее и отсоединить/удалить устаревшие
+
+    Выполняется одной транзакцией под advisory lock: при нескольких
+    репликах бота обслуживание делает только одна.
+
+    Args:
+        config: Конфигурация приложения
+        today: Текущая дата (для тестов)
+
+    Returns:
+        True, если обслуживание выполнено (False - messages не партиционирована
+        или блокировку держит другой процесс)
+    """
+    today = today or date.today()
+    async with session():
+        if not await try_advisory_lock(PARTITION_MAINTENANCE_LOCK_ID):
+            logger.debug("Partition maintenance is running in another process")
+            return False
+
+        rows = await list_message_partitions()
+        if rows is None:
+            logger.debug("Table messages is not partitioned, maintenance skipped")
+            return False
+        existing = [part for row in rows if (part := parse_partition(row["name"], row["bound"]))]
+
+        for name, start, end in missing_partitions(existing, today, config.partition_months_ahead):
+            await create_message_partition(name, start.isoformat(), end.isoformat())
+
+        for part in expired_partitions(existing, today, config.message_retention_months):
+            await detach_message_partition(part.name, drop=config.message_retention_drop)
+    return True
+
+
+async def run_partition_maintenance(config: Config) -> None:
+    """Периодическое обслуживание партиций (фоновая задача бота, до отмены)"""
+    while True:
+        try:
+            await maintain_partitions(config)
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
@@ -0,0 +1,97 @@
+"""Фоновая очистка удаленных сообщений: перенос в архив небольшими пачками
+
+Сообщения прошлых эпох очищенных диалогов (см. clear_conversation) сразу
+помечаются удаленными, soft-deleted сообщения старше периода ожидания
+удаляются (MESSAGE_PURGE_ENABLED).
+"""
+
+import asyncio
+import logging
+
+from config import Config
+from services.database import (
+    get_purge_lag,
+    purge_deleted_messages,
+    reclaim_cleared_messages,
+    session,
+)
+from services.metrics import MESSAGES_PURGE_LAG_SECONDS, MESSAGES_PURGED
+
+logger = logging.getLogger(__name__)
+
+
+async def reclaim_messages(config: Config) -> int:
+    """
+    Пометить удаленными сообщения прошлых эпох очищенных диалогов
+
+    Выполняется всегда, независимо от MESSAGE_PURGE_ENABLED: до этого
+    очищенная история учитывается запросами с условием deleted_at IS NULL
+    (статистика, аналитика) как активная.
+
+    Args:
+        config: Конфигурация приложения
+
+    Returns:
+        Количество помеченных строк
+    """
+    total = 0
+    while True:
+        async with session():
+            reclaimed = await reclaim_cleared_messages(config.message_purge_batch_size)
+        if reclaimed is None:
+            break
+        total += reclaimed
+        await asyncio.sleep(config.message_purge_batch_pause)
+
+    if total:
+        logger.info(f"Marked {total} messages of cleared conversations as deleted")
+    return total
+
+
+async def purge_messages(config: Config) -> int:
+    """
+    Один проход очистки: удалить (перенести в архив) все soft-deleted
+    сообщения старше периода ожидания
+
+    Каждая пачка - отдельная короткая транзакция, между пачками пауза, чтобы
+    не держать блокировки и не создавать всплесков WAL.
+
+    Args:
+        config: Конфигурация приложения
+
+    Returns:
+        Количество удаленных строк
+    """
+    grace = config.message_purge_grace_hours * 3600
+    action = "archived" if config.message_purge_archive else "deleted"
+    after = None
+    total = 0
+    while True:
+        async with session():
+            purged, after = await purge_deleted_messages(
+                grace, after, config.message_purge_batch_size, config.message_purge_archive
+            )
+        if after is None:
+            break
+        total += purged
+        MESSAGES_PURGED.inc(purged, action=action)
+        await asyncio.sleep(config.message_purge_batch_pause)
+
+    async with session():
+        MESSAGES_PURGE_LAG_SECONDS.set(await get_purge_lag(grace))
+
+    if total:
+        logger.info(f"Purged {total} deleted messages ({action})")
+    return total
+
+
+async def run_message_purge(config: Config) -> None:
+    """Периодическая очистка (фоновая задача бота, до отмены)"""
+    while True:
+        try:
+            await reclaim_messages(config)
+            if config.message_purge_enabled:
+                await purge_messages(config)
+        except Exception as e:
+            logger.error(f"Message purge failed: {e}")
+        await asyncio.sleep(config.message_purge_interval)
@@ -0,0 +1,258 @@
+"""Повторные попытки и circuit breaker для запросов к LLM"""
+
+import asyncio
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+from enum import StrEnum
+from typing import Protocol, TypeVar
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+from config import Config
+from constants import RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, RETRY_MIN_BUDGET
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Провайдер LLM признан недоступным, запрос не выполняется"""
+
+
+class CircuitState(StrEnum):
+    """Состояния circuit breaker"""
+
+    CLOSED = "closed"  # Запросы проходят
+    OPEN = "open"  # Запросы сразу отклоняются
+    HALF_OPEN = "half_open"  # Пропускается один пробный запрос
+
+
+class CircuitBreaker:
+    """Circuit breaker для провайдера LLM.
+
+    После failure_threshold подряд неудачных запросов (таймауты, ошибки
+    соединения, 5xx) переходит в состояние open и reset_timeout секунд
+    отклоняет запросы без обращения к провайдеру. Затем пропускает один
+    пробный запрос (half-open): успех закрывает breaker, ошибка снова
+    открывает его.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at: float | None = None
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        now = time.monotonic()
+        if self.state == CircuitState.OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = CircuitState.HALF_OPEN
+            self._probe_started_at = None
+            logger.info("Circuit breaker half-open: probing LLM provider")
+
+        if self.state == CircuitState.CLOSED:
+            return True
+
+        # Half-open: один пробный запрос (если он завис или отменен - новый через reset_timeout)
+        if self.state == CircuitState.HALF_OPEN and (
+            self._probe_started_at is None or now - self._probe_started_at >= self.reset_timeout
+        ):
+            self._probe_started_at = now
+            return True
+
+        self.rejected_total += 1
+        return False
+
+    def record_success(self) -> None:
+        """Провайдер ответил - закрыть breaker"""
+        if self.state != CircuitState.CLOSED:
+            logger.info("Circuit breaker closed: LLM provider recovered")
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._probe_started_at = None
+
+    def record_inconclusive(self) -> None:
+        """Ответ не говорит о состоянии провайдера - счетчик ошибок и состояние не меняются
+
+        429, ошибка запроса или таймаут из-за исчерпанного бюджета. В half-open
+        освобождается пробный запрос, чтобы провайдер проверил следующий.
+        """
+        self._probe_started_at = None
+
+    def record_failure(self) -> None:
+        """Провайдер не ответил - учесть ошибку и при необходимости открыть breaker"""
+        self._failures += 1
+        if self.state == CircuitState.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != CircuitState.OPEN:
+                self.opened_total += 1
+                logger.warning(
+                    f"Circuit breaker open: {self._failures} consecutive LLM failures, "
+                    f"retry in {self.reset_timeout}s"
+                )
+            self.state = CircuitState.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started_at = None
+
+    def stats(self) -> dict[str, object]:
+        """Метрики breaker: состояние, ошибки подряд, число открытий и отклоненных запросов"""
+        return {
+            "state": self.state.value,
+            "consecutive_failures": self._failures,
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+class BreakerTarget(Protocol):
+    """Цель запроса со своим circuit breaker (например, endpoint LLM)"""
+
+    breaker: CircuitBreaker
+
+
+E = TypeVar("E", bound=BreakerTarget)
+
+
+async def call_with_failover(
+    call: Callable[[E, float], Awaitable[T]],
+    config: Config,
+    pick: Callable[[list[E]], E | None],
+    deadline: float | None = None,
+) -> T:
+    """
+    Выполнить запрос к LLM с повторными попытками и переключением целей
+
+    Повторяются только временные ошибки (429, таймауты, ошибки соединения,
+    5xx), не более llm_max_retries раз. Если pick предлагает другую цель,
+    повтор идет на нее сразу; повтор на ту же цель - после паузы
+    (экспоненциальная с jitter или Retry-After от провайдера). Все попытки
+    укладываются в общий бюджет openai_timeout: каждая получает оставшееся
+    время, и повтор не выполняется, если после паузы остается меньше
+    RETRY_MIN_BUDGET секунд.
+
+    Breaker цели учитывает только ошибки провайдера. Таймаут попытки,
+    которой досталась лишь часть openai_timeout, вызван исчерпанием общего
+    бюджета и ошибкой не считается; 429 и ошибки запроса состояние breaker
+    не меняют.
+
+    Args:
+        call: Одна попытка запроса; принимает цель и таймаут в секундах
+        config: Конфигурация приложения
+        pick: Выбор цели с учетом уже неудачных (None - все цели недоступны);
+            отвечает за проверку breaker.allow()
+        deadline: Общий срок по time.monotonic() (None - openai_timeout от начала);
+            например, дубль запроса получает срок основного
+
+    Returns:
+        Результат успешной попытки
+
+    Raises:
+        CircuitOpenError: Все цели признаны недоступными
+        Exception: Ошибка последней попытки
+    """
+    if deadline is None:
+        deadline = time.monotonic() + config.openai_timeout
+    failed: list[E] = []
+    target = pick(failed)
+    if target is None:
+        raise CircuitOpenError("LLM provider circuit is open")
+
+    while True:
+        timeout = max(deadline - time.monotonic(), 0.0)
+        try:
+            result = await call(target, timeout)
+        except Exception as e:
+            if is_provider_failure(e) and not is_budget_timeout(e, timeout, config):
+                target.breaker.record_failure()
+            else:
+                target.breaker.record_inconclusive()
+
+            if not _is_retryable(e) or len(failed) >= config.llm_max_retries:
+                raise
+
+            failed.append(target)
+            next_target = pick(failed)
+            if next_target is None:
+                raise
+
+            delay = 0.0 if next_target is not target else _retry_delay(len(failed) - 1, e)
+            if delay + RETRY_MIN_BUDGET > deadline - time.monotonic():
+                logger.warning(
+                    f"LLM retry skipped: less than {RETRY_MIN_BUDGET}s of deadline budget "
+                    f"left after {delay:.2f}s delay"
+                )
+                raise
+
+            logger.warning(
+                f"LLM request failed ({type(e).__name__}), retry {len(failed)}/"
+                f"{config.llm_max_retries} in {delay:.2f}s"
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+            target = next_target
+            continue
+
+        target.breaker.record_success()
+        return result
+
+
+def _is_retryable(e: Exception) -> bool:
+    """Временная ошибка, которую имеет смысл повторить"""
+    if isinstance(e, RateLimitError | APIConnectionError):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409) or e.status_code >= 500
+    return False
+
+
+def is_provider_failure(e: Exception) -> bool:
+    """Ошибка, говорящая о недоступности провайдера (учитывается circuit breaker и роутером)"""
+    # APITimeoutError - подкласс APIConnectionError
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
+
+
+def is_budget_timeout(e: Exception, timeout: float, config: Config) -> bool:
+    """Таймаут попытки, которой достался не весь openai_timeout (исчерпан общий бюджет)
+
+    Такой таймаут не говорит о недоступности провайдера: попытка получила
+    меньше времени, чем положено одному запросу.
+    """
+    return isinstance(e, APITimeoutError) and timeout < config.openai_timeout - RETRY_MIN_BUDGET
+
+
+def _retry_delay(attempt: int, e: Exception) -> float:
+    """Пауза перед повтором: Retry-After провайдера или экспоненциальная с full jitter"""
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**attempt))
+
+
+def _retry_after(e: Exception) -> float | None:
+    """Retry-After из ответа провайдера в секундах (если есть)"""
+    if not isinstance(e, APIStatusError):
+        return None
+    headers = e.response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if isinstance(retry_after_ms, str):
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if isinstance(retry_after, str):
+        try:
+            return float(retry_after)
+        except ValueError:
+            # Формат HTTP-date не поддерживается - используем backoff
+            return None
+    return None
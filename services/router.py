@@ -0,0 +1,231 @@
+"""Маршрутизация запросов к LLM между несколькими endpoint'ами"""
+
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable
+from contextlib import AbstractAsyncContextManager, nullcontext
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+from config import Config
+from constants import ROUTER_ERROR_PENALTY, ROUTER_EWMA_ALPHA
+from services.resilience import (
+    CircuitBreaker,
+    CircuitState,
+    call_with_failover,
+    is_budget_timeout,
+    is_provider_failure,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass(eq=False)
+class LLMEndpoint:
+    """OpenAI-совместимый endpoint с моделью и скользящей статистикой"""
+
+    base_url: str
+    model: str
+    api_key: str
+    weight: float
+    breaker: CircuitBreaker
+    latency_ewma: float | None = None
+    error_rate: float = 0.0
+    inflight: int = 0
+    requests: int = 0
+    failures: int = 0
+    last_used: float = field(default=0.0, repr=False)
+
+    @property
+    def name(self) -> str:
+        """Имя для логов и метрик"""
+        return f"{self.model}@{self.base_url}"
+
+    def score(self) -> float:
+        """Ожидаемая стоимость запроса (меньше - лучше)
+
+        Скользящая задержка с учетом уже выполняющихся запросов и доли
+        ошибок, деленная на вес. Endpoint без замеров получает 0, чтобы
+        по нему появилась статистика.
+        """
+        if self.latency_ewma is None:
+            return 0.0
+        return (
+            self.latency_ewma
+            * (1 + self.inflight)
+            * (1 + ROUTER_ERROR_PENALTY * self.error_rate)
+            / self.weight
+        )
+
+
+class LLMRouter:
+    """Выбор лучшего доступного endpoint'а и переключение при ошибках.
+
+    Для каждого endpoint'а ведется EWMA задержки и доли ошибок и свой
+    circuit breaker. Запрос идет на endpoint с наименьшей оценкой среди
+    тех, чей breaker пропускает запросы; при временной ошибке повтор идет
+    на следующий по оценке endpoint.
+    """
+
+    def __init__(self, endpoints: list[LLMEndpoint]) -> None:
+        if not endpoints:
+            raise ValueError("LLM router requires at least one endpoint")
+        self.endpoints = endpoints
+
+    def pick(self, failed: list[LLMEndpoint]) -> LLMEndpoint | None:
+        """
+        Выбрать endpoint для попытки
+
+        Сначала рассматриваются endpoint'ы, на которых эта попытка еще не
+        падала; если таких не осталось, неудачные рассматриваются снова.
+
+        Args:
+            failed: Endpoint'ы, на которых запрос уже завершился ошибкой
+
+        Returns:
+            Endpoint или None, если все endpoint'ы недоступны
+        """
+        fresh = [ep for ep in self.endpoints if ep not in failed]
+        others = [ep for ep in self.endpoints if ep in failed]
+        # При равной оценке - тот, что дольше не использовался (равномерно по весам)
+        for group in (fresh, others):
+            for endpoint in sorted(group, key=lambda ep: (ep.score(), ep.last_used)):
+                if endpoint.breaker.allow():
+                    endpoint.last_used = time.monotonic()
+                    return endpoint
+        return None
+
+    async def call(
+        self,
+        fn: Callable[[LLMEndpoint, float], Awaitable[T]],
+        config: Config,
+        slot: Callable[[], AbstractAsyncContextManager[None]] | None = None,
+        deadline: float | None = None,
+    ) -> T:
+        """
+        Выполнить запрос на лучшем endpoint'е с повторами и переключением
+
+        Args:
+            fn: Одна попытка запроса к endpoint'у с таймаутом в секундах
+            config: Конфигурация приложения
+            slot: Слот планировщика на время одной попытки (опционально);
+                ожидание слота не входит в задержку endpoint'а
+            deadline: Общий срок всех попыток (см. call_with_failover)
+
+        Returns:
+            Результат успешной попытки
+        """
+
+        async def attempt(endpoint: LLMEndpoint, timeout: float) -> T:
+            async with slot() if slot else nullcontext():
+                endpoint.inflight += 1
+                started = time.monotonic()
+                try:
+                    result = await fn(endpoint, timeout)
+                except Exception as e:
+                    # Ошибки запроса (4xx) и таймаут из-за исчерпанного общего бюджета
+                    # не говорят о состоянии endpoint'а
+                    failed = is_provider_failure(e) and not is_budget_timeout(e, timeout, config)
+                    self._observe(endpoint, None, failed)
+                    raise
+                finally:
+                    endpoint.inflight -= 1
+                self._observe(endpoint, time.monotonic() - started, False)
+                return result
+
+        return await call_with_failover(attempt, config, self.pick, deadline)
+
+    def _observe(self, endpoint: LLMEndpoint, latency: float | None, failed: bool) -> None:
+        """Обновить скользящую статистику endpoint'а (latency=None - без замера задержки)"""
+        endpoint.requests += 1
+        endpoint.error_rate += ROUTER_EWMA_ALPHA * (float(failed) - endpoint.error_rate)
+        if failed:
+            endpoint.failures += 1
+        if latency is None:
+            return
+        if endpoint.latency_ewma is None:
+            endpoint.latency_ewma = latency
+        else:
+            endpoint.latency_ewma += ROUTER_EWMA_ALPHA * (latency - endpoint.latency_ewma)
+
+    def stats(self) -> list[dict[str, object]]:
+        """Метрики по endpoint'ам: задержка, доля ошибок, нагрузка и состояние breaker"""
+        return [
+            {
+                "endpoint": ep.name,
+                "weight": ep.weight,
+                "latency_ewma": round(ep.latency_ewma, 3) if ep.latency_ewma is not None else None,
+                "error_rate": round(ep.error_rate, 3),
+                "inflight": ep.inflight,
+                "requests": ep.requests,
+                "failures": ep.failures,
+                "healthy": ep.breaker.state != CircuitState.OPEN,
+                "circuit": ep.breaker.stats(),
+            }
+            for ep in self.endpoints
+        ]
+
+
+def parse_endpoints(config: Config) -> list[LLMEndpoint]:
+    """
+    Получить список endpoint'ов из конфигурации
+
+    LLM_ENDPOINTS - записи через запятую в формате
+    base_url|model|weight|API_KEY_ENV (все поля, кроме base_url, необязательны:
+    по умолчанию OPENAI_MODEL, вес 1 и OPENAI_API_KEY). Если LLM_ENDPOINTS
+    не задан, используется единственный endpoint OPENAI_BASE_URL/OPENAI_MODEL.
+
+    Raises:
+        ValueError: Некорректная запись или не задан ключ API
+    """
+    entries = [entry.strip() for entry in config.llm_endpoints.split(",") if entry.strip()]
+    if not entries:
+        entries = [config.openai_base_url]
+
+    endpoints = []
+    for entry in entries:
+        base_url, model, weight, key_env = (entry.split("|") + ["", "", "", ""])[:4]
+        api_key = os.getenv(key_env, "") if key_env else config.openai_api_key
+        if not api_key:
+            raise ValueError(f"{key_env or 'OPENAI_API_KEY'} не установлен в .env")
+        try:
+            weight_value = float(weight) if weight else 1.0
+        except ValueError as e:
+            raise ValueError(f"Некорректный вес endpoint'а в LLM_ENDPOINTS: {entry}") from e
+        if weight_value <= 0:
+            raise ValueError(f"Вес endpoint'а должен быть больше 0: {entry}")
+
+        endpoints.append(
+            LLMEndpoint(
+                base_url=base_url,
+                model=model or config.openai_model,
+                api_key=api_key,
+                weight=weight_value,
+                breaker=CircuitBreaker(
+                    failure_threshold=config.llm_circuit_threshold,
+                    reset_timeout=config.llm_circuit_reset_seconds,
+                ),
+            )
+        )
+    return endpoints
+
+
+_router: LLMRouter | None = None
+
+
+def get_router(config: Config) -> LLMRouter:
+    """Получить маршрутизатор LLM (singleton pattern)"""
+    global _router
+    if _router is None:
+        _router = LLMRouter(parse_endpoints(config))
+        logger.info(f"LLM router created: {', '.join(ep.name for ep in _router.endpoints)}")
+    return _router
+
+
+def _reset_router() -> None:
+    """Сбросить маршрутизатор (для тестов)."""
+    global _router
+    _router = None
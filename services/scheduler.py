@@ -0,0 +1,179 @@
+"""Планировщик конкурентных запросов к LLM с честной очередью"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from config import Config
+from constants import LLM_LANE_WEIGHTS, LLMPriority
+from services.metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(order=True)
+class _Waiter:
+    """Запрос в очереди (упорядочен по виртуальному времени завершения)"""
+
+    finish: float
+    seq: int
+    start: float = field(compare=False)
+    lane: LLMPriority = field(compare=False)
+    future: asyncio.Future[None] = field(compare=False)
+
+
+@dataclass
+class _LaneStats:
+    """Счетчики полосы для метрик"""
+
+    queued: int = 0
+    granted: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+class LLMScheduler:
+    """Ограничение числа одновременных запросов к LLM с weighted fair queueing.
+
+    Одновременно выполняется не более max_concurrency запросов. Остальные
+    ждут в очереди, упорядоченной по виртуальному времени (start-time fair
+    queueing): каждый поток (полоса, пользователь) получает долю слотов
+    пропорционально весу полосы, поэтому один активный пользователь или
+    фоновые задачи не вытесняют остальных.
+    """
+
+    def __init__(self, max_concurrency: int) -> None:
+        self.max_concurrency = max_concurrency
+        self._active = 0
+        self._queue: list[_Waiter] = []
+        self._virtual_time = 0.0
+        self._last_finish: dict[tuple[LLMPriority, int | None], float] = {}
+        self._seq = itertools.count()
+        self._lanes = {lane: _LaneStats() for lane in LLMPriority}
+        for lane in LLMPriority:
+            LLM_QUEUE_DEPTH.set(0, lane=lane.value)
+
+    @asynccontextmanager
+    async def slot(
+        self, user_id: int | None = None, priority: LLMPriority = LLMPriority.CHAT
+    ) -> AsyncIterator[None]:
+        """
+        Занять слот для запроса к LLM на время блока
+
+        Args:
+            user_id: Пользователь, от имени которого выполняется запрос
+            priority: Полоса запроса
+        """
+        await self._acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, user_id: int | None, priority: LLMPriority) -> None:
+        """Дождаться свободного слота в порядке очереди"""
+        flow = (priority, user_id)
+        start = max(self._virtual_time, self._last_finish.get(flow, 0.0))
+        finish = start + 1.0 / LLM_LANE_WEIGHTS[priority]
+        self._last_finish[flow] = finish
+        lane = self._lanes[priority]
+
+        if self._active < self.max_concurrency and not self._queue:
+            self._active += 1
+            self._virtual_time = start
+            lane.granted += 1
+            LLM_QUEUE_WAIT_SECONDS.observe(0.0, lane=priority.value)
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, _Waiter(finish, next(self._seq), start, priority, future))
+        self._set_queued(priority, +1)
+        enqueued_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но задача отменена - возвращаем его
+                self._release()
+            else:
+                future.cancel()
+                self._set_queued(priority, -1)
+            raise
+
+        waited = time.monotonic() - enqueued_at
+        lane.wait_seconds_total += waited
+        lane.wait_seconds_max = max(lane.wait_seconds_max, waited)
+        LLM_QUEUE_WAIT_SECONDS.observe(waited, lane=priority.value)
+        if waited > 1.0:
+            logger.info(f"LLM request waited {waited:.2f}s in {priority.value} queue")
+
+    def _release(self) -> None:
+        """Освободить слот и передать его следующему в очереди"""
+        self._active -= 1
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                # Ожидание было отменено
+                continue
+            self._set_queued(waiter.lane, -1)
+            self._lanes[waiter.lane].granted += 1
+            self._virtual_time = waiter.start
+            self._active += 1
+            waiter.future.set_result(None)
+            return
+
+        # Очередь пуста - забываем потоки, которые уже не опережают виртуальное время
+        self._last_finish = {
+            flow: finish
+            for flow, finish in self._last_finish.items()
+            if finish > self._virtual_time
+        }
+
+    def _set_queued(self, priority: LLMPriority, delta: int) -> None:
+        """Изменить глубину очереди полосы (и gauge llm_queue_depth)"""
+        lane = self._lanes[priority]
+        lane.queued += delta
+        LLM_QUEUE_DEPTH.set(lane.queued, lane=priority.value)
+
+    def saturated(self) -> bool:
+        """Все слоты заняты: новый запрос встанет в очередь"""
+        return self._active >= self.max_concurrency
+
+    def stats(self) -> dict[str, object]:
+        """Метрики планировщика: занятые слоты, глубина очереди и ожидание по полосам"""
+        return {
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "lanes": {
+                lane.value: {
+                    "queue_depth": stats.queued,
+                    "granted": stats.granted,
+                    "wait_seconds_total": round(stats.wait_seconds_total, 3),
+                    "wait_seconds_max": round(stats.wait_seconds_max, 3),
+                }
+                for lane, stats in self._lanes.items()
+            },
+        }
+
+
+_scheduler: LLMScheduler | None = None
+
+
+def get_scheduler(config: Config) -> LLMScheduler:
+    """Получить планировщик LLM (singleton pattern)"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler(max_concurrency=config.llm_max_concurrency)
+        logger.info(f"LLM scheduler created: max_concurrency={config.llm_max_concurrency}")
+    return _scheduler
+
+
+def _reset_scheduler() -> None:
+    """Сбросить планировщик (для тестов)."""
+    global _scheduler
+    _scheduler = None
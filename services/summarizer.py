@@ -0,0 +1,149 @@
+"""Фоновое сжатие длинных диалогов в краткое содержание"""
+
+import asyncio
+import contextvars
+import logging
+from typing import Any
+
+from config import Config
+from constants import PINNED_ROLES, LLMPriority, MessageRole
+from message_types import Message
+from roles.prompts import SUMMARY_PREFIX, PromptName, get_prompt
+from services.context import invalidate_context
+from services.database import load_conversation, replace_with_summary
+from services.llm import complete_chat
+from services.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Диалоги, для которых сейчас готовится краткое содержание
+_in_progress: set[tuple[int, int]] = set()
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_background_tasks: set[asyncio.Task[bool]] = set()
+
+_ROLE_NAMES = {MessageRole.USER.value: "Пользователь", MessageRole.ASSISTANT.value: "Ассистент"}
+
+
+def schedule_summary(user_id: int, chat_id: int, config: Config, messages: list[Message]) -> None:
+    """
+    Запустить сжатие диалога в фоне, не задерживая ответ пользователю
+
+    Порог проверяется по сообщениям, которые уже есть у вызывающего
+    (контекст хода из кэша), без обращения к БД: диалог загружается,
+    только если порог превышен.
+
+    Задача запускается с пустым контекстом переменных, чтобы не
+    унаследовать открытую сессию БД вызывающего кода.
+
+    Args:
+        user_id: ID пользователя в Telegram
+        chat_id: ID чата в Telegram
+        config: Конфигурация приложения
+        messages: Сообщения диалога после хода (контекст и новые сообщения)
+    """
+    if not config.summary_enabled or (user_id, chat_id) in _in_progress:
+        return
+
+    dialogue = [msg for msg in messages if msg["role"] not in PINNED_ROLES]
+    if not _over_threshold(
+        len(dialogue), sum(count_tokens(msg["content"]) for msg in dialogue), config
+    ):
+        return
+
+    task = asyncio.create_task(
+        summarize_conversation(user_id, chat_id, config), context=contextvars.Context()
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def summarize_conversation(user_id: int, chat_id: int, config: Config) -> bool:
+    """
+    Сжать старую часть диалога, если он превысил порог
+
+    Порог: диалог (без system) больше summary_trigger_tokens токенов или
+    достиг max_context_messages сообщений (дальше старые сообщения
+    удалялись бы при усечении). Последние summary_keep_messages сообщений
+    остаются как есть, остальные вместе с предыдущим кратким содержанием
+    заменяются новым кратким содержанием.
+
+    Args:
+        user_id: ID пользователя в Telegram
+        chat_id: ID чата в Telegram
+        config: Конфигурация приложения
+
+    Returns:
+        True, если краткое содержание сохранено
+    """
+    key = (user_id, chat_id)
+    if key in _in_progress:
+        return False
+
+    _in_progress.add(key)
+    try:
+        return await _summarize(user_id, chat_id, config)
+    except Exception as e:
+        logger.error(f"Summarization failed for user {user_id} in chat {chat_id}: {e}")
+        return False
+    finally:
+        _in_progress.discard(key)
+
+
+async def _summarize(user_id: int, chat_id: int, config: Config) -> bool:
+    """Сжать диалог (без защиты от параллельного запуска)"""
+    conversation = await load_conversation(user_id, chat_id, limit=100)
+    rows = conversation["messages"]
+
+    summaries = [row for row in rows if row["role"] == MessageRole.SUMMARY]
+    dialogue = [row for row in rows if row["role"] not in PINNED_ROLES]
+    dialogue_tokens = sum(_row_tokens(row) for row in dialogue)
+
+    if not _over_threshold(len(dialogue), dialogue_tokens, config):
+        return False
+
+    keep = max(config.summary_keep_messages, 0)
+    old_rows = dialogue[: len(dialogue) - keep]
+    if not old_rows:
+        return False
+
+    prompt = [
+        get_prompt(PromptName.SUMMARY).message,
+        {"role": MessageRole.USER, "content": _transcript(summaries, old_rows)},
+    ]
+    summary = await complete_chat(prompt, config, user_id=user_id, priority=LLMPriority.BACKGROUND)
+    if not summary:
+        logger.warning(f"Empty summary for user {user_id} in chat {chat_id}")
+        return False
+
+    stored = await replace_with_summary(
+        conversation["user_id"],
+        conversation["chat_id"],
+        [row["id"] for row in summaries + old_rows],
+        SUMMARY_PREFIX + summary,
+    )
+    invalidate_context(user_id, chat_id)
+
+    logger.info(
+        f"Conversation summarized for user {user_id} in chat {chat_id}: "
+        f"{len(old_rows)} messages ({dialogue_tokens} dialogue tokens), stored={stored is not None}"
+    )
+    return stored is not None
+
+
+def _over_threshold(messages: int, tokens: int, config: Config) -> bool:
+    """Превышен ли порог сжатия: число сообщений диалога или их токены (без system)"""
+    return messages >= config.max_context_messages or tokens > config.summary_trigger_tokens
+
+
+def _row_tokens(row: dict[str, Any]) -> int:
+    """Количество токенов сообщения (сохраненное или оценка по тексту)"""
+    tokens = row.get("tokens")
+    return tokens if tokens is not None else count_tokens(row["content"])
+
+
+def _transcript(summaries: list[dict[str, Any]], rows: list[dict[str, Any]]) -> str:
+    """Текст для сжатия: предыдущее краткое содержание и сообщения диалога"""
+    parts = [row["content"] for row in summaries]
+    parts += [f"{_ROLE_NAMES.get(row['role'], row['role'])}: {row['content']}" for row in rows]
+    return "\n\n".join(parts)
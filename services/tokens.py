@@ -0,0 +1,47 @@
+"""Оценка количества токенов и бюджет контекста модели"""
+
+from config import Config
+from constants import DEFAULT_CONTEXT_WINDOW, MESSAGE_TOKEN_OVERHEAD, MODEL_CONTEXT_WINDOWS
+
+
+def count_tokens(text: str) -> int:
+    """
+    Оценить количество токенов в тексте
+
+    Приближение без токенизатора: около 4 байт UTF-8 на токен. Для латиницы
+    это близко к BPE-токенизаторам OpenAI, для кириллицы оценка слегка
+    завышена (безопасно для бюджета). Та же формула используется в миграции
+    при заполнении messages.tokens для старых сообщений.
+
+    Args:
+        text: Текст сообщения
+
+    Returns:
+        Оценка количества токенов
+    """
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def message_tokens(content_tokens: int) -> int:
+    """Стоимость сообщения в контексте: токены текста + служебные токены роли"""
+    return content_tokens + MESSAGE_TOKEN_OVERHEAD
+
+
+def get_context_window(config: Config) -> int:
+    """
+    Получить размер окна контекста модели в токенах
+
+    Явное значение CONTEXT_WINDOW_TOKENS важнее таблицы известных моделей.
+    """
+    if config.context_window_tokens > 0:
+        return config.context_window_tokens
+    model = config.openai_model.lower()
+    for name, window in MODEL_CONTEXT_WINDOWS.items():
+        if name in model:
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def get_context_budget(config: Config) -> int:
+    """Бюджет токенов на сообщения запроса: окно модели минус место под ответ"""
+    return max(get_context_window(config) - config.max_tokens, 0)
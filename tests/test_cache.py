@@ -0,0 +1,49 @@
+"""Тесты для in-process кэшей"""
+
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.cache import TTLCache
+
+
+def test_cache_hit_and_miss():
+    """Тест подсчета попаданий и промахов"""
+    cache: TTLCache[str, int] = TTLCache(max_size=10, ttl=60)
+
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_cache_evicts_least_recently_used():
+    """Тест вытеснения давно не использовавшейся записи"""
+    cache: TTLCache[str, int] = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # "a" становится самой свежей, поэтому вытесняется "b"
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.evictions == 1
+
+
+def test_cache_expires_by_ttl():
+    """Тест истечения записи по TTL"""
+    cache: TTLCache[str, int] = TTLCache(max_size=10, ttl=5)
+
+    with patch("services.cache.time.monotonic", return_value=100.0):
+        cache.set("a", 1)
+    with patch("services.cache.time.monotonic", return_value=106.0):
+        assert cache.get("a") is None
+
+    assert len(cache) == 0
+    assert cache.evictions == 1
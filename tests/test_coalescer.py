@@ -0,0 +1,85 @@
+"""Тесты для объединения сообщений диалога"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.coalescer import MessageCoalescer, merge_user_messages
+
+
+@pytest.mark.asyncio
+async def test_coalescer_processes_single_message():
+    """Тест: одиночное сообщение обрабатывается сразу"""
+    coalescer: MessageCoalescer[str] = MessageCoalescer()
+    batches: list[list[str]] = []
+
+    async def process(batch: list[str]) -> None:
+        batches.append(batch)
+
+    await coalescer.submit("key", "hello", process)
+
+    assert batches == [["hello"]]
+    assert not coalescer.is_busy("key")
+
+
+@pytest.mark.asyncio
+async def test_coalescer_buffers_while_busy():
+    """Тест: сообщения во время обработки копятся и обрабатываются одной пачкой"""
+    coalescer: MessageCoalescer[str] = MessageCoalescer()
+    release = asyncio.Event()
+    batches: list[list[str]] = []
+
+    async def process(batch: list[str]) -> None:
+        batches.append(batch)
+        await release.wait()
+
+    task = asyncio.create_task(coalescer.submit("key", "a", process))
+    await asyncio.sleep(0)
+    await coalescer.submit("key", "b", process)
+    await coalescer.submit("key", "c", process)
+    # Другой диалог не блокируется
+    other = asyncio.create_task(coalescer.submit("other", "x", process))
+    await asyncio.sleep(0)
+
+    release.set()
+    await asyncio.gather(task, other)
+
+    assert ["a"] in batches
+    assert ["b", "c"] in batches
+    assert ["x"] in batches
+    assert len(batches) == 3
+
+
+@pytest.mark.asyncio
+async def test_coalescer_failed_batch_keeps_buffered_messages():
+    """Тест: ошибка обработки пачки не теряет сообщения, накопленные за это время"""
+    coalescer: MessageCoalescer[str] = MessageCoalescer()
+    release = asyncio.Event()
+    batches: list[list[str]] = []
+
+    async def process(batch: list[str]) -> None:
+        batches.append(batch)
+        if batch == ["a"]:
+            await release.wait()
+            raise RuntimeError("LLM error")
+
+    task = asyncio.create_task(coalescer.submit("key", "a", process))
+    await asyncio.sleep(0)
+    await coalescer.submit("key", "b", process)
+
+    release.set()
+    await task
+
+    assert batches == [["a"], ["b"]]
+    assert not coalescer.is_busy("key")
+
+
+def test_merge_user_messages():
+    """Тест объединения текстов сообщений"""
+    assert merge_user_messages(["Привет", None, "Как дела?"]) == "Привет\nКак дела?"
+    assert merge_user_messages(["Одно"]) == "Одно"
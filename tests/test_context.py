@@ -10,7 +10,69 @@ import pytest
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from constants import MessageRole
-from services.context import clear_context, get_context, save_context, trim_context
+from roles.prompts import PromptName, get_prompt
+from services.context import (
+    _clear_context_cache,
+    append_turn,
+    clear_context,
+    get_context,
+    get_context_cache_stats,
+    insert_after_system,
+    save_context,
+    trim_context,
+)
+from services.metrics import render_metrics
+
+# Последний номер сообщения по диалогам (conversations.last_seq) для mock append_messages
+_last_seqs: dict[tuple[int, int], int] = {}
+# Текст сохраненных сообщений по (user_id, chat_id, seq)
+_stored: dict[tuple[int, int, int], str] = {}
+
+
+async def _mock_append_messages(user_id, chat_id, messages, keep_last, first_seq=None):  # type: ignore[no-untyped-def]
+    """Mock для append_messages: возвращает вставленные строки, повтор хода пропускает"""
+    last_seq = _last_seqs.get((user_id, chat_id), 0)
+    start = last_seq + 1 if first_seq is None else first_seq
+    # Без хранения сообщений: номер first_seq занят этим же ходом, если совпадает content
+    if start <= last_seq and _stored.get((user_id, chat_id, start)) != messages[0]["content"]:
+        start = last_seq + 1
+    inserted = [
+        {"id": seq, "role": msg["role"], "content": msg["content"], "seq": seq}
+        for seq, msg in enumerate(messages, start=start)
+        if seq > last_seq
+    ]
+    for row in inserted:
+        _stored[(user_id, chat_id, row["seq"])] = row["content"]
+    if inserted:
+        _last_seqs[(user_id, chat_id)] = inserted[-1]["seq"]
+    return inserted
+
+
+def _conversation(
+    messages: list, prompt: tuple[str, int] | None = None, seq: int | None = None
+) -> dict:
+    """Результат load_conversation с заданными сообщениями (seq - по числу сообщений)"""
+    return {
+        "user_id": 1,
+        "chat_id": 1,
+        "messages": messages,
+        "prompt": prompt,
+        "seq": len(messages) if seq is None else seq,
+    }
+
+
+# Контекст нового диалога (результат get_context до первого хода)
+_NEW_CONTEXT = {"messages": [], "tokens": [], "seq": 0}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Очистка кэша контекста перед каждым тестом"""
+    _clear_context_cache()
+    _last_seqs.clear()
+    _stored.clear()
+    yield
+    _clear_context_cache()
 
 
 @pytest.mark.asyncio
@@ -19,11 +81,11 @@ async def test_get_context_empty():
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.get_messages", new=AsyncMock(return_value=[])),
+        patch("services.context.load_conversation", new=AsyncMock(return_value=_conversation([]))),
     ):
         result = await get_context(123, 456)
 
-    assert result == {"messages": []}
+    assert result == {"messages": [], "tokens": [], "seq": 0}
 
 
 @pytest.mark.asyncio
@@ -38,7 +100,7 @@ async def test_save_and_get_context():
     ]
     user_name = "Ivan"
 
-    # Mock для get_messages возвращает те же сообщения
+    # Mock для load_conversation возвращает те же сообщения
     db_messages = [
         {"id": 1, "role": "system", "content": "System prompt"},
         {"id": 2, "role": "user", "content": "Hello"},
@@ -48,11 +110,14 @@ async def test_save_and_get_context():
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.save_message", new=AsyncMock()),
-        patch("services.context.get_messages", new=AsyncMock(return_value=db_messages)),
+        patch("services.context.append_messages", new=_mock_append_messages),
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation(db_messages)),
+        ),
     ):
         # Сохраняем контекст
-        await save_context(user_id, chat_id, messages, user_name)
+        await save_context(user_id, chat_id, messages, user_name, context=_NEW_CONTEXT)
 
         # Получаем контекст
         result = await get_context(user_id, chat_id)
@@ -70,10 +135,10 @@ async def test_save_context_without_name():
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.save_message", new=AsyncMock()),
-        patch("services.context.get_messages", new=AsyncMock(return_value=[])),
+        patch("services.context.append_messages", new=_mock_append_messages),
+        patch("services.context.load_conversation", new=AsyncMock(return_value=_conversation([]))),
     ):
-        await save_context(user_id, chat_id, messages)
+        await save_context(user_id, chat_id, messages, context=_NEW_CONTEXT)
 
     # Тест прошел успешно если не было exception
 
@@ -84,17 +149,17 @@ async def test_clear_context():
     user_id = 111
     chat_id = 222
 
-    mock_soft_delete = AsyncMock()
+    mock_clear = AsyncMock()
 
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.soft_delete_messages", new=mock_soft_delete),
+        patch("services.context.clear_conversation", new=mock_clear),
     ):
         await clear_context(user_id, chat_id)
 
-    # Проверяем что soft_delete_messages был вызван
-    mock_soft_delete.assert_called_once_with(1, 1)
+    # Проверяем что clear_conversation был вызван
+    mock_clear.assert_called_once_with(1, 1)
 
 
 @pytest.mark.asyncio
@@ -103,7 +168,7 @@ async def test_clear_nonexistent_context():
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.soft_delete_messages", new=AsyncMock()),
+        patch("services.context.clear_conversation", new=AsyncMock()),
     ):
         # Очищаем контекст, которого нет - не должно упасть
         await clear_context(999, 888)
@@ -196,16 +261,16 @@ async def test_multiple_users_separate_contexts():
     """Тест раздельных контекстов для разных пользователей"""
 
     # Разные user_id возвращают разные db_user_id
-    async def mock_get_or_create_user(telegram_user_id: int, name: str):  # type: ignore[misc]
+    async def mock_get_or_create_user(telegram_user_id: int, name: str | None = None):  # type: ignore[misc]
         return telegram_user_id  # Просто возвращаем telegram_user_id как db_user_id
 
-    # Mock messages для разных пользователей
-    async def mock_get_messages(user_id: int, chat_id: int, limit: int = 10):  # type: ignore[misc]
+    # Mock загрузки диалога для разных пользователей
+    async def mock_load(user_id: int, chat_id: int, limit: int = 10):  # type: ignore[misc]
         if user_id == 1:
-            return [{"id": 1, "role": "user", "content": "User 1"}]
+            return _conversation([{"id": 1, "role": "user", "content": "User 1"}])
         elif user_id == 2:
-            return [{"id": 2, "role": "user", "content": "User 2"}]
-        return []
+            return _conversation([{"id": 2, "role": "user", "content": "User 2"}])
+        return _conversation([])
 
     with (
         patch("services.context.get_or_create_user", new=mock_get_or_create_user),
@@ -213,12 +278,16 @@ async def test_multiple_users_separate_contexts():
             "services.context.get_or_create_chat",
             new=AsyncMock(side_effect=[100, 200, 100, 200]),
         ),
-        patch("services.context.get_messages", new=mock_get_messages),
-        patch("services.context.save_message", new=AsyncMock()),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.append_messages", new=_mock_append_messages),
     ):
         # Сохраняем для пользователей
-        await save_context(1, 100, [{"role": MessageRole.USER, "content": "User 1"}], "Alice")
-        await save_context(2, 200, [{"role": MessageRole.USER, "content": "User 2"}], "Bob")
+        await save_context(
+            1, 100, [{"role": MessageRole.USER, "content": "User 1"}], "Alice", context=_NEW_CONTEXT
+        )
+        await save_context(
+            2, 200, [{"role": MessageRole.USER, "content": "User 2"}], "Bob", context=_NEW_CONTEXT
+        )
 
         # Получаем контексты
         context1 = await get_context(1, 100)
@@ -232,23 +301,27 @@ async def test_multiple_users_separate_contexts():
 async def test_same_user_different_chats():
     """Тест разных контекстов для одного пользователя в разных чатах"""
 
-    # Mock messages для разных чатов
-    async def mock_get_messages(user_id: int, chat_id: int, limit: int = 10):  # type: ignore[misc]
+    # Mock загрузки диалога для разных чатов
+    async def mock_load(user_id: int, chat_id: int, limit: int = 10):  # type: ignore[misc]
         if chat_id == 1:
-            return [{"id": 1, "role": "user", "content": "Chat 1"}]
+            return _conversation([{"id": 1, "role": "user", "content": "Chat 1"}])
         elif chat_id == 2:
-            return [{"id": 2, "role": "user", "content": "Chat 2"}]
-        return []
+            return _conversation([{"id": 2, "role": "user", "content": "Chat 2"}])
+        return _conversation([])
 
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=100)),
         patch("services.context.get_or_create_chat", new=AsyncMock(side_effect=[1, 2, 1, 2])),
-        patch("services.context.get_messages", new=mock_get_messages),
-        patch("services.context.save_message", new=AsyncMock()),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.append_messages", new=_mock_append_messages),
     ):
         # Сохраняем для разных чатов
-        await save_context(100, 1, [{"role": MessageRole.USER, "content": "Chat 1"}])
-        await save_context(100, 2, [{"role": MessageRole.USER, "content": "Chat 2"}])
+        await save_context(
+            100, 1, [{"role": MessageRole.USER, "content": "Chat 1"}], context=_NEW_CONTEXT
+        )
+        await save_context(
+            100, 2, [{"role": MessageRole.USER, "content": "Chat 2"}], context=_NEW_CONTEXT
+        )
 
         # Получаем контексты
         context1 = await get_context(100, 1)
@@ -264,33 +337,460 @@ async def test_context_update():
     user_id = 500
     chat_id = 600
 
-    # Первый вызов get_messages возвращает 1 сообщение, второй - 2
-    get_messages_calls = [
-        [],  # Первый save_context
-        [{"id": 1, "role": "user", "content": "First"}],  # Второй save_context
-        [  # get_context
-            {"id": 1, "role": "user", "content": "First"},
-            {"id": 2, "role": "assistant", "content": "Response"},
-        ],
-    ]
+    # load_conversation вызывается только из get_context: сохранение историю не читает
+    mock_load = AsyncMock(
+        return_value=_conversation(
+            [
+                {"id": 1, "role": "user", "content": "First"},
+                {"id": 2, "role": "assistant", "content": "Response"},
+            ]
+        )
+    )
+    mock_append = AsyncMock(side_effect=_mock_append_messages)
+    _last_seqs[(1, 1)] = 2
 
     with (
         patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
         patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
-        patch("services.context.get_messages", new=AsyncMock(side_effect=get_messages_calls)),
-        patch("services.context.save_message", new=AsyncMock()),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.append_messages", new=mock_append),
     ):
-        # Первое сохранение
-        await save_context(user_id, chat_id, [{"role": MessageRole.USER, "content": "First"}])
+        context = await get_context(user_id, chat_id)
 
         # Обновление контекста
-        new_messages = [
-            {"role": MessageRole.USER, "content": "First"},
-            {"role": MessageRole.ASSISTANT, "content": "Response"},
+        new_messages = context["messages"] + [
+            {"role": MessageRole.USER, "content": "Second"},
+            {"role": MessageRole.ASSISTANT, "content": "Response 2"},
         ]
-        await save_context(user_id, chat_id, new_messages, "Updated User")
+        await save_context(user_id, chat_id, new_messages, "Updated User", context=context)
 
         # Получаем обновленный контекст
         result = await get_context(user_id, chat_id)
 
-    assert len(result["messages"]) == 2
+    assert len(result["messages"]) == 4
+    assert result["seq"] == 4
+    mock_load.assert_called_once()
+    # Сохраняются только новые сообщения, с номера после контекста
+    assert mock_append.call_args.args[2] == new_messages[2:]
+    assert mock_append.call_args.kwargs["first_seq"] == 3
+
+
+@pytest.mark.asyncio
+async def test_save_context_repeat_is_idempotent():
+    """Тест: повторное сохранение того же списка не дублирует сообщения"""
+    messages = [
+        {"role": MessageRole.USER, "content": "Q"},
+        {"role": MessageRole.ASSISTANT, "content": "A"},
+    ]
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation([])),
+        ),
+        patch("services.context.append_messages", new=_mock_append_messages),
+    ):
+        context = await get_context(123, 456)
+        await save_context(123, 456, messages, context=context)
+        # Повтор (например, после ошибки сети) ничего не добавляет
+        await save_context(123, 456, messages, context=context)
+        context = await get_context(123, 456)
+        await save_context(
+            123,
+            456,
+            context["messages"] + [{"role": MessageRole.USER, "content": "Q2"}],
+            context=context,
+        )
+        result = await get_context(123, 456)
+
+    assert [m["content"] for m in result["messages"]] == ["Q", "A", "Q2"]
+    assert result["seq"] == 3
+
+
+@pytest.mark.asyncio
+async def test_save_context_after_trimmed_history():
+    """Тест: длинный диалог (last_seq больше числа сообщений в контексте) не теряет новый ход"""
+    history = [
+        {"id": i, "role": "user" if i % 2 else "assistant", "content": f"M{i}"}
+        for i in range(6, 21)
+    ]
+    _last_seqs[(1, 1)] = 20
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation(history, seq=20)),
+        ),
+        patch("services.context.append_messages", new=_mock_append_messages),
+    ):
+        context = await get_context(123, 456)
+        turn = [
+            {"role": MessageRole.USER, "content": "Q"},
+            {"role": MessageRole.ASSISTANT, "content": "A"},
+        ]
+        await save_context(123, 456, context["messages"] + turn, context=context)
+        result = await get_context(123, 456)
+
+    assert [m["content"] for m in result["messages"]][-2:] == ["Q", "A"]
+    assert result["seq"] == 22
+
+
+@pytest.mark.asyncio
+async def test_append_turn_concurrent_writer_invalidates_cache():
+    """Тест: номер хода занят другим процессом - ход сохраняется следом, кэш сбрасывается"""
+    mock_load = AsyncMock(return_value=_conversation([]))
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.append_messages", new=_mock_append_messages),
+    ):
+        context = await get_context(123, 456)
+        # Другой процесс записал свой ход после загрузки контекста
+        await _mock_append_messages(1, 1, [{"role": "user", "content": "Other"}], keep_last=15)
+        await append_turn(
+            123,
+            456,
+            [{"role": MessageRole.USER, "content": "Q"}],
+            first_seq=context["seq"] + 1,
+        )
+        await get_context(123, 456)
+
+    assert _stored == {(1, 1, 1): "Other", (1, 1, 2): "Q"}
+    # Кэш устарел и загружен заново
+    assert mock_load.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_context_served_from_cache():
+    """Тест повторной загрузки контекста из кэша без обращения к БД"""
+    db_messages = [{"id": 1, "role": "user", "content": "Hello"}]
+    mock_load = AsyncMock(return_value=_conversation(db_messages))
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch("services.context.load_conversation", new=mock_load),
+    ):
+        first = await get_context(123, 456)
+        second = await get_context(123, 456)
+
+    assert first == second
+    mock_load.assert_called_once()
+    stats = get_context_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    metrics = render_metrics()
+    assert 'cache_requests_total{cache="context",result="hit"} 1' in metrics
+    assert 'cache_hit_ratio{cache="context"} 0.5' in metrics
+
+
+@pytest.mark.asyncio
+async def test_steady_state_turn_makes_no_selects():
+    """Тест: после первой загрузки ход диалога не читает messages из БД"""
+    mock_load = AsyncMock(return_value=_conversation([]))
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.append_messages", new=_mock_append_messages),
+    ):
+        context = await get_context(123, 456)
+        messages = context["messages"] + [
+            {"role": MessageRole.USER, "content": "Q1"},
+            {"role": MessageRole.ASSISTANT, "content": "A1"},
+        ]
+        await save_context(123, 456, messages, context=context)
+
+        context = await get_context(123, 456)
+        messages = context["messages"] + [
+            {"role": MessageRole.USER, "content": "Q2"},
+            {"role": MessageRole.ASSISTANT, "content": "A2"},
+        ]
+        await save_context(123, 456, messages, context=context)
+
+        result = await get_context(123, 456)
+
+    # Единственный SELECT - при первой загрузке
+    mock_load.assert_called_once()
+    assert [m["content"] for m in result["messages"]] == ["Q1", "A1", "Q2", "A2"]
+
+
+@pytest.mark.asyncio
+async def test_clear_context_updates_cache():
+    """Тест: после очистки кэш возвращает пустой контекст без обращения к БД"""
+    mock_load = AsyncMock(return_value=_conversation([{"id": 1, "role": "user", "content": "Old"}]))
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch("services.context.load_conversation", new=mock_load),
+        patch("services.context.clear_conversation", new=AsyncMock()),
+    ):
+        await get_context(123, 456)
+        await clear_context(123, 456)
+        result = await get_context(123, 456)
+
+    assert result == {"messages": [], "tokens": [], "seq": 0}
+    mock_load.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_append_turn_single_call():
+    """Тест: ход диалога сохраняется одним вызовом append_messages"""
+    mock_append = AsyncMock(side_effect=_mock_append_messages)
+    turn = [
+        {"role": MessageRole.USER, "content": "Q"},
+        {"role": MessageRole.ASSISTANT, "content": "A"},
+    ]
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=2)),
+        patch("services.context.append_messages", new=mock_append),
+    ):
+        await append_turn(123, 456, turn, "Ivan", max_context_messages=5)
+
+    mock_append.assert_called_once_with(1, 2, turn, keep_last=5, first_seq=None)
+
+
+@pytest.mark.asyncio
+async def test_append_turn_trims_cached_context():
+    """Тест: кэш усекается так же, как история в БД (system сохраняется)"""
+    db_messages = [
+        {"id": 1, "role": "system", "content": "System"},
+        {"id": 2, "role": "user", "content": "Q1"},
+        {"id": 3, "role": "assistant", "content": "A1"},
+    ]
+    _last_seqs[(1, 1)] = 3
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=1)),
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation(db_messages)),
+        ),
+        patch("services.context.append_messages", new=_mock_append_messages),
+    ):
+        await get_context(123, 456)
+        await append_turn(
+            123,
+            456,
+            [
+                {"role": MessageRole.USER, "content": "Q2"},
+                {"role": MessageRole.ASSISTANT, "content": "A2"},
+            ],
+            max_context_messages=2,
+        )
+        result = await get_context(123, 456)
+
+    assert [m["content"] for m in result["messages"]] == ["System", "Q2", "A2"]
+
+
+@pytest.mark.asyncio
+async def test_get_context_resolves_prompt_reference():
+    """Тест: текст system prompt подставляется из реестра по имени и версии из БД"""
+    prompt = get_prompt(PromptName.CHAT)
+    db_messages = [{"id": 7, "role": "user", "content": "Hello", "tokens": 2}]
+
+    with patch(
+        "services.context.load_conversation",
+        new=AsyncMock(return_value=_conversation(db_messages, ("chat", prompt.version))),
+    ):
+        result = await get_context(123, 456)
+
+    assert result["messages"] == [prompt.message, {"role": "user", "content": "Hello"}]
+    assert result["tokens"] == [prompt.tokens, 6]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "db_messages,expected",
+    [
+        # Диалог без ссылки на промпт (очищен во время ответа) - текущий промпт
+        ([{"id": 1, "role": "user", "content": "Q"}], ["PROMPT", "Q"]),
+        # Промпт сохранен в messages (диалоги до реестра промптов) - не дублируется
+        (
+            [
+                {"id": 1, "role": "system", "content": "Stored"},
+                {"id": 2, "role": "user", "content": "Q"},
+            ],
+            ["Stored", "Q"],
+        ),
+        # Новый диалог остается пустым: промпт добавляет и сохраняет обработчик
+        ([], []),
+    ],
+)
+async def test_get_context_default_prompt(db_messages, expected):
+    """Тест: default_prompt подставляется только в начатый диалог без system prompt"""
+    prompt = get_prompt(PromptName.CHAT)
+
+    with patch(
+        "services.context.load_conversation",
+        new=AsyncMock(return_value=_conversation(db_messages)),
+    ):
+        result = await get_context(123, 456, default_prompt=prompt)
+
+    contents = [
+        "PROMPT" if m["content"] == prompt.content else m["content"] for m in result["messages"]
+    ]
+    assert contents == expected
+
+
+@pytest.mark.asyncio
+async def test_append_turn_stores_prompt_reference():
+    """Тест: новый диалог сохраняет только ссылку на system prompt, а не его текст"""
+    prompt = get_prompt(PromptName.CHAT)
+    mock_append = AsyncMock(side_effect=_mock_append_messages)
+    mock_set_prompt = AsyncMock()
+    turn = [
+        {"role": MessageRole.USER, "content": "Q"},
+        {"role": MessageRole.ASSISTANT, "content": "A"},
+    ]
+
+    with (
+        patch("services.context.get_or_create_user", new=AsyncMock(return_value=1)),
+        patch("services.context.get_or_create_chat", new=AsyncMock(return_value=2)),
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation([])),
+        ),
+        patch("services.context.append_messages", new=mock_append),
+        patch("services.context.set_conversation_prompt", new=mock_set_prompt),
+    ):
+        await get_context(123, 456)
+        await append_turn(123, 456, turn, max_context_messages=1, prompt=prompt)
+        result = await get_context(123, 456)
+
+    mock_set_prompt.assert_called_once_with(1, 2, "chat", prompt.version)
+    mock_append.assert_called_once_with(1, 2, turn, keep_last=1, first_seq=None)
+    # Prompt закреплен в начале кэша и не вытесняется при усечении
+    assert result["messages"] == [prompt.message, {"role": "assistant", "content": "A"}]
+
+
+def test_insert_after_system():
+    """Тест: сообщение вставляется после system-блока в начале контекста"""
+    messages = [
+        {"role": MessageRole.SYSTEM, "content": "System"},
+        {"role": MessageRole.SYSTEM, "content": "Summary"},
+        {"role": MessageRole.USER, "content": "Q"},
+    ]
+    profile = {"role": MessageRole.SYSTEM, "content": "Имя пользователя: Иван"}
+
+    result = insert_after_system(messages, profile)
+
+    assert [m["content"] for m in result] == ["System", "Summary", "Имя пользователя: Иван", "Q"]
+    # Исходный список не меняется
+    assert len(messages) == 3
+
+
+def test_trim_context_by_token_budget():
+    """Тест усечения по бюджету токенов: system + новые сообщения, влезающие в бюджет"""
+    messages = [
+        {"role": MessageRole.SYSTEM, "content": "System"},
+        {"role": MessageRole.USER, "content": "Old"},
+        {"role": MessageRole.ASSISTANT, "content": "Huge log"},
+        {"role": MessageRole.USER, "content": "Q"},
+        {"role": MessageRole.ASSISTANT, "content": "A"},
+        {"role": MessageRole.USER, "content": "Current"},
+    ]
+    tokens = [10, 5, 500, 5, 5, 5]
+
+    result = trim_context(messages, max_messages=10, token_budget=100, tokens=tokens)
+
+    # Большое сообщение не влезает - оно и все более старые отбрасываются
+    assert [m["content"] for m in result] == ["System", "Q", "A", "Current"]
+
+
+def test_trim_context_by_token_budget_respects_max_messages():
+    """Тест: при большом бюджете действует ограничение по количеству сообщений"""
+    messages = [
+        {"role": MessageRole.SYSTEM, "content": "System"},
+        *[{"role": MessageRole.USER, "content": f"Message {i}"} for i in range(20)],
+    ]
+
+    result = trim_context(messages, max_messages=5, token_budget=100000)
+
+    assert len(result) == 6
+    assert result[0]["role"] == MessageRole.SYSTEM
+    assert result[-1]["content"] == "Message 19"
+
+
+def test_trim_context_by_token_budget_keeps_current_message():
+    """Тест: текущее сообщение сохраняется, даже если превышает бюджет"""
+    messages = [
+        {"role": MessageRole.SYSTEM, "content": "System"},
+        {"role": MessageRole.USER, "content": "Old"},
+        {"role": MessageRole.USER, "content": "Pasted log"},
+    ]
+
+    result = trim_context(messages, max_messages=10, token_budget=50, tokens=[10, 5, 1000])
+
+    assert [m["content"] for m in result] == ["System", "Pasted log"]
+
+
+@pytest.mark.asyncio
+async def test_get_context_returns_stored_token_counts():
+    """Тест: get_context возвращает сохраненные счетчики токенов без пересчета"""
+    db_messages = [
+        {"id": 1, "role": "system", "content": "Prompt", "tokens": 30},
+        {"id": 2, "role": "user", "content": "Hello", "tokens": 2},
+    ]
+
+    with (
+        patch(
+            "services.context.load_conversation",
+            new=AsyncMock(return_value=_conversation(db_messages)),
+        ),
+        patch("services.context.count_tokens") as mock_count,
+    ):
+        result = await get_context(123, 456)
+
+    mock_count.assert_not_called()
+    # К токенам текста добавляются служебные токены сообщения
+    assert result["tokens"] == [34, 6]
+
+
+@pytest.mark.asyncio
+async def test_get_context_puts_summary_after_system_prompt():
+    """Тест: краткое содержание передается модели как system сразу после system prompt"""
+    db_messages = [
+        {"id": 1, "role": "system", "content": "Prompt", "tokens": 2},
+        {"id": 5, "role": "user", "content": "Recent", "tokens": 2},
+        {"id": 6, "role": "summary", "content": "Summary", "tokens": 2},
+    ]
+
+    with patch(
+        "services.context.load_conversation",
+        new=AsyncMock(return_value=_conversation(db_messages)),
+    ):
+        result = await get_context(123, 456)
+
+    assert result["messages"] == [
+        {"role": MessageRole.SYSTEM, "content": "Prompt"},
+        {"role": MessageRole.SYSTEM, "content": "Summary"},
+        {"role": "user", "content": "Recent"},
+    ]
+
+
+def test_trim_context_keeps_leading_system_messages():
+    """Тест: system prompt и краткое содержание не удаляются при усечении"""
+    messages = [
+        {"role": MessageRole.SYSTEM, "content": "System prompt"},
+        {"role": MessageRole.SYSTEM, "content": "Summary"},
+        *[{"role": MessageRole.USER, "content": f"Message {i}"} for i in range(20)],
+    ]
+
+    result = trim_context(messages, max_messages=5)
+    assert [m["content"] for m in result[:2]] == ["System prompt", "Summary"]
+    assert len(result) == 7
+
+    result = trim_context(messages, max_messages=5, token_budget=30, tokens=[10] * len(messages))
+    assert [m["content"] for m in result] == ["System prompt", "Summary", "Message 19"]
@@ -9,6 +9,17 @@ import pytest
 # Добавляем корневую директорию проекта в путь
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from services.database import _clear_id_cache
+from services.metrics import render_metrics
+
+
+@pytest.fixture(autouse=True)
+def clear_id_cache():
+    """Очистка кэша соответствия ID перед каждым тестом"""
+    _clear_id_cache()
+    yield
+    _clear_id_cache()
+
 
 @pytest.mark.asyncio
 async def test_get_or_create_user_new():
@@ -21,7 +32,7 @@ async def test_get_or_create_user_new():
     mock_cursor = AsyncMock()
 
     # Настройка мок cursor
-    mock_cursor.fetchone = AsyncMock(return_value={"id": 42})
+    mock_cursor.fetchone = AsyncMock(return_value={"id": 42, "first_name": "John"})
     mock_cursor.execute = AsyncMock()
     mock_cursor.__aenter__ = AsyncMock(return_value=mock_cursor)
     mock_cursor.__aexit__ = AsyncMock()
@@ -95,7 +106,7 @@ async def test_save_message():
     # Проверяем что execute был вызван с правильными параметрами
     call_args = mock_cursor.execute.call_args
     assert "Hello world" in str(call_args)
-    assert 11 in call_args[0][1]  # length = len("Hello world") = 11
+    assert call_args[0][1]["length"] == 11  # length = len("Hello world") = 11
 
 
 @pytest.mark.asyncio
@@ -160,9 +171,9 @@ async def test_get_messages_with_data():
 
 
 @pytest.mark.asyncio
-async def test_soft_delete_messages():
-    """Тест soft delete сообщений"""
-    from services.database import soft_delete_messages
+async def test_clear_conversation():
+    """Тест: очистка диалога - одна запись в conversations, сообщения не обновляются"""
+    from services.database import clear_conversation
 
     mock_pool = MagicMock()
     mock_conn = AsyncMock()
@@ -179,10 +190,450 @@ async def test_soft_delete_messages():
     mock_pool.connection = MagicMock(return_value=mock_conn)
 
     with patch("services.database.get_pool", return_value=mock_pool):
-        await soft_delete_messages(1, 2)
+        await clear_conversation(1, 2)
 
-    # Проверяем что UPDATE был вызван
     mock_cursor.execute.assert_called_once()
-    call_args = mock_cursor.execute.call_args
-    assert "UPDATE messages" in str(call_args)
-    assert "deleted_at" in str(call_args)
+    query = mock_cursor.execute.call_args.args[0]
+    assert "INSERT INTO conversations" in query
+    assert "epoch = conversations.epoch + 1" in query
+    assert "messages" not in query
+    # Ссылка на system prompt сбрасывается тем же запросом
+    assert "prompt_name = NULL" in query
+
+
+@pytest.mark.asyncio
+async def test_set_conversation_prompt():
+    """Тест сохранения ссылки на system prompt диалога (upsert)"""
+    from services.database import set_conversation_prompt
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        await set_conversation_prompt(1, 2, "chat", 2)
+
+    mock_cursor.execute.assert_called_once()
+    query, params = mock_cursor.execute.call_args.args
+    assert "INSERT INTO conversations" in query
+    assert "ON CONFLICT (user_id, chat_id)" in query
+    assert params == (1, 2, "chat", 2)
+
+
+def _make_mock_pool(fetchone_results: list) -> tuple[MagicMock, AsyncMock]:
+    """Создать mock pool, cursor которого возвращает fetchone_results по очереди"""
+    mock_pool = MagicMock()
+    mock_conn = AsyncMock()
+    mock_cursor = AsyncMock()
+
+    mock_cursor.fetchone = AsyncMock(side_effect=fetchone_results)
+    mock_cursor.execute = AsyncMock()
+    mock_cursor.__aenter__ = AsyncMock(return_value=mock_cursor)
+    mock_cursor.__aexit__ = AsyncMock()
+
+    mock_conn.cursor = MagicMock(return_value=mock_cursor)
+    mock_conn.__aenter__ = AsyncMock(return_value=mock_conn)
+    mock_conn.__aexit__ = AsyncMock()
+
+    mock_pool.connection = MagicMock(return_value=mock_conn)
+    return mock_pool, mock_cursor
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_cached():
+    """Тест: повторное разрешение ID пользователя не обращается к БД"""
+    from services.database import get_or_create_user
+
+    mock_pool, mock_cursor = _make_mock_pool([{"id": 42, "first_name": "John"}])
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        first = await get_or_create_user(123456, "John")
+        second = await get_or_create_user(123456, "John")
+        # Без имени - используем сохраненное
+        third = await get_or_create_user(123456)
+
+    assert first == second == third == 42
+    mock_cursor.execute.assert_called_once()
+    metrics = render_metrics()
+    assert 'cache_requests_total{cache="user_id",result="hit"} 2' in metrics
+    assert 'cache_size{cache="chat_id"} 0' in metrics
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_name_changed():
+    """Тест: изменение имени приводит к записи в БД"""
+    from services.database import get_or_create_user
+
+    mock_pool, mock_cursor = _make_mock_pool(
+        [{"id": 42, "first_name": "John"}, {"id": 42, "first_name": "Johnny"}]
+    )
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        await get_or_create_user(123456, "John")
+        result = await get_or_create_user(123456, "Johnny")
+
+    assert result == 42
+    assert mock_cursor.execute.call_count == 2
+    assert mock_cursor.execute.call_args[0][1]["name"] == "Johnny"
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_chat_single_flight():
+    """Тест: конкурентные промахи по одному чату выполняют один запрос"""
+    import asyncio
+
+    from services.database import get_or_create_chat
+
+    mock_pool, mock_cursor = _make_mock_pool([{"id": 100}])
+
+    async def slow_execute(*args, **kwargs):  # type: ignore[no-untyped-def]
+        await asyncio.sleep(0.01)
+
+    mock_cursor.execute = AsyncMock(side_effect=slow_execute)
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        results = await asyncio.gather(*(get_or_create_chat(789012) for _ in range(5)))
+
+    assert results == [100] * 5
+    mock_cursor.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_append_messages_single_statement():
+    """Тест: вставка хода и усечение выполняются одним запросом"""
+    from services.database import append_messages
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        return_value=[
+            {
+                "id": 10,
+                "role": "user",
+                "content": "Hello",
+                "tokens": 2,
+                "seq": 5,
+                "trimmed_count": 2,
+            },
+            {
+                "id": 11,
+                "role": "assistant",
+                "content": "Hi!",
+                "tokens": 1,
+                "seq": 6,
+                "trimmed_count": 2,
+            },
+        ]
+    )
+    messages = [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi!"},
+    ]
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        result = await append_messages(1, 2, messages, keep_last=10)
+
+    assert result == [
+        {"id": 10, "role": "user", "content": "Hello", "tokens": 2, "seq": 5},
+        {"id": 11, "role": "assistant", "content": "Hi!", "tokens": 1, "seq": 6},
+    ]
+    mock_cursor.execute.assert_called_once()
+    query, params = mock_cursor.execute.call_args[0]
+    assert "INSERT INTO messages" in query
+    assert "ROW_NUMBER()" in query
+    assert params["lengths"] == [5, 3]
+    # Токены считаются один раз при вставке и сохраняются в БД
+    assert params["tokens"] == [2, 1]
+    # Из существующих остается keep_last минус новые не-system (считается в запросе)
+    assert params["keep_last"] == 10
+    # Номера выделяются в том же запросе: следующие 2 после conversations.last_seq
+    assert "ON CONFLICT (user_id, chat_id) DO UPDATE" in query
+    assert params["first_seq"] is None
+    assert params["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_append_messages_explicit_seq_single_statement():
+    """Тест: с заданными номерами проверка повтора и вставка - тот же один запрос"""
+    from services.database import append_messages
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        return_value=[
+            {"id": 12, "role": "user", "content": "Q2", "tokens": 1, "seq": 5, "trimmed_count": 0}
+        ]
+    )
+    messages = [
+        {"role": "user", "content": "Q1"},
+        {"role": "assistant", "content": "A1"},
+        {"role": "user", "content": "Q2"},
+    ]
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        result = await append_messages(1, 2, messages, keep_last=10, first_seq=3)
+
+    # Уже сохраненные Q1 и A1 (номера 3, 4) не вернулись - вставлен только Q2
+    assert [row["seq"] for row in result] == [5]
+    mock_cursor.execute.assert_called_once()
+    query, params = mock_cursor.execute.call_args[0]
+    assert params["first_seq"] == 3
+    assert params["count"] == 3
+    # Проверяется каждый номер хода, включая усеченные сообщения
+    stored = query[query.index("stored AS") : query.index("claimed AS")]
+    assert "m.seq = t.planned" in stored
+    assert "deleted_at IS NULL" not in stored
+
+
+@pytest.mark.asyncio
+async def test_append_messages_repeat_is_noop():
+    """Тест: повтор уже сохраненной записи ничего не вставляет"""
+    from services.database import append_messages
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(return_value=[])
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        result = await append_messages(
+            1, 2, [{"role": "user", "content": "Q1"}], keep_last=10, first_seq=1
+        )
+
+    assert result == []
+    mock_cursor.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_append_messages_with_usage():
+    """Тест: замеры LLM ответа сохраняются в llm_usage тем же запросом"""
+    from services.database import append_messages
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(return_value=[])
+    usage = {
+        "model": "m",
+        "endpoint": "https://a",
+        "latency_ms": 1500,
+        "prompt_tokens": 120,
+        "completion_tokens": None,
+    }
+    messages = [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi!", "usage": usage},
+    ]
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        await append_messages(1, 2, messages, keep_last=10)
+
+    mock_cursor.execute.assert_called_once()
+    query, params = mock_cursor.execute.call_args[0]
+    assert "INSERT INTO llm_usage" in query
+    # Замеры выровнены по сообщениям хода, у сообщения без замеров - NULL
+    assert params["models"] == [None, "m"]
+    assert params["endpoints"] == [None, "https://a"]
+    assert params["latencies"] == [None, 1500]
+    assert params["prompt_tokens"] == [None, 120]
+    assert params["completion_tokens"] == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_load_conversation_single_query():
+    """Тест: пользователь, чат и сообщения загружаются одним запросом"""
+    from services.database import get_or_create_chat, get_or_create_user, load_conversation
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        return_value=[
+            {
+                "user_id": 7,
+                "chat_id": 8,
+                "prompt_name": "chat",
+                "prompt_version": 2,
+                "last_seq": 2,
+                "message_id": 1,
+                "role": "user",
+                "content": "Hello",
+                "tokens": 2,
+            },
+            {
+                "user_id": 7,
+                "chat_id": 8,
+                "prompt_name": "chat",
+                "prompt_version": 2,
+                "last_seq": 2,
+                "message_id": 2,
+                "role": "assistant",
+                "content": "Hi!",
+                "tokens": 1,
+            },
+        ]
+    )
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        result = await load_conversation(123, 456, limit=100)
+        # ID попали в кэш - повторное разрешение не обращается к БД
+        assert await get_or_create_user(123) == 7
+        assert await get_or_create_chat(456) == 8
+
+    assert result["user_id"] == 7
+    assert result["chat_id"] == 8
+    assert [m["content"] for m in result["messages"]] == ["Hello", "Hi!"]
+    assert [m["tokens"] for m in result["messages"]] == [2, 1]
+    # Текст system prompt не хранится в сообщениях - только ссылка на реестр
+    assert result["prompt"] == ("chat", 2)
+    assert result["seq"] == 2
+    mock_cursor.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_load_conversation_empty():
+    """Тест загрузки диалога без сообщений (LEFT JOIN возвращает пустую строку)"""
+    from services.database import load_conversation
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        return_value=[
+            {
+                "user_id": 7,
+                "chat_id": 8,
+                "prompt_name": None,
+                "prompt_version": None,
+                "last_seq": 0,
+                "message_id": None,
+                "role": None,
+                "content": None,
+            }
+        ]
+    )
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        result = await load_conversation(123, 456)
+
+    assert result == {"user_id": 7, "chat_id": 8, "messages": [], "prompt": None, "seq": 0}
+
+
+@pytest.mark.asyncio
+async def test_session_reuses_single_connection():
+    """Тест: внутри сессии все операции используют одно соединение и транзакцию"""
+    from services.database import clear_conversation, get_messages, session
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(return_value=[])
+    mock_conn = mock_pool.connection.return_value
+    mock_transaction = MagicMock()
+    mock_transaction.__aenter__ = AsyncMock()
+    mock_transaction.__aexit__ = AsyncMock(return_value=False)
+    mock_conn.transaction = MagicMock(return_value=mock_transaction)
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        async with session():
+            await get_messages(1, 2)
+            await clear_conversation(1, 2)
+
+    mock_pool.connection.assert_called_once()
+    mock_conn.transaction.assert_called_once()
+    mock_transaction.__aexit__.assert_called_once()
+    assert mock_cursor.execute.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_session_without_queries_does_not_checkout():
+    """Тест: сессия без запросов к БД не берет соединение из пула"""
+    from services.database import session
+
+    mock_pool = MagicMock()
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        async with session():
+            pass
+
+    mock_pool.connection.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_session_rollback_skips_id_cache_warmup():
+    """Тест: при откате сессии ID из load_conversation не попадают в кэш"""
+    from services.database import _chat_id_cache, load_conversation, session
+
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        return_value=[
+            {
+                "user_id": 7,
+                "chat_id": 8,
+                "prompt_name": None,
+                "prompt_version": None,
+                "last_seq": 0,
+                "message_id": None,
+                "role": None,
+                "content": None,
+            }
+        ]
+    )
+    mock_conn = mock_pool.connection.return_value
+    mock_conn.__aexit__ = AsyncMock(return_value=False)
+    mock_transaction = MagicMock()
+    mock_transaction.__aenter__ = AsyncMock()
+    mock_transaction.__aexit__ = AsyncMock(return_value=False)
+    mock_conn.transaction = MagicMock(return_value=mock_transaction)
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        with pytest.raises(RuntimeError):
+            async with session():
+                await load_conversation(123, 456)
+                raise RuntimeError("boom")
+
+    assert 456 not in _chat_id_cache
+
+
+@pytest.mark.asyncio
+async def test_list_message_partitions():
+    """Тест: партиции messages из каталога; None, если таблица не партиционирована"""
+    from services.database import list_message_partitions
+
+    bound = "FOR VALUES FROM ('2026-12-01 00:00:00') TO ('2027-01-01 00:00:00')"
+    mock_pool, mock_cursor = _make_mock_pool([])
+    mock_cursor.fetchall = AsyncMock(
+        side_effect=[[{"name": "messages_y2026m12", "bound": bound}], []]
+    )
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        assert await list_message_partitions() == [{"name": "messages_y2026m12", "bound": bound}]
+        assert await list_message_partitions() is None
+
+
+@pytest.mark.asyncio
+async def test_purge_deleted_messages_keyset():
+    """Тест: пачка продолжается после ключа предыдущей; пустая пачка - None"""
+    from datetime import datetime
+
+    from services.database import purge_deleted_messages
+
+    deleted_at = datetime(2026, 10, 1, 12, 0)
+    mock_pool, mock_cursor = _make_mock_pool(
+        [{"deleted_at": deleted_at, "id": 7, "purged": 3}, None]
+    )
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        first = await purge_deleted_messages(3600, None, 3)
+        second = await purge_deleted_messages(3600, first[1], 3, archive=False)
+
+    assert first == (3, (deleted_at, 7))
+    assert second == (0, None)
+    params = mock_cursor.execute.call_args_list[1].args[1]
+    assert params["after_deleted_at"] == deleted_at
+    assert params["after_id"] == 7
+    assert params["archive"] is False
+
+
+@pytest.mark.asyncio
+async def test_reclaim_cleared_messages():
+    """Тест: число помеченных строк прошлых эпох; None, если очищенных диалогов нет"""
+    from services.database import reclaim_cleared_messages
+
+    mock_pool, mock_cursor = _make_mock_pool([(250,), None])
+
+    with patch("services.database.get_pool", return_value=mock_pool):
+        assert await reclaim_cleared_messages(250) == 250
+        assert await reclaim_cleared_messages(250) is None
+
+    query, params = mock_cursor.execute.call_args.args
+    assert "m.epoch < conv.epoch" in query
+    # Временем удаления становится время очистки: дальше - обычная очистка soft-deleted
+    assert "SET deleted_at = conv.cleared_at" in query
+    assert params == {"limit": 250}
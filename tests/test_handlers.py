@@ -11,12 +11,16 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from constants import MessageRole
 from handlers.messages import handle_message
-from services.context import get_context
+from roles.prompts import PromptName, get_prompt
+from services.context import _clear_context_cache, clear_context, get_context
 
 # Глобальное хранилище для эмуляции БД в тестах
 _test_db_users = {}
 _test_db_chats = {}
 _test_db_messages = []
+_test_db_prompts = {}
+_test_db_epochs = {}
+_test_db_seqs = {}
 _test_db_id_counter = 1
 
 
@@ -26,10 +30,13 @@ def _reset_test_db():
     _test_db_users.clear()
     _test_db_chats.clear()
     _test_db_messages.clear()
+    _test_db_prompts.clear()
+    _test_db_epochs.clear()
+    _test_db_seqs.clear()
     _test_db_id_counter = 1
 
 
-async def _mock_get_or_create_user(telegram_user_id: int, first_name: str):  # type: ignore[misc]
+async def _mock_get_or_create_user(telegram_user_id: int, first_name: str | None = None):  # type: ignore[misc]
     """Mock для get_or_create_user"""
     if telegram_user_id not in _test_db_users:
         global _test_db_id_counter
@@ -47,22 +54,55 @@ async def _mock_get_or_create_chat(telegram_chat_id: int):  # type: ignore[misc]
     return _test_db_chats[telegram_chat_id]
 
 
-async def _mock_save_message(user_id: int, chat_id: int, role: str, content: str):  # type: ignore[misc]
-    """Mock для save_message"""
+async def _mock_append_messages(  # type: ignore[misc]
+    user_id: int, chat_id: int, messages: list, keep_last: int, first_seq: int | None = None
+):
+    """Mock для append_messages: нумерация, вставка + усечение не-system сообщений"""
     global _test_db_id_counter
-    msg_id = _test_db_id_counter
-    _test_db_id_counter += 1
-    _test_db_messages.append(
-        {
-            "id": msg_id,
+    last_seq = _test_db_seqs.get((user_id, chat_id), 0)
+    epoch = _test_db_epochs.get((user_id, chat_id), 0)
+    start = last_seq + 1 if first_seq is None else first_seq
+    if start <= last_seq:
+        stored = [
+            msg
+            for msg in _test_db_messages
+            if (msg["user_id"], msg["chat_id"], msg["epoch"], msg["seq"])
+            == (user_id, chat_id, epoch, start)
+        ]
+        # Номер занят другим сообщением - следующие свободные номера
+        if not stored or stored[0]["content"] != messages[0]["content"]:
+            start = last_seq + 1
+    inserted = []
+    for seq, msg in enumerate(messages, start=start):
+        if seq <= last_seq:
+            continue
+        _test_db_seqs[(user_id, chat_id)] = seq
+        row = {
+            "id": _test_db_id_counter,
             "user_id": user_id,
             "chat_id": chat_id,
-            "role": role,
-            "content": content,
+            "role": msg["role"],
+            "content": msg["content"],
             "deleted_at": None,
+            "epoch": epoch,
+            "seq": seq,
         }
-    )
-    return msg_id
+        _test_db_id_counter += 1
+        _test_db_messages.append(row)
+        inserted.append(row)
+
+    live = [
+        msg
+        for msg in _test_db_messages
+        if msg["user_id"] == user_id
+        and msg["chat_id"] == chat_id
+        and msg["deleted_at"] is None
+        and msg["epoch"] == _test_db_epochs.get((user_id, chat_id), 0)
+        and msg["role"] != MessageRole.SYSTEM
+    ]
+    for msg in live[: max(len(live) - keep_last, 0)]:
+        msg["deleted_at"] = True
+    return inserted
 
 
 async def _mock_get_messages(user_id: int, chat_id: int, limit: int = 10):  # type: ignore[misc]
@@ -70,31 +110,59 @@ async def _mock_get_messages(user_id: int, chat_id: int, limit: int = 10):  # ty
     messages = [
         msg
         for msg in _test_db_messages
-        if msg["user_id"] == user_id and msg["chat_id"] == chat_id and msg["deleted_at"] is None
+        if msg["user_id"] == user_id
+        and msg["chat_id"] == chat_id
+        and msg["deleted_at"] is None
+        and msg["epoch"] == _test_db_epochs.get((user_id, chat_id), 0)
     ]
     return messages[-limit:] if len(messages) > limit else messages
 
 
-async def _mock_soft_delete_messages(user_id: int, chat_id: int):  # type: ignore[misc]
-    """Mock для soft_delete_messages"""
-    for msg in _test_db_messages:
-        if msg["user_id"] == user_id and msg["chat_id"] == chat_id:
-            msg["deleted_at"] = True
+async def _mock_load_conversation(telegram_user_id: int, telegram_chat_id: int, limit: int = 100):  # type: ignore[misc]
+    """Mock для load_conversation"""
+    user_id = await _mock_get_or_create_user(telegram_user_id)
+    chat_id = await _mock_get_or_create_chat(telegram_chat_id)
+    messages = await _mock_get_messages(user_id, chat_id, limit)
+    prompt = _test_db_prompts.get((user_id, chat_id))
+    return {
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "messages": messages,
+        "prompt": prompt,
+        "seq": _test_db_seqs.get((user_id, chat_id), 0),
+    }
+
+
+async def _mock_set_conversation_prompt(  # type: ignore[misc]
+    user_id: int, chat_id: int, prompt_name: str, prompt_version: int
+):
+    """Mock для set_conversation_prompt"""
+    _test_db_prompts[(user_id, chat_id)] = (prompt_name, prompt_version)
+
+
+async def _mock_clear_conversation(user_id: int, chat_id: int):  # type: ignore[misc]
+    """Mock для clear_conversation: новая эпоха, сообщения не изменяются"""
+    _test_db_prompts.pop((user_id, chat_id), None)
+    _test_db_epochs[(user_id, chat_id)] = _test_db_epochs.get((user_id, chat_id), 0) + 1
+    _test_db_seqs[(user_id, chat_id)] = 0
 
 
 @pytest.fixture(autouse=True)
 def mock_database():
     """Mock всех database функций для тестов"""
     _reset_test_db()
+    _clear_context_cache()
     with (
         patch("services.context.get_or_create_user", new=_mock_get_or_create_user),
         patch("services.context.get_or_create_chat", new=_mock_get_or_create_chat),
-        patch("services.context.save_message", new=_mock_save_message),
-        patch("services.context.get_messages", new=_mock_get_messages),
-        patch("services.context.soft_delete_messages", new=_mock_soft_delete_messages),
+        patch("services.context.append_messages", new=_mock_append_messages),
+        patch("services.context.load_conversation", new=_mock_load_conversation),
+        patch("services.context.set_conversation_prompt", new=_mock_set_conversation_prompt),
+        patch("services.context.clear_conversation", new=_mock_clear_conversation),
     ):
         yield
     _reset_test_db()
+    _clear_context_cache()
 
 
 @pytest.fixture
@@ -121,6 +189,10 @@ def mock_config():
     config.openai_model = "gpt-4o-mini"
     config.max_context_messages = 10
     config.temperature = 0.7
+    config.max_tokens = 1000
+    config.context_window_tokens = 0
+    config.llm_streaming = False
+    config.summary_enabled = False
     return config
 
 
@@ -146,6 +218,76 @@ async def test_handle_message_creates_initial_context(mock_message, mock_config)
             assert messages[2]["role"] == MessageRole.ASSISTANT
 
 
+@pytest.mark.asyncio
+async def test_handle_message_stores_prompt_reference(mock_message, mock_config):
+    """Тест: system prompt не пишется в messages, диалог хранит только его версию"""
+    prompt = get_prompt(PromptName.CHAT)
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.get_llm_response", return_value="Ответ"):
+            await handle_message(mock_message)
+
+    assert [msg["role"] for msg in _test_db_messages] == [
+        MessageRole.USER,
+        MessageRole.ASSISTANT,
+    ]
+    assert list(_test_db_prompts.values()) == [("chat", prompt.version)]
+
+    # После сброса кэша текст промпта подставляется из реестра
+    _clear_context_cache()
+    context = await get_context(mock_message.from_user.id, mock_message.chat.id)
+    assert context["messages"][0] == prompt.message
+    assert len(context["messages"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_clear_context_starts_new_epoch(mock_message, mock_config):
+    """Тест: после очистки старые сообщения не читаются, хотя в БД не изменены"""
+    user_id = mock_message.from_user.id
+    chat_id = mock_message.chat.id
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.get_llm_response", return_value="Ответ"):
+            await handle_message(mock_message)
+            await clear_context(user_id, chat_id)
+            mock_message.text = "Новый диалог"
+            await handle_message(mock_message)
+
+    assert all(msg["deleted_at"] is None for msg in _test_db_messages)
+    assert [msg["epoch"] for msg in _test_db_messages] == [0, 0, 1, 1]
+
+    _clear_context_cache()
+    context = await get_context(user_id, chat_id)
+    assert [msg["content"] for msg in context["messages"][1:]] == ["Новый диалог", "Ответ"]
+
+
+@pytest.mark.asyncio
+async def test_clear_during_answer_keeps_system_prompt(mock_message, mock_config):
+    """Тест: /clear, пока готовился ответ - в новой эпохе следующий запрос идет с system prompt"""
+    user_id = mock_message.from_user.id
+    chat_id = mock_message.chat.id
+    requests = []
+
+    async def answer_with_clear(request, *args, **kwargs):  # type: ignore[no-untyped-def]
+        requests.append(request)
+        if len(requests) == 2:
+            await clear_context(user_id, chat_id)
+        return "Ответ"
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.get_llm_response", new=answer_with_clear):
+            await handle_message(mock_message)
+            mock_message.text = "Второй"
+            await handle_message(mock_message)
+            mock_message.text = "Третий"
+            await handle_message(mock_message)
+
+    # Ход, начатый до очистки, записан в новую эпоху без ссылки на промпт
+    assert _test_db_prompts == {}
+    assert requests[2][0] == get_prompt(PromptName.CHAT).message
+    assert [msg["content"] for msg in requests[2][-3:]] == ["Второй", "Ответ", "Третий"]
+
+
 @pytest.mark.asyncio
 async def test_handle_message_preserves_context(mock_message, mock_config):
     """Тест сохранения контекста между сообщениями"""
@@ -209,6 +351,21 @@ async def test_handle_message_error_handling(mock_message, mock_config):
             assert "ошибка" in error_message.lower()
 
 
+@pytest.mark.asyncio
+async def test_handle_message_context_error_replies(mock_message, mock_config):
+    """Тест: ошибка загрузки контекста (БД недоступна) - пользователь получает ответ об ошибке"""
+    with (
+        patch("handlers.messages.load_config", return_value=mock_config),
+        patch("handlers.messages.get_context", side_effect=Exception("DB down")),
+        patch("handlers.messages.get_llm_response", new=AsyncMock()) as mock_llm,
+    ):
+        await handle_message(mock_message)
+
+    mock_llm.assert_not_called()
+    mock_message.answer.assert_called_once()
+    assert "❌" in mock_message.answer.call_args[0][0]
+
+
 @pytest.mark.asyncio
 async def test_handle_message_without_from_user(mock_config):
     """Тест обработки сообщения без from_user"""
@@ -278,3 +435,155 @@ async def test_handle_message_user_name_in_context(mock_message, mock_config):
             # Этот тест проверяет только что контекст существует
             context = await get_context(mock_message.from_user.id, mock_message.chat.id)
             assert len(context.get("messages", [])) > 0
+
+
+@pytest.mark.asyncio
+async def test_handle_message_coalesces_messages_during_llm_call(mock_config):
+    """Тест: сообщения, пришедшие во время запроса к LLM, объединяются в один ход"""
+    import asyncio
+
+    def make_message(text: str) -> MagicMock:
+        message = MagicMock()
+        message.from_user.id = 12345
+        message.from_user.first_name = "Тестовый"
+        message.chat.id = 67890
+        message.text = text
+        message.answer = AsyncMock()
+        message.bot = MagicMock()
+        message.bot.send_chat_action = AsyncMock()
+        return message
+
+    release = asyncio.Event()
+    llm_calls: list[list] = []
+
+    async def slow_llm(messages, config, **kwargs):  # type: ignore[no-untyped-def]
+        llm_calls.append(list(messages))
+        await release.wait()
+        return f"Ответ {len(llm_calls)}"
+
+    first, second, third = make_message("A"), make_message("B"), make_message("C")
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.get_llm_response", new=slow_llm):
+            task = asyncio.create_task(handle_message(first))
+            await asyncio.sleep(0)
+
+            # Пока идет запрос к LLM, приходят еще два сообщения
+            await handle_message(second)
+            await handle_message(third)
+            assert len(llm_calls) == 1
+
+            release.set()
+            await task
+
+            context = await get_context(12345, 67890)
+
+    # Два запроса к LLM: первое сообщение и объединенные второе+третье
+    assert len(llm_calls) == 2
+    assert llm_calls[1][-1]["content"] == "B\nC"
+    first.answer.assert_called_once_with("Ответ 1")
+    second.answer.assert_not_called()
+    third.answer.assert_called_once_with("Ответ 2")
+
+    contents = [m["content"] for m in context["messages"]]
+    assert contents[1:] == ["A", "Ответ 1", "B\nC", "Ответ 2"]
+
+
+@pytest.mark.asyncio
+async def test_handle_message_streaming(mock_message, mock_config):
+    """Тест потокового режима: заглушка редактируется по мере генерации"""
+    mock_config.llm_streaming = True
+    mock_config.stream_edit_interval = 0
+
+    placeholder = MagicMock()
+    placeholder.edit_text = AsyncMock()
+    mock_message.answer = AsyncMock(return_value=placeholder)
+
+    async def fake_stream(messages, config, **kwargs):  # type: ignore[no-untyped-def]
+        for text in ["При", "Привет", "Привет", "Привет!"]:
+            yield text
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.stream_llm_response", new=fake_stream):
+            await handle_message(mock_message)
+
+    mock_message.answer.assert_called_once_with("⏳")
+    edits = [c.args[0] for c in placeholder.edit_text.call_args_list]
+    assert edits == ["При", "Привет", "Привет!"]
+
+    context = await get_context(mock_message.from_user.id, mock_message.chat.id)
+    assert context["messages"][-1]["content"] == "Привет!"
+
+
+@pytest.mark.asyncio
+async def test_handle_message_streaming_throttles_edits(mock_message, mock_config):
+    """Тест потокового режима: промежуточные правки не чаще интервала, финальная - всегда"""
+    mock_config.llm_streaming = True
+    mock_config.stream_edit_interval = 60
+
+    placeholder = MagicMock()
+    placeholder.edit_text = AsyncMock()
+    mock_message.answer = AsyncMock(return_value=placeholder)
+
+    async def fake_stream(messages, config, **kwargs):  # type: ignore[no-untyped-def]
+        for text in ["Раз", "Раз два", "Раз два три"]:
+            yield text
+
+    with patch("handlers.messages.load_config", return_value=mock_config):
+        with patch("handlers.messages.stream_llm_response", new=fake_stream):
+            await handle_message(mock_message)
+
+    edits = [c.args[0] for c in placeholder.edit_text.call_args_list]
+    assert edits == ["Раз", "Раз два три"]
+
+
+@pytest.mark.asyncio
+async def test_handle_message_saves_llm_usage(mock_message, mock_config):
+    """Тест: замеры запроса к LLM сохраняются вместе с ответом ассистента"""
+    usage = {
+        "model": "gpt-4o-mini",
+        "endpoint": "https://api.openai.com/v1",
+        "latency_ms": 1200,
+        "prompt_tokens": 50,
+        "completion_tokens": 10,
+    }
+
+    async def fake_llm(messages, config, on_usage=None, **kwargs):  # type: ignore[no-untyped-def]
+        on_usage(usage)
+        return "Ответ"
+
+    mock_append = AsyncMock()
+    with (
+        patch("handlers.messages.load_config", return_value=mock_config),
+        patch("handlers.messages.get_llm_response", new=fake_llm),
+        patch("handlers.messages.append_turn", new=mock_append),
+    ):
+        await handle_message(mock_message)
+
+    turn = mock_append.call_args.args[2]
+    assert turn[-1] == {"role": MessageRole.ASSISTANT, "content": "Ответ", "usage": usage}
+    # Остальные сообщения хода сохраняются без замеров
+    assert all("usage" not in msg for msg in turn[:-1])
+
+
+@pytest.mark.asyncio
+async def test_handle_message_shared_prompt_prefix(mock_message, mock_config):
+    """Тест: system prompt одинаков для всех пользователей, имя - следующим сообщением"""
+    from roles.prompts import DEFAULT_SYSTEM_PROMPT
+
+    mock_llm = AsyncMock(return_value="Ответ")
+    with (
+        patch("handlers.messages.load_config", return_value=mock_config),
+        patch("handlers.messages.get_llm_response", new=mock_llm),
+    ):
+        await handle_message(mock_message)
+
+    request = mock_llm.call_args.args[0]
+    assert request[0] == {"role": MessageRole.SYSTEM, "content": DEFAULT_SYSTEM_PROMPT}
+    assert request[1] == {"role": MessageRole.SYSTEM, "content": "Имя пользователя: Тестовый"}
+    assert request[2]["content"] == "Привет!"
+
+    # В истории сохраняется только общий system prompt
+    context = await get_context(mock_message.from_user.id, mock_message.chat.id)
+    assert context["messages"][0]["content"] == DEFAULT_SYSTEM_PROMPT
+    assert all("Тестовый" not in m["content"] for m in context["messages"])
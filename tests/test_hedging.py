@@ -0,0 +1,244 @@
+"""Тесты для хеджирования запросов к LLM"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import services.hedging as hedging
+from constants import HEDGE_MIN_SAMPLES
+from services.hedging import LatencyTracker, _reset_hedging, get_hedge_stats, hedged
+from services.metrics import _reset_metrics, render_metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_hedging():
+    """Сброс замеров и счетчиков перед каждым тестом"""
+    _reset_hedging()
+    _reset_metrics()
+    yield
+    _reset_hedging()
+    _reset_metrics()
+
+
+def _warm_up(latency: float) -> None:
+    """Заполнить окно одинаковыми замерами"""
+    for _ in range(HEDGE_MIN_SAMPLES):
+        hedging._latency.observe(latency)
+
+
+def test_percentile_requires_min_samples():
+    """Тест: без достаточного числа замеров перцентиль не считается"""
+    tracker = LatencyTracker(window=100)
+    for _ in range(HEDGE_MIN_SAMPLES - 1):
+        tracker.observe(1.0)
+
+    assert tracker.percentile(0.95) is None
+
+    tracker.observe(1.0)
+    assert tracker.percentile(0.95) == 1.0
+
+
+def test_percentile_uses_sliding_window():
+    """Тест: перцентиль считается по последним замерам"""
+    tracker = LatencyTracker(window=HEDGE_MIN_SAMPLES)
+    for value in range(HEDGE_MIN_SAMPLES * 2):
+        tracker.observe(float(value))
+
+    assert len(tracker) == HEDGE_MIN_SAMPLES
+    assert tracker.percentile(0.0) == float(HEDGE_MIN_SAMPLES)
+    assert tracker.percentile(1.0) == float(HEDGE_MIN_SAMPLES * 2 - 1)
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_without_samples():
+    """Тест: до накопления замеров дубль не отправляется, задержка замеряется"""
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        return "ok"
+
+    assert await hedged(call, 0.95) == "ok"
+
+    assert calls == 1
+    assert len(hedging._latency) == 1
+    assert get_hedge_stats()["hedged"] == 0
+
+
+@pytest.mark.asyncio
+async def test_fast_response_is_not_hedged():
+    """Тест: ответ быстрее перцентиля не дублируется"""
+    _warm_up(1.0)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        return "ok"
+
+    assert await hedged(call, 0.95) == "ok"
+
+    assert calls == 1
+    stats = get_hedge_stats()
+    assert stats["requests"] == 1
+    assert stats["hedged"] == 0
+
+
+@pytest.mark.asyncio
+async def test_slow_request_is_hedged_and_loser_cancelled():
+    """Тест: долгий запрос дублируется, первый ответ побеждает, второй отменяется"""
+    _warm_up(0.01)
+    calls = 0
+    cancelled = asyncio.Event()
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return "primary"
+        return "hedge"
+
+    assert await hedged(call, 0.95) == "hedge"
+
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+    assert calls == 2
+    stats = get_hedge_stats()
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 1
+    assert stats["hedge_rate"] == 1.0
+    assert stats["win_rate"] == 1.0
+    # Те же счетчики и текущая задержка дубля - в /metrics
+    metrics = render_metrics()
+    assert "llm_hedge_requests_total 1" in metrics
+    assert "llm_hedges_sent_total 1" in metrics
+    assert "llm_hedge_wins_total 1" in metrics
+    assert "llm_hedge_delay_seconds 0.01" in metrics
+
+
+@pytest.mark.asyncio
+async def test_primary_can_win_after_hedge():
+    """Тест: если основной запрос ответил раньше дубля, побеждает он"""
+    _warm_up(0.01)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.05)
+            return "primary"
+        await asyncio.sleep(10)
+        return "hedge"
+
+    assert await hedged(call, 0.95) == "primary"
+
+    stats = get_hedge_stats()
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_request_waits_for_other():
+    """Тест: ошибка одного из запросов не отменяет второй"""
+    _warm_up(0.01)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.05)
+            return "primary"
+        raise RuntimeError("hedge failed")
+
+    assert await hedged(call, 0.95) == "primary"
+
+
+@pytest.mark.asyncio
+async def test_both_failed_raises_primary_error():
+    """Тест: если оба запроса упали, пробрасывается ошибка основного"""
+    _warm_up(0.01)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.05)
+            raise RuntimeError("primary failed")
+        raise RuntimeError("hedge failed")
+
+    with pytest.raises(RuntimeError, match="primary failed"):
+        await hedged(call, 0.95)
+
+
+@pytest.mark.asyncio
+async def test_disabled_hedging_never_duplicates():
+    """Тест: без перцентиля (хеджирование выключено) запрос не дублируется"""
+    _warm_up(0.01)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    assert await hedged(call, None) == "ok"
+
+    assert calls == 1
+    assert get_hedge_stats()["hedged"] == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_wait_does_not_trigger_hedge():
+    """Тест: время до дубля отсчитывается от начала запроса к провайдеру, а не от очереди"""
+    _warm_up(0.05)
+    started = asyncio.Event()
+    calls = 0
+
+    async def call() -> tuple[str, float]:
+        nonlocal calls
+        calls += 1
+        # Ожидание слота дольше перцентиля, сам ответ - быстрый
+        await asyncio.sleep(0.1)
+        started.set()
+        await asyncio.sleep(0.01)
+        return "ok", 0.01
+
+    result = await hedged(call, 0.95, started=started, latency=lambda r: r[1])
+
+    assert result == ("ok", 0.01)
+    assert calls == 1
+    assert get_hedge_stats()["hedged"] == 0
+    # В окно попадает задержка провайдера, без ожидания в очереди
+    assert hedging._latency._samples[-1] == 0.01
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_when_not_allowed():
+    """Тест: при занятом планировщике дубль не отправляется, ждем основной запрос"""
+    _warm_up(0.01)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    assert await hedged(call, 0.95, can_hedge=lambda: False) == "primary"
+
+    assert calls == 1
+    assert get_hedge_stats()["hedged"] == 0
@@ -12,15 +12,36 @@ from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimi
 
 from config import Config
 from constants import MessageRole
-from services.llm import _clear_client_cache, get_llm_response
+from services.hedging import _reset_hedging
+from services.llm import (
+    _cache_key,
+    _clean_partial_answer,
+    _clear_client_cache,
+    _clear_response_cache,
+    close_llm_clients,
+    get_llm_response,
+    get_response_cache_stats,
+    stream_llm_response,
+    warm_up_llm,
+)
+from services.metrics import _reset_metrics, render_metrics
+from services.router import _reset_router
 
 
 @pytest.fixture(autouse=True)
 def clear_llm_cache():
-    """Очистка кэша клиентов OpenAI перед каждым тестом"""
+    """Очистка кэша клиентов OpenAI и кэша ответов перед каждым тестом"""
     _clear_client_cache()
+    _clear_response_cache()
+    _reset_router()
+    _reset_hedging()
+    _reset_metrics()
     yield
     _clear_client_cache()
+    _clear_response_cache()
+    _reset_router()
+    _reset_hedging()
+    _reset_metrics()
 
 
 def test_token_cleanup():
@@ -133,6 +154,8 @@ def mock_config():
         temperature=0.7,
         max_context_messages=10,
         openai_timeout=30,
+        # Повторы проверяются в tests/test_resilience.py
+        llm_max_retries=0,
     )
 
 
@@ -274,3 +297,408 @@ async def test_llm_empty_response(mock_config):
 
         assert "пустой ответ" in result
         assert "🤔" in result
+
+
+def test_partial_answer_cleanup():
+    """Тест очистки частичного ответа при потоковой генерации"""
+    # Начало служебного токена в конце не показывается
+    assert _clean_partial_answer("Привет!<｜end▁of") == "Привет!"
+    assert _clean_partial_answer("Привет!<|end_of_te") == "Привет!"
+    # Обычный символ < остается
+    assert _clean_partial_answer("a < b") == "a < b"
+    # Незакрытая разметка не показывается, закрытая очищается
+    assert _clean_partial_answer("Это **важ") == "Это важ"
+    assert _clean_partial_answer("Это *курсив* и *ещ") == "Это курсив и"
+    assert _clean_partial_answer("Это **важно**") == "Это важно"
+
+
+def _stream_chunks(*parts: str):  # type: ignore[no-untyped-def]
+    """Имитация потока чанков chat.completions (stream=True)"""
+
+    async def stream():  # type: ignore[no-untyped-def]
+        for part in parts:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock()]
+            chunk.choices[0].delta.content = part
+            yield chunk
+
+    return stream()
+
+
+@pytest.mark.asyncio
+async def test_stream_llm_response(mock_config):
+    """Тест потокового ответа: накопленный очищенный текст, в конце - полный ответ"""
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            return_value=_stream_chunks("Привет, **мир", "**! Как", " дела?<|end_of_text|>")
+        )
+
+        updates = [
+            text
+            async for text in stream_llm_response(
+                [{"role": MessageRole.USER, "content": "test"}], mock_config
+            )
+        ]
+
+        assert mock_instance.chat.completions.create.call_args.kwargs["stream"] is True
+        assert updates[0] == "Привет, мир"
+        assert updates[1] == "Привет, мир! Как"
+        assert updates[-1] == "Привет, мир! Как дела?"
+
+
+@pytest.mark.asyncio
+async def test_stream_llm_response_error(mock_config):
+    """Тест потокового ответа при ошибке: последнее значение - текст ошибки"""
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            side_effect=APITimeoutError(request=MagicMock())
+        )
+
+        updates = [
+            text
+            async for text in stream_llm_response(
+                [{"role": MessageRole.USER, "content": "test"}], mock_config
+            )
+        ]
+
+        assert updates == ["⏱️ Превышено время ожидания ответа."]
+
+
+def _completion(content: str) -> MagicMock:
+    """Ответ chat.completions с заданным текстом"""
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = content
+    return response
+
+
+@pytest.mark.asyncio
+async def test_response_cache_hit(mock_config):
+    """Тест: одинаковый запрос второй раз отдается из кэша"""
+    mock_config.llm_cache_enabled = True
+    messages = [{"role": MessageRole.USER, "content": "Сколько пользователей?"}]
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(return_value=_completion("**42**"))
+
+        assert await get_llm_response(messages, mock_config) == "42"
+        assert await get_llm_response(list(messages), mock_config) == "42"
+
+        # Другие параметры генерации - другой ключ
+        mock_config.temperature = 0.1
+        await get_llm_response(messages, mock_config)
+
+    assert mock_instance.chat.completions.create.call_count == 2
+    stats = get_response_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["hit_ratio"] == 0.3333
+    # Те же значения - в /metrics
+    metrics = render_metrics()
+    assert 'cache_requests_total{cache="llm_response",result="hit"} 1' in metrics
+    assert 'cache_hit_ratio{cache="llm_response"} 0.3333' in metrics
+    assert "llm_response_cache_saved_seconds_total " in metrics
+
+
+def test_response_cache_key_uses_routed_models(mock_config):
+    """Тест: ключ кэша зависит от моделей endpoints маршрутизатора, а не от OPENAI_MODEL"""
+    messages = [{"role": MessageRole.USER, "content": "Привет"}]
+    mock_config.llm_endpoints = "https://a|m1,https://b|m2"
+    key = _cache_key(messages, mock_config)
+
+    _reset_router()
+    mock_config.llm_endpoints = "https://a|m3,https://b|m2"
+    assert _cache_key(messages, mock_config) != key
+
+    _reset_router()
+    mock_config.llm_endpoints = "https://a|m1,https://b|m2"
+    mock_config.openai_model = "other-model"
+    assert _cache_key(messages, mock_config) == key
+
+
+@pytest.mark.asyncio
+async def test_response_cache_single_flight(mock_config):
+    """Тест: одновременные одинаковые запросы выполняются одним обращением"""
+    import asyncio
+
+    mock_config.llm_cache_enabled = True
+    messages = [{"role": MessageRole.USER, "content": "test"}]
+    release = asyncio.Event()
+
+    async def slow_create(**kwargs):  # type: ignore[no-untyped-def]
+        await release.wait()
+        return _completion("Ответ")
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(side_effect=slow_create)
+
+        tasks = [asyncio.create_task(get_llm_response(messages, mock_config)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+    assert results == ["Ответ", "Ответ", "Ответ"]
+    assert mock_instance.chat.completions.create.call_count == 1
+    assert get_response_cache_stats()["shared"] == 2
+    assert "llm_response_cache_shared_total 2" in render_metrics()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_skips_errors(mock_config):
+    """Тест: текст ошибки не кэшируется - следующий запрос идет к провайдеру"""
+    mock_config.llm_cache_enabled = True
+    messages = [{"role": MessageRole.USER, "content": "test"}]
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            side_effect=[
+                RateLimitError("Rate limit", response=MagicMock(status_code=429), body=None),
+                _completion("Ответ"),
+            ]
+        )
+
+        assert "Слишком много запросов" in await get_llm_response(messages, mock_config)
+        assert await get_llm_response(messages, mock_config) == "Ответ"
+
+    assert mock_instance.chat.completions.create.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_response_cache_disabled_by_default(mock_config):
+    """Тест: без LLM_CACHE_ENABLED каждый запрос идет к провайдеру"""
+    messages = [{"role": MessageRole.USER, "content": "test"}]
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(return_value=_completion("Ответ"))
+
+        await get_llm_response(messages, mock_config)
+        await get_llm_response(messages, mock_config)
+
+    assert mock_instance.chat.completions.create.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_llm_circuit_open(mock_config):
+    """Тест: при открытом circuit breaker провайдер не вызывается"""
+    mock_config.llm_circuit_threshold = 1
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            side_effect=APIConnectionError(request=MagicMock())
+        )
+
+        messages = [{"role": MessageRole.USER, "content": "test"}]
+        assert "Не удалось подключиться" in await get_llm_response(messages, mock_config)
+        result = await get_llm_response(messages, mock_config)
+
+    assert "временно недоступен" in result
+    assert mock_instance.chat.completions.create.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_clients_share_tuned_http_pool(mock_config):
+    """Тест: клиенты всех endpoint'ов используют общий пул с настройками из конфига"""
+    mock_config.llm_endpoints = "https://a|m1,https://b|m2"
+    mock_config.llm_http_max_connections = 7
+    mock_config.llm_http_max_keepalive = 3
+    mock_config.llm_http_keepalive_expiry = 12.0
+
+    with (
+        patch("services.llm.AsyncOpenAI") as mock_client,
+        patch("services.llm.DefaultAsyncHttpxClient") as mock_http,
+    ):
+        mock_client.return_value.models.list = AsyncMock()
+        mock_client.return_value.with_options.return_value.models.list = AsyncMock()
+
+        await warm_up_llm(mock_config)
+
+    assert mock_http.call_count == 1
+    limits = mock_http.call_args.kwargs["limits"]
+    assert limits.max_connections == 7
+    assert limits.max_keepalive_connections == 3
+    assert limits.keepalive_expiry == 12.0
+    assert mock_client.call_count == 2
+    assert all(
+        call.kwargs["http_client"] is mock_http.return_value for call in mock_client.call_args_list
+    )
+
+
+@pytest.mark.asyncio
+async def test_http2_falls_back_without_h2(mock_config):
+    """Тест: без пакета h2 HTTP/2 отключается вместо ошибки при старте"""
+    mock_config.llm_http2 = True
+
+    with (
+        patch("services.llm.AsyncOpenAI"),
+        patch("services.llm.DefaultAsyncHttpxClient") as mock_http,
+        patch("services.llm.importlib.util.find_spec", return_value=None),
+    ):
+        await warm_up_llm(mock_config)
+
+    assert mock_http.call_args.kwargs["http2"] is False
+
+
+@pytest.mark.asyncio
+async def test_warm_up_ignores_errors(mock_config):
+    """Тест: недоступный при старте endpoint не мешает запуску"""
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        models = mock_client.return_value.with_options.return_value.models
+        models.list = AsyncMock(side_effect=APIConnectionError(request=MagicMock()))
+
+        await warm_up_llm(mock_config)
+
+    models.list.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_warm_up_ignores_invalid_endpoints(mock_config):
+    """Тест: некорректный LLM_ENDPOINTS только логируется, как и в API"""
+    mock_config.llm_endpoints = "https://a|m|not-a-number"
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        await warm_up_llm(mock_config)
+
+    mock_client.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_close_llm_clients(mock_config):
+    """Тест: закрытие пула соединений и сброс клиентов"""
+    with (
+        patch("services.llm.AsyncOpenAI") as mock_client,
+        patch("services.llm.DefaultAsyncHttpxClient") as mock_http,
+    ):
+        mock_http.return_value.aclose = AsyncMock()
+        mock_client.return_value.with_options.return_value.models.list = AsyncMock()
+        await warm_up_llm(mock_config)
+
+        await close_llm_clients()
+
+    mock_http.return_value.aclose.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_llm_call_metrics(mock_config):
+    """Тест: задержка, токены, модель, endpoint и результат запроса попадают в метрики"""
+    response = _completion("Ответ")
+    response.usage = MagicMock(prompt_tokens=120, completion_tokens=30)
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(return_value=response)
+
+        await get_llm_response([{"role": MessageRole.USER, "content": "test"}], mock_config)
+
+    text = render_metrics()
+    labels = 'model="test-model",endpoint="https://test.api.com"'
+    assert f'llm_request_duration_seconds_count{{{labels},outcome="ok",stream="false"}} 1' in text
+    assert f"llm_prompt_tokens_sum{{{labels}}} 120" in text
+    assert f"llm_completion_tokens_sum{{{labels}}} 30" in text
+
+
+@pytest.mark.asyncio
+async def test_llm_error_metrics(mock_config):
+    """Тест: ошибка запроса учитывается с классом результата"""
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            side_effect=APITimeoutError(request=MagicMock())
+        )
+
+        await get_llm_response([{"role": MessageRole.USER, "content": "test"}], mock_config)
+
+    assert 'outcome="timeout",stream="false"} 1' in render_metrics()
+
+
+@pytest.mark.asyncio
+async def test_stream_metrics_ttft(mock_config):
+    """Тест: для потока записываются время до первого токена и usage последнего чанка"""
+    usage_chunk = MagicMock()
+    usage_chunk.choices = []
+    usage_chunk.usage = MagicMock(prompt_tokens=50, completion_tokens=7)
+
+    async def stream():  # type: ignore[no-untyped-def]
+        async for chunk in _stream_chunks("При", "вет"):
+            chunk.usage = None
+            yield chunk
+        yield usage_chunk
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(return_value=stream())
+
+        results = [
+            text
+            async for text in stream_llm_response(
+                [{"role": MessageRole.USER, "content": "test"}], mock_config
+            )
+        ]
+
+    assert results[-1] == "Привет"
+    assert mock_instance.chat.completions.create.call_args.kwargs["stream_options"] == {
+        "include_usage": True
+    }
+    text = render_metrics()
+    assert 'outcome="ok",stream="true"} 1' in text
+    assert "llm_time_to_first_token_seconds_count" in text
+    assert 'llm_completion_tokens_sum{model="test-model",endpoint="https://test.api.com"} 7' in text
+
+
+@pytest.mark.asyncio
+async def test_on_usage_receives_call_stats(mock_config):
+    """Тест: вызывающий получает замеры запроса для сохранения вместе с ответом"""
+    response = _completion("Ответ")
+    response.usage = MagicMock(prompt_tokens=120, completion_tokens=30)
+    usage: list = []
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(return_value=response)
+
+        await get_llm_response(
+            [{"role": MessageRole.USER, "content": "test"}], mock_config, on_usage=usage.append
+        )
+
+    assert len(usage) == 1
+    assert usage[0]["model"] == "test-model"
+    assert usage[0]["endpoint"] == "https://test.api.com"
+    assert usage[0]["latency_ms"] >= 0
+    assert usage[0]["prompt_tokens"] == 120
+    assert usage[0]["completion_tokens"] == 30
+
+
+@pytest.mark.asyncio
+async def test_on_usage_not_called_on_error(mock_config):
+    """Тест: при ошибке замеры не передаются (сохранять нечего)"""
+    usage: list = []
+
+    with patch("services.llm.AsyncOpenAI") as mock_client:
+        mock_instance = MagicMock()
+        mock_client.return_value = mock_instance
+        mock_instance.chat.completions.create = AsyncMock(
+            side_effect=APITimeoutError(request=MagicMock())
+        )
+
+        await get_llm_response(
+            [{"role": MessageRole.USER, "content": "test"}], mock_config, on_usage=usage.append
+        )
+
+    assert usage == []
@@ -0,0 +1,126 @@
+"""Тесты для метрик Prometheus"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.cache import TTLCache
+from services.metrics import (
+    CacheCollector,
+    Counter,
+    Gauge,
+    Histogram,
+    LLMCallStats,
+    _reset_metrics,
+    record_llm_call,
+    render_metrics,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """Сброс метрик перед каждым тестом"""
+    _reset_metrics()
+    yield
+    _reset_metrics()
+
+
+def test_histogram_render():
+    """Тест: корзины накопительные, есть +Inf, сумма и количество"""
+    histogram = Histogram("test_seconds", "Test", ["model"], [1, 5])
+    histogram.observe(0.5, model="m")
+    histogram.observe(3, model="m")
+    histogram.observe(10, model="m")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{model="m",le="1"} 1',
+        'test_seconds_bucket{model="m",le="5"} 2',
+        'test_seconds_bucket{model="m",le="+Inf"} 3',
+        'test_seconds_sum{model="m"} 13.5',
+        'test_seconds_count{model="m"} 3',
+    ]
+
+
+def test_histogram_escapes_labels():
+    """Тест: кавычки и переводы строк в значениях меток экранируются"""
+    histogram = Histogram("test_seconds", "Test", ["model"], [1])
+    histogram.observe(1, model='a"b\nc')
+
+    assert 'test_seconds_count{model="a\\"b\\nc"} 1' in histogram.render()
+
+
+def test_counter_and_gauge_render():
+    """Тест: счетчик суммирует по меткам, неустановленный gauge без значения"""
+    counter = Counter("test_total", "Test", ["action"])
+    counter.inc(2, action="a")
+    counter.inc(action="a")
+    gauge = Gauge("test_lag_seconds", "Test")
+
+    assert counter.render() == [
+        "# HELP test_total Test",
+        "# TYPE test_total counter",
+        'test_total{action="a"} 3',
+    ]
+    assert gauge.render() == ["# HELP test_lag_seconds Test", "# TYPE test_lag_seconds gauge"]
+    gauge.set(1.5)
+    assert gauge.render()[-1] == "test_lag_seconds 1.5"
+
+
+def test_cache_collector_render():
+    """Тест: размер, обращения, вытеснения и доля попаданий читаются из кэша при отрисовке"""
+    cache: TTLCache[str, int] = TTLCache(max_size=1, ttl=60)
+    collector = CacheCollector()
+    collector.register("test", cache)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    cache.set("b", 2)
+
+    lines = collector.render()
+
+    assert 'cache_size{cache="test"} 1' in lines
+    assert 'cache_requests_total{cache="test",result="hit"} 1' in lines
+    assert 'cache_requests_total{cache="test",result="miss"} 1' in lines
+    assert 'cache_evictions_total{cache="test"} 1' in lines
+    assert 'cache_hit_ratio{cache="test"} 0.5' in lines
+
+
+def test_record_llm_call():
+    """Тест: запрос к LLM учитывается в гистограммах задержки, TTFT и токенов"""
+    record_llm_call(
+        LLMCallStats(
+            model="m",
+            endpoint="https://a",
+            outcome="ok",
+            latency=1.5,
+            stream=True,
+            ttft=0.3,
+            prompt_tokens=100,
+            completion_tokens=20,
+        )
+    )
+
+    text = render_metrics()
+    assert (
+        'llm_request_duration_seconds_count{model="m",endpoint="https://a",'
+        'outcome="ok",stream="true"} 1'
+    ) in text
+    assert 'llm_time_to_first_token_seconds_sum{model="m",endpoint="https://a"} 0.3' in text
+    assert 'llm_prompt_tokens_sum{model="m",endpoint="https://a"} 100' in text
+    assert 'llm_completion_tokens_sum{model="m",endpoint="https://a"} 20' in text
+
+
+def test_record_llm_call_without_usage():
+    """Тест: без usage и TTFT записывается только задержка"""
+    record_llm_call(LLMCallStats(model="m", endpoint="e", outcome="timeout", latency=30))
+
+    text = render_metrics()
+    assert "llm_request_duration_seconds_count" in text
+    assert "llm_time_to_first_token_seconds_count" not in text
+    assert "llm_prompt_tokens_count" not in text
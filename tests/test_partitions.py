@@ -0,0 +1,125 @@
+"""Тесты для обслуживания партиций messages"""
+
+import sys
+from datetime import date
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config
+from services.partitions import (
+    Partition,
+    add_months,
+    expired_partitions,
+    maintain_partitions,
+    missing_partitions,
+    parse_partition,
+)
+
+TODAY = date(2026, 10, 17)
+
+
+def _config(**kwargs) -> Config:  # type: ignore[no-untyped-def]
+    """Конфигурация для тестов"""
+    return Config(telegram_token="", openai_api_key="", database_url="", **kwargs)
+
+
+def test_add_months():
+    """Тест: первое число месяца со сдвигом через границу года"""
+    assert add_months(TODAY, 0) == date(2026, 10, 1)
+    assert add_months(TODAY, 3) == date(2027, 1, 1)
+    assert add_months(TODAY, -10) == date(2025, 12, 1)
+
+
+def test_parse_partition():
+    """Тест разбора границ из pg_get_expr"""
+    monthly = parse_partition(
+        "messages_y2026m12",
+        "FOR VALUES FROM ('2026-12-01 00:00:00') TO ('2027-01-01 00:00:00')",
+    )
+    legacy = parse_partition(
+        "messages_legacy", "FOR VALUES FROM (MINVALUE) TO ('2026-12-01 00:00:00')"
+    )
+
+    assert monthly == Partition("messages_y2026m12", date(2026, 12, 1), date(2027, 1, 1))
+    assert legacy == Partition("messages_legacy", None, date(2026, 12, 1))
+    assert parse_partition("messages_default", "DEFAULT") is None
+
+
+def test_missing_partitions_skip_covered_months():
+    """Тест: месяцы, покрытые старой таблицей или партициями, не создаются"""
+    existing = [
+        Partition("messages_legacy", None, date(2026, 12, 1)),
+        Partition("messages_y2026m12", date(2026, 12, 1), date(2027, 1, 1)),
+    ]
+
+    missing = missing_partitions(existing, TODAY, months_ahead=3)
+
+    assert missing == [
+        ("messages_y2027m01", date(2027, 1, 1), date(2027, 2, 1)),
+    ]
+
+
+def test_expired_partitions():
+    """Тест: устаревают партиции целиком старше срока хранения"""
+    existing = [
+        Partition("messages_legacy", None, date(2026, 6, 1)),
+        Partition("messages_y2026m06", date(2026, 6, 1), date(2026, 7, 1)),
+        Partition("messages_y2026m07", date(2026, 7, 1), date(2026, 8, 1)),
+    ]
+
+    # Хранятся 3 полных месяца до текущего: июль, август, сентябрь
+    expired = expired_partitions(existing, TODAY, retention_months=3)
+
+    assert [part.name for part in expired] == ["messages_legacy", "messages_y2026m06"]
+    assert expired_partitions(existing, TODAY, retention_months=0) == []
+
+
+@pytest.mark.asyncio
+async def test_maintain_partitions_creates_and_detaches():
+    """Тест: обслуживание создает недостающие партиции и удаляет устаревшие"""
+    rows = [
+        {"name": "messages_legacy", "bound": "FOR VALUES FROM (MINVALUE) TO ('2026-06-01')"},
+        {"name": "messages_y2026m10", "bound": "FOR VALUES FROM ('2026-10-01') TO ('2026-11-01')"},
+    ]
+    mock_create = AsyncMock()
+    mock_detach = AsyncMock()
+
+    with (
+        patch("services.partitions.try_advisory_lock", new=AsyncMock(return_value=True)),
+        patch("services.partitions.list_message_partitions", new=AsyncMock(return_value=rows)),
+        patch("services.partitions.create_message_partition", new=mock_create),
+        patch("services.partitions.detach_message_partition", new=mock_detach),
+    ):
+        config = _config(
+            partition_months_ahead=1, message_retention_months=3, message_retention_drop=True
+        )
+        assert await maintain_partitions(config, today=TODAY) is True
+
+    mock_create.assert_called_once_with("messages_y2026m11", "2026-11-01", "2026-12-01")
+    mock_detach.assert_called_once_with("messages_legacy", drop=True)
+
+
+@pytest.mark.asyncio
+async def test_maintain_partitions_skipped_without_lock_or_partitioning():
+    """Тест: без блокировки или без партиционирования ничего не меняется"""
+    mock_create = AsyncMock()
+
+    with (
+        patch("services.partitions.try_advisory_lock", new=AsyncMock(return_value=False)),
+        patch("services.partitions.create_message_partition", new=mock_create),
+    ):
+        assert await maintain_partitions(_config(), today=TODAY) is False
+
+    with (
+        patch("services.partitions.try_advisory_lock", new=AsyncMock(return_value=True)),
+        patch("services.partitions.list_message_partitions", new=AsyncMock(return_value=None)),
+        patch("services.partitions.create_message_partition", new=mock_create),
+    ):
+        assert await maintain_partitions(_config(), today=TODAY) is False
+
+    mock_create.assert_not_called()
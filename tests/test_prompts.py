@@ -6,7 +6,17 @@ from pathlib import Path
 # Добавляем корневую директорию проекта в путь
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from roles.prompts import DEFAULT_SYSTEM_PROMPT, get_system_prompt
+from config import Config
+from constants import MessageRole
+from roles.prompts import (
+    DEFAULT_SYSTEM_PROMPT,
+    PromptName,
+    get_prompt,
+    get_system_prompt,
+    get_user_prompt,
+)
+from services.analytics import build_analytics_request, get_analytics_prompt
+from services.tokens import count_tokens, message_tokens
 
 
 def test_default_prompt_without_name():
@@ -86,3 +96,60 @@ def test_prompt_with_long_name():
     # Длинное имя должно корректно добавиться
     assert user_name in result
     assert DEFAULT_SYSTEM_PROMPT in result
+
+
+def test_prompt_registry():
+    """Тест реестра: версия, готовое сообщение и заранее посчитанные токены"""
+    prompt = get_prompt(PromptName.CHAT)
+
+    assert prompt.content == DEFAULT_SYSTEM_PROMPT
+    assert prompt.id == f"chat@v{prompt.version}"
+    assert prompt.message == {"role": MessageRole.SYSTEM, "content": DEFAULT_SYSTEM_PROMPT}
+    assert prompt.tokens == message_tokens(count_tokens(DEFAULT_SYSTEM_PROMPT))
+    # Сообщение не пересоздается при каждом обращении
+    assert get_prompt(PromptName.CHAT).message is prompt.message
+
+
+def test_user_prompt_is_separate_message():
+    """Тест: имя пользователя передается отдельным сообщением, а не в system prompt"""
+    assert get_user_prompt("Михаил") == {"role": "system", "content": "Имя пользователя: Михаил"}
+    assert get_user_prompt("") is None
+    assert get_user_prompt(None) is None
+
+
+def test_prompt_registry_versions():
+    """Тест: промпт находится по версии, неизвестная версия заменяется актуальной"""
+    latest = get_prompt(PromptName.CHAT)
+
+    assert get_prompt("chat", latest.version) is latest
+    assert get_prompt(PromptName.CHAT, 999) is latest
+    assert latest.tokens == message_tokens(latest.content_tokens)
+
+
+def test_compact_analytics_prompt_keeps_schema():
+    """Тест: короткий аналитический промпт меньше полного и описывает те же колонки"""
+    full = get_prompt(PromptName.ANALYTICS)
+    compact = get_prompt(PromptName.ANALYTICS_COMPACT)
+
+    assert compact.tokens < full.tokens / 2
+    for column in ("telegram_user_id", "first_name", "telegram_chat_id", "deleted_at", "length"):
+        assert column in compact.content
+
+
+def test_analytics_prompt_selected_by_config():
+    """Тест: вариант аналитического промпта выбирается настройкой ANALYTICS_COMPACT_PROMPT"""
+    config = Config(telegram_token="", openai_api_key="", database_url="")
+    compact_config = Config(
+        telegram_token="", openai_api_key="", database_url="", analytics_compact_prompt=True
+    )
+
+    assert get_analytics_prompt(config).name == PromptName.ANALYTICS
+    assert get_analytics_prompt(compact_config).name == PromptName.ANALYTICS_COMPACT
+
+    # Существующий system prompt истории заменяется выбранным вариантом
+    history = [{"role": MessageRole.SYSTEM, "content": "Old"}]
+    request = build_analytics_request("Сколько чатов?", history, compact_config)
+    assert request == [
+        get_prompt(PromptName.ANALYTICS_COMPACT).message,
+        {"role": MessageRole.USER, "content": "Сколько чатов?"},
+    ]
@@ -0,0 +1,109 @@
+"""Тесты для фоновой очистки soft-deleted сообщений"""
+
+import asyncio
+import sys
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config
+from services.metrics import MESSAGES_PURGE_LAG_SECONDS, MESSAGES_PURGED, _reset_metrics
+from services.purge import purge_messages, reclaim_messages, run_message_purge
+
+KEY_1 = (datetime(2026, 10, 1), 10)
+KEY_2 = (datetime(2026, 10, 2), 20)
+
+
+def _config(**kwargs) -> Config:  # type: ignore[no-untyped-def]
+    """Конфигурация для тестов"""
+    return Config(telegram_token="", openai_api_key="", database_url="", **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """Сброс метрик перед каждым тестом"""
+    _reset_metrics()
+    yield
+    _reset_metrics()
+
+
+@pytest.mark.asyncio
+async def test_purge_messages_batches_until_empty():
+    """Тест: пачки идут по ключу предыдущей до пустой, строки учитываются в метриках"""
+    mock_purge = AsyncMock(side_effect=[(500, KEY_1), (120, KEY_2), (0, None)])
+
+    with (
+        patch("services.purge.purge_deleted_messages", new=mock_purge),
+        patch("services.purge.get_purge_lag", new=AsyncMock(return_value=42.0)),
+        patch("services.purge.asyncio.sleep", new=AsyncMock()) as mock_sleep,
+    ):
+        config = _config(
+            message_purge_grace_hours=1, message_purge_batch_size=500, message_purge_batch_pause=0.1
+        )
+        assert await purge_messages(config) == 620
+
+    assert [call.args for call in mock_purge.call_args_list] == [
+        (3600, None, 500, True),
+        (3600, KEY_1, 500, True),
+        (3600, KEY_2, 500, True),
+    ]
+    assert mock_sleep.await_count == 2
+    assert 'messages_purged_total{action="archived"} 620' in MESSAGES_PURGED.render()
+    assert "messages_purge_lag_seconds 42" in MESSAGES_PURGE_LAG_SECONDS.render()
+
+
+@pytest.mark.asyncio
+async def test_purge_messages_without_archive():
+    """Тест: без архива строки учитываются как удаленные"""
+    mock_purge = AsyncMock(side_effect=[(5, KEY_1), (0, None)])
+
+    with (
+        patch("services.purge.purge_deleted_messages", new=mock_purge),
+        patch("services.purge.get_purge_lag", new=AsyncMock(return_value=0.0)),
+        patch("services.purge.asyncio.sleep", new=AsyncMock()),
+    ):
+        assert await purge_messages(_config(message_purge_archive=False)) == 5
+
+    assert mock_purge.call_args_list[0].args[3] is False
+    assert 'messages_purged_total{action="deleted"} 5' in MESSAGES_PURGED.render()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_messages_marks_cleared_conversations():
+    """Тест: сообщения прошлых эпох помечаются удаленными пачками, пока есть очищенные диалоги"""
+    mock_reclaim = AsyncMock(side_effect=[500, 30, 0, None])
+
+    with (
+        patch("services.purge.reclaim_cleared_messages", new=mock_reclaim),
+        patch("services.purge.asyncio.sleep", new=AsyncMock()),
+    ):
+        config = _config(message_purge_batch_size=500)
+        assert await reclaim_messages(config) == 530
+
+    assert mock_reclaim.await_count == 4
+    assert mock_reclaim.call_args.args == (500,)
+    # Строки не удалены физически - в счетчик очистки не попадают
+    assert "messages_purged_total{" not in MESSAGES_PURGED.render()
+
+
+@pytest.mark.asyncio
+async def test_run_message_purge_reclaims_without_purge_enabled():
+    """Тест: очищенная история помечается удаленной и при выключенной очистке"""
+    mock_reclaim = AsyncMock(return_value=None)
+    mock_purge = AsyncMock(return_value=(0, None))
+
+    with (
+        patch("services.purge.reclaim_cleared_messages", new=mock_reclaim),
+        patch("services.purge.purge_deleted_messages", new=mock_purge),
+        patch("services.purge.asyncio.sleep", new=AsyncMock(side_effect=asyncio.CancelledError)),
+    ):
+        with pytest.raises(asyncio.CancelledError):
+            await run_message_purge(_config(message_purge_enabled=False))
+
+    mock_reclaim.assert_awaited_once()
+    mock_purge.assert_not_called()
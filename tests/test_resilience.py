@@ -0,0 +1,250 @@
+"""Тесты для повторных попыток и circuit breaker"""
+
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from openai import APIStatusError, APITimeoutError, RateLimitError
+
+from config import Config
+from services.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    CircuitState,
+    call_with_failover,
+)
+
+
+@dataclass
+class _Target:
+    """Цель запроса со своим breaker"""
+
+    breaker: CircuitBreaker
+
+
+async def _call_with_retries(call, config, breaker):  # type: ignore[no-untyped-def]
+    """Повторы на единственной цели: call принимает только таймаут"""
+    target = _Target(breaker)
+    return await call_with_failover(
+        lambda _, timeout: call(timeout),
+        config,
+        lambda failed: target if breaker.allow() else None,
+    )
+
+
+@pytest.fixture
+def config() -> Config:
+    """Конфигурация с двумя повторами"""
+    return Config(
+        telegram_token="t",
+        openai_api_key="k",
+        database_url="db",
+        openai_timeout=30,
+        llm_max_retries=2,
+    )
+
+
+def _status_error(status_code: int, headers: dict | None = None) -> APIStatusError:
+    """Ошибка провайдера с заданным статусом и заголовками"""
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    if status_code == 429:
+        return RateLimitError("Rate limit", response=response, body=None)
+    return APIStatusError("Error", response=response, body=None)
+
+
+@pytest.mark.asyncio
+async def test_retries_transient_error(config):
+    """Тест: временная ошибка повторяется, затем возвращается успешный ответ"""
+    call = AsyncMock(side_effect=[_status_error(503), "ok"])
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+    with patch("services.resilience.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        assert await _call_with_retries(call, config, breaker) == "ok"
+
+    assert call.call_count == 2
+    mock_sleep.assert_called_once()
+    # Каждая попытка получает остаток общего бюджета
+    assert call.call_args_list[0].args[0] <= 30
+    assert breaker.state == CircuitState.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_retry_honours_retry_after(config):
+    """Тест: пауза берется из Retry-After провайдера"""
+    call = AsyncMock(side_effect=[_status_error(429, {"retry-after": "3"}), "ok"])
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+    with patch("services.resilience.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        assert await _call_with_retries(call, config, breaker) == "ok"
+
+    mock_sleep.assert_called_once_with(3.0)
+
+
+@pytest.mark.asyncio
+async def test_no_retry_for_client_error(config):
+    """Тест: ошибки запроса (4xx) не повторяются"""
+    call = AsyncMock(side_effect=_status_error(404))
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+    with pytest.raises(APIStatusError):
+        await _call_with_retries(call, config, breaker)
+
+    assert call.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_respects_deadline(config):
+    """Тест: повтор не выполняется, если пауза не помещается в бюджет openai_timeout"""
+    call = AsyncMock(side_effect=_status_error(429, {"retry-after": "60"}))
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+    with patch("services.resilience.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        with pytest.raises(RateLimitError):
+            await _call_with_retries(call, config, breaker)
+
+    assert call.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_and_recovers(config):
+    """Тест: breaker открывается после ошибок подряд и закрывается после пробного запроса"""
+    config.llm_max_retries = 0
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    failing = AsyncMock(side_effect=_status_error(502))
+
+    with patch("services.resilience.time.monotonic", return_value=100.0):
+        for _ in range(2):
+            with pytest.raises(APIStatusError):
+                await _call_with_retries(failing, config, breaker)
+        assert breaker.state == CircuitState.OPEN
+
+        # Пока breaker открыт, провайдер не вызывается
+        with pytest.raises(CircuitOpenError):
+            await _call_with_retries(failing, config, breaker)
+        assert failing.call_count == 2
+
+    # После reset_timeout пропускается пробный запрос
+    with patch("services.resilience.time.monotonic", return_value=131.0):
+        assert await _call_with_retries(AsyncMock(return_value="ok"), config, breaker) == "ok"
+
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.stats()["opened_total"] == 1
+    assert breaker.stats()["rejected_total"] == 1
+
+
+def test_circuit_breaker_half_open_single_probe():
+    """Тест: в состоянии half-open пропускается только один пробный запрос"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+    with patch("services.resilience.time.monotonic", return_value=100.0):
+        breaker.record_failure()
+
+    with patch("services.resilience.time.monotonic", return_value=131.0):
+        assert breaker.allow() is True
+        assert breaker.allow() is False
+        # Пробный запрос не удался - breaker снова открыт
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+
+
+@pytest.mark.asyncio
+async def test_failover_to_other_target_without_delay(config):
+    """Тест: при ошибке повтор сразу идет на другую цель, пауза не нужна"""
+    primary, secondary = _Target(CircuitBreaker(5, 30)), _Target(CircuitBreaker(5, 30))
+    calls = []
+
+    async def call(target, timeout):  # type: ignore[no-untyped-def]
+        calls.append(target)
+        if target is primary:
+            raise _status_error(503)
+        return "ok"
+
+    def pick(failed):  # type: ignore[no-untyped-def]
+        return next(t for t in (primary, secondary) if t not in failed)
+
+    with patch("services.resilience.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        assert await call_with_failover(call, config, pick) == "ok"
+
+    assert calls == [primary, secondary]
+    mock_sleep.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_failover_uses_given_deadline(config):
+    """Тест: с заданным сроком попытка получает оставшееся до него время, а не openai_timeout"""
+    call = AsyncMock(return_value="ok")
+    target = _Target(CircuitBreaker(failure_threshold=5, reset_timeout=30))
+
+    with patch("services.resilience.time.monotonic", return_value=100.0):
+        result = await call_with_failover(call, config, lambda failed: target, deadline=103.0)
+
+    assert result == "ok"
+    assert call.call_args.args == (target, 3.0)
+
+
+@pytest.mark.asyncio
+async def test_failover_skipped_when_budget_nearly_exhausted(config):
+    """Тест: переключение не выполняется, если от бюджета осталось меньше минимума на попытку"""
+    primary, secondary = _Target(CircuitBreaker(5, 30)), _Target(CircuitBreaker(5, 30))
+    call = AsyncMock(side_effect=_status_error(503))
+
+    def pick(failed):  # type: ignore[no-untyped-def]
+        return next(t for t in (primary, secondary) if t not in failed)
+
+    with patch("services.resilience.time.monotonic", return_value=100.0):
+        with pytest.raises(APIStatusError):
+            await call_with_failover(call, config, pick, deadline=101.0)
+
+    assert call.call_count == 1
+    assert secondary.breaker.stats()["consecutive_failures"] == 0
+
+
+@pytest.mark.asyncio
+async def test_budget_timeout_not_charged_to_breaker(config):
+    """Тест: таймаут попытки с урезанным бюджетом не считается ошибкой провайдера"""
+    config.llm_max_retries = 0
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    target = _Target(breaker)
+    call = AsyncMock(side_effect=APITimeoutError(request=MagicMock()))
+
+    with patch("services.resilience.time.monotonic", return_value=100.0):
+        with pytest.raises(APITimeoutError):
+            await call_with_failover(call, config, lambda failed: target, deadline=105.0)
+
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.stats()["consecutive_failures"] == 0
+
+    # Таймаут с полным openai_timeout - ошибка провайдера
+    with pytest.raises(APITimeoutError):
+        await call_with_failover(call, config, lambda failed: target)
+    assert breaker.state == CircuitState.OPEN
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_does_not_reset_breaker(config):
+    """Тест: 429 не сбрасывает счетчик ошибок и не закрывает half-open breaker"""
+    config.llm_max_retries = 0
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    rate_limited = AsyncMock(side_effect=_status_error(429))
+
+    with pytest.raises(RateLimitError):
+        await _call_with_retries(rate_limited, config, breaker)
+    assert breaker.stats()["consecutive_failures"] == 1
+
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    with patch("services.resilience.time.monotonic", return_value=time.monotonic() + 31):
+        with pytest.raises(RateLimitError):
+            await _call_with_retries(rate_limited, config, breaker)
+        # Пробный запрос не дал ответа о провайдере - breaker не закрыт, можно пробовать снова
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert breaker.allow() is True
@@ -0,0 +1,107 @@
+"""Тесты для маршрутизации запросов к LLM"""
+
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from openai import APIStatusError
+
+from config import Config
+from services.resilience import CircuitBreaker
+from services.router import LLMEndpoint, LLMRouter, parse_endpoints
+
+
+def _config(**kwargs) -> Config:  # type: ignore[no-untyped-def]
+    """Конфигурация для тестов"""
+    return Config(telegram_token="t", openai_api_key="main-key", database_url="db", **kwargs)
+
+
+def _endpoint(name: str, weight: float = 1.0, latency: float | None = None) -> LLMEndpoint:
+    """Endpoint с заданной задержкой"""
+    return LLMEndpoint(
+        base_url=f"https://{name}",
+        model="model",
+        api_key="key",
+        weight=weight,
+        breaker=CircuitBreaker(failure_threshold=1, reset_timeout=30),
+        latency_ewma=latency,
+    )
+
+
+def test_parse_endpoints_default():
+    """Тест: без LLM_ENDPOINTS используется OPENAI_BASE_URL/OPENAI_MODEL"""
+    endpoints = parse_endpoints(_config(openai_base_url="https://main", openai_model="m"))
+
+    assert [(ep.base_url, ep.model, ep.api_key, ep.weight) for ep in endpoints] == [
+        ("https://main", "m", "main-key", 1.0)
+    ]
+
+
+def test_parse_endpoints_list():
+    """Тест разбора LLM_ENDPOINTS: модель, вес и переменная с ключом API"""
+    config = _config(
+        openai_model="default-model",
+        llm_endpoints="https://a|openai/gpt-oss-20b:free|2, https://b||1|FALLBACK_KEY",
+    )
+
+    with patch.dict("os.environ", {"FALLBACK_KEY": "fallback-key"}):
+        endpoints = parse_endpoints(config)
+
+    assert [(ep.base_url, ep.model, ep.api_key, ep.weight) for ep in endpoints] == [
+        ("https://a", "openai/gpt-oss-20b:free", "main-key", 2.0),
+        ("https://b", "default-model", "fallback-key", 1.0),
+    ]
+
+
+def test_parse_endpoints_invalid():
+    """Тест ошибок конфигурации: некорректный вес и отсутствующий ключ"""
+    with pytest.raises(ValueError, match="вес"):
+        parse_endpoints(_config(llm_endpoints="https://a|m|fast"))
+
+    with patch.dict("os.environ", {}, clear=True):
+        with pytest.raises(ValueError, match="MISSING_KEY"):
+            parse_endpoints(_config(llm_endpoints="https://a|m|1|MISSING_KEY"))
+
+
+def test_pick_prefers_fast_and_heavy_endpoints():
+    """Тест выбора: меньшая задержка на единицу веса, открытый breaker пропускается"""
+    slow, fast, heavy = (
+        _endpoint("slow", latency=4.0),
+        _endpoint("fast", latency=1.0),
+        _endpoint("heavy", weight=4.0, latency=2.0),
+    )
+    router = LLMRouter([slow, fast, heavy])
+
+    assert router.pick([]) is heavy
+
+    heavy.breaker.record_failure()
+    assert router.pick([]) is fast
+    # Уже неудачные endpoint'ы - в последнюю очередь
+    assert router.pick([fast]) is slow
+
+
+@pytest.mark.asyncio
+async def test_call_fails_over_and_tracks_stats():
+    """Тест: при ошибке запрос переключается на другой endpoint, статистика обновляется"""
+    primary, secondary = _endpoint("primary", latency=1.0), _endpoint("secondary", latency=2.0)
+    router = LLMRouter([primary, secondary])
+
+    async def fn(endpoint, timeout):  # type: ignore[no-untyped-def]
+        if endpoint is primary:
+            raise APIStatusError("down", response=MagicMock(status_code=503), body=None)
+        return endpoint.base_url
+
+    assert await router.call(fn, _config()) == "https://secondary"
+
+    stats = {s["endpoint"]: s for s in router.stats()}
+    assert stats["model@https://primary"]["failures"] == 1
+    assert stats["model@https://primary"]["healthy"] is False
+    assert stats["model@https://secondary"]["requests"] == 1
+    assert primary.error_rate > 0
+    # Следующий запрос сразу идет на здоровый endpoint
+    assert await router.call(fn, _config()) == "https://secondary"
@@ -0,0 +1,179 @@
+"""Тесты для планировщика запросов к LLM"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from constants import LLMPriority
+from services.metrics import _reset_metrics, render_metrics
+from services.scheduler import LLMScheduler
+
+
+async def _run_queued(
+    scheduler: LLMScheduler, requests: list[tuple[str, int, LLMPriority]]
+) -> list[str]:
+    """Занять единственный слот, поставить запросы в очередь и вернуть порядок выполнения"""
+    order: list[str] = []
+    release = asyncio.Event()
+
+    async def blocker() -> None:
+        async with scheduler.slot(0):
+            await release.wait()
+
+    async def request(name: str, user_id: int, priority: LLMPriority) -> None:
+        async with scheduler.slot(user_id, priority):
+            order.append(name)
+
+    blocking = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    tasks = []
+    for name, user_id, priority in requests:
+        tasks.append(asyncio.create_task(request(name, user_id, priority)))
+        await asyncio.sleep(0)
+
+    release.set()
+    await asyncio.gather(blocking, *tasks)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_scheduler_limits_concurrency():
+    """Тест: одновременно выполняется не больше max_concurrency запросов"""
+    scheduler = LLMScheduler(max_concurrency=2)
+    running = 0
+    max_running = 0
+
+    async def request(user_id: int) -> None:
+        nonlocal running, max_running
+        async with scheduler.slot(user_id):
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(request(i) for i in range(6)))
+
+    assert max_running == 2
+    assert scheduler.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_fair_between_users():
+    """Тест: пользователь с пачкой запросов не задерживает других пользователей"""
+    scheduler = LLMScheduler(max_concurrency=1)
+
+    order = await _run_queued(
+        scheduler,
+        [
+            ("a1", 1, LLMPriority.CHAT),
+            ("a2", 1, LLMPriority.CHAT),
+            ("a3", 1, LLMPriority.CHAT),
+            ("b1", 2, LLMPriority.CHAT),
+        ],
+    )
+
+    assert order.index("b1") < order.index("a2")
+
+
+@pytest.mark.asyncio
+async def test_scheduler_background_lane_does_not_block_chat():
+    """Тест: запрос бота обгоняет накопившиеся фоновые задачи"""
+    scheduler = LLMScheduler(max_concurrency=1)
+
+    order = await _run_queued(
+        scheduler,
+        [
+            ("bg1", 1, LLMPriority.BACKGROUND),
+            ("bg2", 1, LLMPriority.BACKGROUND),
+            ("bg3", 1, LLMPriority.BACKGROUND),
+            ("chat", 2, LLMPriority.CHAT),
+        ],
+    )
+
+    assert order.index("chat") <= 1
+    # Фоновые задачи все равно выполняются
+    assert set(order) == {"bg1", "bg2", "bg3", "chat"}
+
+    lanes = scheduler.stats()["lanes"]
+    assert lanes["background"]["granted"] == 3
+    assert lanes["background"]["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancelled_waiter_frees_queue():
+    """Тест: отмененный запрос из очереди не занимает слот"""
+    scheduler = LLMScheduler(max_concurrency=1)
+    release = asyncio.Event()
+
+    async def blocker() -> None:
+        async with scheduler.slot(1):
+            await release.wait()
+
+    async def request() -> None:
+        async with scheduler.slot(2):
+            pass
+
+    blocking = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(request())
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.sleep(0)
+
+    release.set()
+    await blocking
+
+    assert scheduler.stats()["active"] == 0
+    async with scheduler.slot(3):
+        assert scheduler.stats()["active"] == 1
+
+
+@pytest.mark.asyncio
+async def test_saturated_when_all_slots_taken():
+    """Тест: планировщик занят, пока все слоты заняты"""
+    scheduler = LLMScheduler(max_concurrency=1)
+    assert not scheduler.saturated()
+
+    async with scheduler.slot(1):
+        assert scheduler.saturated()
+
+    assert not scheduler.saturated()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_queue_metrics():
+    """Тест: глубина очереди и время ожидания по полосам экспортируются в /metrics"""
+    _reset_metrics()
+    scheduler = LLMScheduler(max_concurrency=1)
+    release = asyncio.Event()
+
+    async def blocker() -> None:
+        async with scheduler.slot(1):
+            await release.wait()
+
+    async def request() -> None:
+        async with scheduler.slot(2, LLMPriority.BACKGROUND):
+            pass
+
+    blocking = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(request())
+    await asyncio.sleep(0)
+
+    assert 'llm_queue_depth{lane="background"} 1' in render_metrics()
+
+    release.set()
+    await asyncio.gather(blocking, waiting)
+
+    metrics = render_metrics()
+    assert 'llm_queue_depth{lane="background"} 0' in metrics
+    assert 'llm_queue_depth{lane="chat"} 0' in metrics
+    # Сразу получивший слот запрос учитывается с нулевым ожиданием
+    assert 'llm_queue_wait_seconds_bucket{lane="chat",le="0.01"} 1' in metrics
+    assert 'llm_queue_wait_seconds_count{lane="background"} 1' in metrics
+    _reset_metrics()
@@ -0,0 +1,175 @@
+"""Тесты для фонового сжатия диалогов"""
+
+import asyncio
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config
+from constants import LLMPriority
+from roles.prompts import SUMMARY_PREFIX
+from services.summarizer import schedule_summary, summarize_conversation
+
+
+@pytest.fixture
+def config() -> Config:
+    """Конфигурация с включенным сжатием"""
+    return Config(
+        telegram_token="t",
+        openai_api_key="k",
+        database_url="db",
+        max_context_messages=6,
+        summary_enabled=True,
+        summary_trigger_tokens=1000,
+        summary_keep_messages=2,
+    )
+
+
+def _conversation(rows: list) -> dict:
+    """Результат load_conversation"""
+    return {"user_id": 7, "chat_id": 8, "messages": rows}
+
+
+def _dialogue(count: int, start_id: int = 10) -> list:
+    """Чередующиеся сообщения user/assistant"""
+    return [
+        {
+            "id": start_id + i,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Message {i}",
+            "tokens": 3,
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_summarize_below_threshold(config):
+    """Тест: короткий диалог не сжимается и LLM не вызывается"""
+    rows = [{"id": 1, "role": "system", "content": "Prompt", "tokens": 2}, *_dialogue(4)]
+    mock_llm = AsyncMock()
+
+    with (
+        patch(
+            "services.summarizer.load_conversation", new=AsyncMock(return_value=_conversation(rows))
+        ),
+        patch("services.summarizer.complete_chat", new=mock_llm),
+    ):
+        assert await summarize_conversation(123, 456, config) is False
+
+    mock_llm.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_summarize_replaces_old_messages(config):
+    """Тест: старые сообщения и предыдущее краткое содержание заменяются новым"""
+    rows = [
+        {"id": 1, "role": "system", "content": "Prompt", "tokens": 2},
+        {"id": 5, "role": "summary", "content": "Earlier facts", "tokens": 3},
+        *_dialogue(6),
+    ]
+    mock_llm = AsyncMock(return_value="New summary")
+    mock_replace = AsyncMock(return_value={"id": 99})
+
+    with (
+        patch(
+            "services.summarizer.load_conversation", new=AsyncMock(return_value=_conversation(rows))
+        ),
+        patch("services.summarizer.complete_chat", new=mock_llm),
+        patch("services.summarizer.replace_with_summary", new=mock_replace),
+        patch("services.summarizer.invalidate_context") as mock_invalidate,
+    ):
+        assert await summarize_conversation(123, 456, config) is True
+
+    # Фоновый запрос: предыдущее краткое содержание + 4 старых сообщения
+    prompt = mock_llm.call_args.args[0]
+    assert mock_llm.call_args.kwargs["priority"] == LLMPriority.BACKGROUND
+    assert prompt[1]["content"].startswith("Earlier facts")
+    assert "Пользователь: Message 0" in prompt[1]["content"]
+    assert "Message 4" not in prompt[1]["content"]
+
+    mock_replace.assert_called_once_with(7, 8, [5, 10, 11, 12, 13], SUMMARY_PREFIX + "New summary")
+    mock_invalidate.assert_called_once_with(123, 456)
+
+
+@pytest.mark.asyncio
+async def test_summarize_by_token_threshold(config):
+    """Тест: диалог сжимается при превышении порога токенов"""
+    rows = _dialogue(4)
+    rows[0]["tokens"] = 2000
+
+    with (
+        patch(
+            "services.summarizer.load_conversation", new=AsyncMock(return_value=_conversation(rows))
+        ),
+        patch("services.summarizer.complete_chat", new=AsyncMock(return_value="Summary")),
+        patch(
+            "services.summarizer.replace_with_summary", new=AsyncMock(return_value={"id": 99})
+        ) as mock_replace,
+        patch("services.summarizer.invalidate_context"),
+    ):
+        assert await summarize_conversation(123, 456, config) is True
+
+    assert mock_replace.call_args.args[2] == [10, 11]
+
+
+@pytest.mark.asyncio
+async def test_summarize_llm_error_keeps_messages(config):
+    """Тест: при ошибке LLM сообщения не удаляются"""
+    mock_replace = AsyncMock()
+
+    with (
+        patch(
+            "services.summarizer.load_conversation",
+            new=AsyncMock(return_value=_conversation(_dialogue(6))),
+        ),
+        patch("services.summarizer.complete_chat", new=AsyncMock(side_effect=RuntimeError("down"))),
+        patch("services.summarizer.replace_with_summary", new=mock_replace),
+    ):
+        assert await summarize_conversation(123, 456, config) is False
+
+    mock_replace.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_disabled(config):
+    """Тест: при выключенной настройке фоновая задача не создается"""
+    config.summary_enabled = False
+
+    with patch("services.summarizer.asyncio.create_task") as mock_create_task:
+        schedule_summary(123, 456, config, _dialogue(10))
+
+    mock_create_task.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_below_threshold_skips_database(config):
+    """Тест: ниже порога (по контексту вызывающего) диалог из БД не загружается"""
+    mock_load = AsyncMock()
+    messages = [{"role": "system", "content": "Prompt"}, *_dialogue(4)]
+
+    with (
+        patch("services.summarizer.load_conversation", new=mock_load),
+        patch("services.summarizer.asyncio.create_task") as mock_create_task,
+    ):
+        schedule_summary(123, 456, config, messages)
+
+    mock_create_task.assert_not_called()
+    mock_load.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_over_threshold_starts_task(config):
+    """Тест: порог превышен - сжатие запускается в фоне"""
+    mock_summarize = AsyncMock(return_value=True)
+
+    with patch("services.summarizer.summarize_conversation", new=mock_summarize):
+        schedule_summary(123, 456, config, _dialogue(6))
+        await asyncio.sleep(0)
+
+    mock_summarize.assert_awaited_once_with(123, 456, config)
@@ -0,0 +1,42 @@
+"""Тесты для оценки токенов и бюджета контекста"""
+
+import sys
+from pathlib import Path
+
+# Добавляем корневую директорию проекта в путь
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import Config
+from constants import DEFAULT_CONTEXT_WINDOW
+from services.tokens import count_tokens, get_context_budget, get_context_window
+
+
+def _config(**kwargs) -> Config:  # type: ignore[no-untyped-def]
+    """Конфигурация для тестов"""
+    return Config(telegram_token="t", openai_api_key="k", database_url="db", **kwargs)
+
+
+def test_count_tokens():
+    """Тест оценки токенов: ~4 байта UTF-8 на токен"""
+    assert count_tokens("") == 0
+    assert count_tokens("abcd") == 1
+    assert count_tokens("Hello") == 2
+    # Кириллица занимает 2 байта на символ
+    assert count_tokens("Привет") == 3
+
+
+def test_context_window_by_model():
+    """Тест определения окна контекста по названию модели"""
+    assert get_context_window(_config(openai_model="openai/gpt-4o-mini")) == 128000
+    assert get_context_window(_config(openai_model="unknown-model")) == DEFAULT_CONTEXT_WINDOW
+    # Явная настройка важнее таблицы моделей
+    assert get_context_window(_config(openai_model="gpt-4o", context_window_tokens=4096)) == 4096
+
+
+def test_context_budget_reserves_answer():
+    """Тест: бюджет контекста оставляет место под ответ модели"""
+    config = _config(context_window_tokens=4096, max_tokens=1000)
+    assert get_context_budget(config) == 3096
+
+    config = _config(context_window_tokens=500, max_tokens=1000)
+    assert get_context_budget(config) == 0